@@ -1,11 +1,15 @@
+import io, os
+from collections import OrderedDict
 from dataclasses import dataclass, field
+from typing import Iterable
 from struct import pack_into
 import bpy
 from warnings import warn
 from .serialization import Serializable, Numeric, FixedArray, ResizableBuffer
-from . import prs, njcm, xvm, xj, util
+from . import prs, njcm, xvm, xj, dxt, util
 from .nj import nj_to_blender_mesh
-from .iff import IffChunk, IffHeader, parse_pof0
+from .iff import IffChunk, IffHeader, read_chunks, read_pof0
+from .njtl import read_texture_names
 
 
 U8 = Numeric.U8
@@ -69,64 +73,145 @@ class BmlItem:
     pointer_table: list[int] = field(default_factory=list)
 
 
-def parse_bml(path: str) -> list[BmlItem]:
-    with open(path, "rb") as f:
-        bml = bytearray(f.read())
+def parse_entry(name: str, compression_type: int, file_data: bytes, decompressed_size: int, texture_data: bytes, textures_decompressed_size: int) -> BmlItem:
+    "Decompresses and reads the chunks of one file inside a BML"
+    item = BmlItem(name=name)
 
-    items = []
-    (bml_header, _) = BmlHeader.deserialize_from(bml)
-    file_description_offset = BmlHeader.type_size()
-    file_alignment = 0x20 if bml_header.has_textures else 0x800
-    file_offset = util.align_up(bml_header.file_count * 0x40, 0x800)
-    chunk_header_size = IffHeader.type_size()
-
-    for i in range(bml_header.file_count):
-        # Read file description
-        (file_description, file_description_offset) = FileDescription.deserialize_from(bml, offset=file_description_offset)
-        item = BmlItem(name=util.bytes_to_string(file_description.name))
-        items.append(item)
-
-        # Get file from offset, decompress if needed
-        file_data = bml[file_offset:file_offset + file_description.compressed_size]
-        if bml_header.compression_type == CompressionType.PRS:
-            file_data = prs.decompress(file_data)
-        
-        # Read iff chunks
-        chunk_offset = 0
-        prev_chunk_offset = None
-        prev_chunk_size = None
-        while chunk_offset < file_description.decompressed_size:
-            (chunk_header, _) = IffHeader.deserialize_from(file_data, offset=chunk_offset)
-            chunk_type = util.bytes_to_string(chunk_header.type_name)
-            chunk_body = file_data[chunk_offset + chunk_header_size:chunk_offset + chunk_header_size + chunk_header.body_size]
-
-            if chunk_type == "NJCM":
-                item.models.append(chunk_body)
-            elif chunk_type == "NJTL":
-                item.texture_list = chunk_body
-            elif chunk_type == "NMDM":
-                item.animation = chunk_body
-            elif chunk_type == "POF0":
-                if prev_chunk_offset is None:
-                    # POF0 must always come after another chunk
-                    warn("BML Warning: File '{}' contains a POF0 chunk at index zero".format(item.name))
-                else:
-                    item.pointer_table = parse_pof0(item.name, file_data, prev_chunk_offset, prev_chunk_size, chunk_offset, chunk_header.body_size)
+    # Decompress while reading chunks if needed
+    if compression_type == CompressionType.PRS:
+        file_stream = prs.Reader(file_data, decompressed_size)
+    else:
+        file_stream = io.BytesIO(file_data)
+
+    # Read iff chunks
+    prev_chunk_offset = None
+    prev_chunk_body = None
+    for (chunk_type, chunk_offset, chunk_body) in read_chunks(file_stream):
+        if chunk_type == "NJCM":
+            item.models.append(chunk_body)
+        elif chunk_type == "NJTL":
+            item.texture_list = chunk_body
+        elif chunk_type == "NMDM":
+            item.animation = chunk_body
+        elif chunk_type == "POF0":
+            if prev_chunk_offset is None:
+                # POF0 must always come after another chunk
+                warn("BML Warning: File '{}' contains a POF0 chunk at index zero".format(item.name))
             else:
-                warn("BML Warning: File '{}' has an unknown IFF chunk type '{}'".format(item.name, chunk_type))
+                item.pointer_table = read_pof0(chunk_body, prev_chunk_body, prev_chunk_offset)
+        else:
+            warn("BML Warning: File '{}' has an unknown IFF chunk type '{}'".format(item.name, chunk_type))
 
-            prev_chunk_offset = chunk_offset
-            prev_chunk_size = chunk_header.body_size
-            chunk_offset += chunk_header.body_size + chunk_header_size
+        prev_chunk_offset = chunk_offset
+        prev_chunk_body = chunk_body
 
-        file_offset += util.align_up(file_description.compressed_size, file_alignment)
+    if texture_data is not None:
+        # Texture archive is always PRS compressed
+        item.texture_archive = prs.decompress(texture_data, textures_decompressed_size)
+    return item
 
-        if file_description.textures_compressed_size > 0:
-            # Texture archive is always PRS compressed
-            item.texture_archive = prs.decompress(bml[file_offset:file_offset + file_description.textures_compressed_size])
-            file_offset += util.align_up(file_description.textures_compressed_size, file_alignment)
 
-    return items
+@dataclass
+class BmlEntry:
+    "Where a file and its texture archive are inside a BML"
+    name: str
+    offset: int
+    compressed_size: int
+    decompressed_size: int
+    textures_offset: int
+    textures_compressed_size: int
+    textures_decompressed_size: int
+
+
+class BmlArchive:
+    """Only reads the header and file descriptions when opened. Files are decompressed when they're opened,
+    and the most recently opened ones are kept in a cache limited to cache_size bytes of decompressed data."""
+    DEFAULT_CACHE_SIZE = 0x4000000
+
+    def __init__(self, path: str, cache_size: int=DEFAULT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, BmlItem] = OrderedDict()
+        self._cached_size = 0
+        self._file = open(path, "rb")
+        (self.header, _) = BmlHeader.deserialize_from(self._file.read(BmlHeader.type_size()))
+        file_descriptions = self._file.read(self.header.file_count * FileDescription.type_size())
+        file_description_offset = 0
+        file_alignment = 0x20 if self.header.has_textures else 0x800
+        file_offset = util.align_up(self.header.file_count * 0x40, 0x800)
+
+        self.entries: list[BmlEntry] = []
+        for i in range(self.header.file_count):
+            (file_description, file_description_offset) = FileDescription.deserialize_from(file_descriptions, offset=file_description_offset)
+            entry = BmlEntry(
+                name=util.bytes_to_string(file_description.name),
+                offset=file_offset,
+                compressed_size=file_description.compressed_size,
+                decompressed_size=file_description.decompressed_size,
+                textures_offset=0,
+                textures_compressed_size=file_description.textures_compressed_size,
+                textures_decompressed_size=file_description.textures_decompressed_size)
+            file_offset += util.align_up(file_description.compressed_size, file_alignment)
+            if file_description.textures_compressed_size > 0:
+                entry.textures_offset = file_offset
+                file_offset += util.align_up(file_description.textures_compressed_size, file_alignment)
+            self.entries.append(entry)
+        self._entries_by_name = {entry.name: entry for entry in reversed(self.entries)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def names(self) -> list[str]:
+        return [entry.name for entry in self.entries]
+
+    def open(self, name: str) -> BmlItem:
+        item = self._cache.get(name)
+        if item is not None:
+            self._cache.move_to_end(name)
+            return item
+        entry = self._entries_by_name.get(name)
+        if entry is None:
+            raise Exception("BML Error: No file named '{}' in archive".format(name))
+        item = parse_entry(*self.entry_args(entry))
+        # Items bigger than the whole cache aren't kept
+        item_size = BmlArchive.item_size(item)
+        if item_size <= self.cache_size:
+            self._cache[name] = item
+            self._cached_size += item_size
+            while self._cached_size > self.cache_size:
+                (_, evicted) = self._cache.popitem(last=False)
+                self._cached_size -= BmlArchive.item_size(evicted)
+        return item
+
+    def entry_args(self, entry: BmlEntry) -> tuple:
+        "Reads the compressed data of an entry and returns the arguments of parse_entry for it"
+        self._file.seek(entry.offset)
+        file_data = self._file.read(entry.compressed_size)
+        texture_data = None
+        if entry.textures_compressed_size > 0:
+            self._file.seek(entry.textures_offset)
+            texture_data = self._file.read(entry.textures_compressed_size)
+        return (entry.name, self.header.compression_type, file_data, entry.decompressed_size, texture_data, entry.textures_decompressed_size)
+
+    @staticmethod
+    def item_size(item: BmlItem) -> int:
+        chunks = item.models + [item.texture_list, item.texture_archive, item.animation]
+        return sum(len(chunk) for chunk in chunks if chunk is not None)
+
+
+def parse_bml(path: str, workers: int=None) -> list[BmlItem]:
+    """Files inside the BML are decompressed and read in a process pool with the given number of workers
+    (default is one per CPU). Items are returned in the same order as in the BML."""
+    # Read all compressed files first so that they can be decompressed independently
+    with BmlArchive(path) as archive:
+        entries = [archive.entry_args(entry) for entry in archive.entries]
+
+    return util.starmap_forked(parse_entry, entries, workers)
 
 
 def to_blender_mesh(bml_item: BmlItem) -> list[bpy.types.Collection]:
@@ -143,111 +228,195 @@ def to_blender_mesh(bml_item: BmlItem) -> list[bpy.types.Collection]:
     return collections
 
 
-def read(path: str) -> list[bpy.types.Collection]:
-    bml = parse_bml(path)
+def to_blender_images(bml_item: BmlItem) -> list[bpy.types.Image]:
+    "Textures are named after the texture list of the file if it has one"
+    names = []
+    if bml_item.texture_list is not None:
+        names = read_texture_names(bml_item.texture_list, 0)
+    return xvm.to_blender_images(xvm.read_from(bml_item.texture_archive), names)
+
+
+def read(path: str, workers: int=None) -> list[bpy.types.Collection]:
+    bml = parse_bml(path, workers)
     collections = []
     for bml_item in bml:
         if len(bml_item.models) > 0:
             collections += to_blender_mesh(bml_item)
         else:
             warn("BML Warning: Skipping unsupported file '{}'.".format(bml_item.name))
+        if bml_item.texture_archive is not None:
+            try:
+                to_blender_images(bml_item)
+            except Exception as ex:
+                warn("BML Warning: Skipping textures of file '{}': {}".format(bml_item.name, ex))
     return collections
 
 
-def write(bml_path: str, xvm_path: str):
+def make_njcm(meshes: list[xj.MeshData]) -> bytearray:
+    "Writes all meshes into the same node tree of a NJCM chunk (+POF0)"
+    chunk_header_size = IffHeader.type_size()
+    njcm_chunk = IffChunk("NJCM", size_hint=sum(map(xj.estimate_mesh_data_size, meshes)))
+    prev_node_next_offset = None
+    for (i, mesh_data) in enumerate(meshes):
+        has_next = i < len(meshes) - 1
+
+        mesh_node = njcm.MeshTreeNode(
+            eval_flags=xj.NinjaEvalFlag.UNIT_ANG | xj.NinjaEvalFlag.UNIT_SCL | xj.NinjaEvalFlag.BREAK,
+            mesh=0xdeadbeef, # Will be rewritten at the end
+            scale_x=1.0,
+            scale_y=1.0,
+            scale_z=1.0,
+            next=0xdeadbeef if has_next else NULLPTR)
+        
+        node_ptr = njcm_chunk.write(mesh_node)
+        mesh_pointer_offset = node_ptr + chunk_header_size + 4
+        next_pointer_offset = node_ptr + chunk_header_size + 0x30
+
+        # Write mesh
+        mesh = xj.write_mesh_data(njcm_chunk, mesh_data)
+        mesh_ptr = njcm_chunk.write(mesh)
+
+        # Write mesh pointer into node
+        pack_into(njcm_chunk.buf.endianness_prefix + "L", njcm_chunk.buf.buffer, mesh_pointer_offset, mesh_ptr)
+        if prev_node_next_offset is not None:
+            # Link previous node to this one
+            pack_into(njcm_chunk.buf.endianness_prefix + "L", njcm_chunk.buf.buffer, prev_node_next_offset, node_ptr)
+        prev_node_next_offset = next_pointer_offset
+
+    # Chunk (+POF0) is done
+    return njcm_chunk.finish()
+
+
+@dataclass
+class CompressedFile:
+    "File inside a BML and its texture archive after PRS compression"
+    name: str
+    data: bytearray
+    decompressed_size: int
+    textures: bytearray = None
+    textures_decompressed_size: int = 0
+
+
+def compress_file(name: str, data: bytearray, textures: bytearray) -> CompressedFile:
+    compressed = CompressedFile(name=name, data=prs.compress(data), decompressed_size=len(data))
+    if textures is not None:
+        compressed.textures = prs.compress(textures)
+        compressed.textures_decompressed_size = len(textures)
+    return compressed
+
+
+def make_file(name: str, meshes: list[xj.MeshData], textures: bytearray) -> CompressedFile:
+    "Does everything that doesn't need Blender to export a file inside a BML"
+    return compress_file(name, make_njcm(meshes), textures)
+
+
+def write(bml_path: str, workers: int=None, texture_quality: int=None):
+    """Mesh data is taken out of Blender in this process.
+    Strips, chunks and compression of each file are made in a process pool with the given number of workers.
+    Texture quality overrides the quality set in materials if given."""
     objects_by_collection = []
-    all_objects = []
     for coll in bpy.data.collections:
         if not coll.hide_viewport:
             objs = BmlItem(name=coll.name)
             for obj in coll.all_objects:
                 if obj.type == "MESH" and not obj.hide_get():
                     objs.models.append(obj)
-                    all_objects.append(obj)
             if len(objs.models) > 0:
                 objects_by_collection.append(objs)
     
     if len(objects_by_collection) < 1:
         raise Exception("BML Error: No objects")
 
-    bml_buf = ResizableBuffer(0)
-    files_buf = ResizableBuffer(0)
-    texture_man = xvm.TextureManager(all_objects)
-
-    # Write BML header at the beginning of the file
-    bml_header = BmlHeader(
-        file_count=len(all_objects),
-        compression_type=CompressionType.NONE,
-        has_textures=0
-    )
-    bml_header.serialize_into(bml_buf)
-
-    chunk_header_size = IffHeader.type_size()
-    file_alignment = 0x20 if bml_header.has_textures else 0x800
+    (dirname, _) = os.path.split(bml_path)
+    files = []
 
     # Collection = file inside BML
     for collection in objects_by_collection:
-        chunks_size_sum = 0
-        njcm_chunk = IffChunk("NJCM")
-        prev_node_next_offset = None
-        # Add all objects in collection to same node tree
-        for (i, obj) in enumerate(collection.models):
-            has_next = i < len(collection.models) - 1
-
-            mesh_node = njcm.MeshTreeNode(
-                eval_flags=xj.NinjaEvalFlag.UNIT_ANG | xj.NinjaEvalFlag.UNIT_SCL | xj.NinjaEvalFlag.BREAK,
-                mesh=0xdeadbeef, # Will be rewritten at the end
-                scale_x=1.0,
-                scale_y=1.0,
-                scale_z=1.0,
-                next=0xdeadbeef if has_next else NULLPTR)
-            
-            node_ptr = njcm_chunk.write(mesh_node)
-            mesh_pointer_offset = node_ptr + chunk_header_size + 4
-            next_pointer_offset = node_ptr + chunk_header_size + 0x30
-
-            # Make and write mesh
+        # Every file has its own texture archive, so texture IDs start from zero in each file
+        texture_man = xvm.TextureManager(collection.models, texture_quality)
+        meshes = []
+        for obj in collection.models:
             blender_mesh = obj.to_mesh()
             util.scale_mesh(blender_mesh, util.get_pso_world_scale())
-            mesh = xj.make_mesh(njcm_chunk, obj, blender_mesh, texture_man)
-            mesh_ptr = njcm_chunk.write(mesh)
-
-            # Write mesh pointer into node
-            pack_into(Numeric.endianness_prefix + "L", njcm_chunk.buf.buffer, mesh_pointer_offset, mesh_ptr)
-            if prev_node_next_offset is not None:
-                # Link previous node to this one
-                pack_into(Numeric.endianness_prefix + "L", njcm_chunk.buf.buffer, prev_node_next_offset, node_ptr)
-            prev_node_next_offset = next_pointer_offset
+            meshes.append(xj.extract_mesh_data(obj, blender_mesh, texture_man))
             obj.to_mesh_clear()
 
-        # Chunk (+POF0) is done
-        files_sum_before = files_buf.offset
-        njcm_chunk_buf = njcm_chunk.finish()
-        files_buf.append(njcm_chunk_buf)
-        chunks_size_sum += len(njcm_chunk_buf)
-        compressed_size = chunks_size_sum
-
-        # Add padding between files
-        files_buf.grow_to(files_sum_before + util.align_up(compressed_size, file_alignment))
-        files_buf.seek_to_end()
-
-        # Write file descriptions after BML header
-        file_desc = FileDescription(
-            name=list(bytes(collection.name[0:28] + ".xj", "ascii")),
-            compressed_size=compressed_size,
-            decompressed_size=chunks_size_sum,
-            textures_compressed_size=0,
-            textures_decompressed_size=0)
-        file_desc.serialize_into(bml_buf)
-    
-    # Add padding after file descriptions
-    bml_buf.grow_to(util.align_up(bml_header.file_count * 0x40, 0x800))
-    files_buf.seek_to_end()
-    # Write files after descriptions
-    bml_buf.append(files_buf.buffer)
-    
-    with open(bml_path, "wb") as f:
-        f.write(bml_buf.buffer)
-
-    if xvm_path and texture_man.has_textures():
-        xvm.write(xvm_path, texture_man.get_all_textures())
+        textures = None
+        if texture_man.has_textures():
+            textures = xvm.load_cached_xvm(dirname, texture_man.get_all_textures())
+        files.append((collection.name[0:28] + ".xj", meshes, textures))
+
+    # Textures of all files are compressed by the same pool, which is only started if something isn't cached.
+    # Textures that are not cached are compressed largest first, no matter which file they are in.
+    pending_xvms = [textures for (_, _, textures) in files if textures is not None]
+    if any(len(pending_xvm.uncached) > 0 for pending_xvm in pending_xvms):
+        with dxt.Encoder() as encoder:
+            xvm.submit_uncached(pending_xvms, encoder)
+    files = [(name, meshes, textures and textures.result()) for (name, meshes, textures) in files]
+
+    write_stream(bml_path, util.imap_forked(make_file, files, workers), len(files), any(textures is not None for (_, _, textures) in files))
+
+
+def write_files(bml_path: str, files: list[tuple[str, bytearray, bytearray]], workers: int=None):
+    "Writes a BML from the name, uncompressed model and texture archive (or None) of each file"
+    write_stream(bml_path, util.imap_forked(compress_file, files, workers), len(files), any(textures is not None for (_, _, textures) in files))
+
+
+def write_stream(bml_path: str, files: Iterable[CompressedFile], file_count: int, has_textures: bool):
+    with util.replace_on_success(bml_path) as f:
+        writer = BmlWriter(f, file_count, has_textures)
+        for file in files:
+            writer.add(file)
+        writer.finish()
+
+
+class BmlWriter:
+    """Writes files into a stream as they are added, so only one file needs to be in memory at a time.
+    The header and file descriptions are written over the space reserved for them at the end."""
+    def __init__(self, stream, file_count: int, has_textures: bool):
+        self.stream = stream
+        self.start = stream.tell()
+        self.header = BmlHeader(
+            file_count=file_count,
+            compression_type=CompressionType.PRS,
+            has_textures=int(has_textures))
+        self.file_alignment = 0x20 if has_textures else 0x800
+        self.file_descriptions: list[FileDescription] = []
+        # Files come after the header and file descriptions
+        self.files_offset = util.align_up(file_count * 0x40, 0x800)
+        self.stream.write(bytes(self.files_offset))
+
+    def add(self, file: CompressedFile):
+        if len(self.file_descriptions) == self.header.file_count:
+            raise Exception("BML Error: Can't add more than {} files".format(self.header.file_count))
+        if file.textures is not None and not self.header.has_textures:
+            raise Exception("BML Error: File '{}' has textures, but the BML was made without them".format(file.name))
+        self._write_aligned(file.data)
+        # Texture archive comes right after the file it belongs to
+        if file.textures is not None:
+            self._write_aligned(file.textures)
+        self.file_descriptions.append(FileDescription(
+            name=list(bytes(file.name, "ascii")),
+            compressed_size=len(file.data),
+            decompressed_size=file.decompressed_size,
+            textures_compressed_size=len(file.textures) if file.textures is not None else 0,
+            textures_decompressed_size=file.textures_decompressed_size))
+
+    def finish(self):
+        if len(self.file_descriptions) != self.header.file_count:
+            raise Exception("BML Error: Expected {} files but got {}".format(self.header.file_count, len(self.file_descriptions)))
+        buf = ResizableBuffer(0)
+        self.header.serialize_into(buf)
+        Serializable.serialize_sequence(self.file_descriptions, buf)
+        if buf.length > self.files_offset:
+            raise Exception("BML Error: File descriptions don't fit before the files ({}/{})".format(buf.length, self.files_offset))
+        end = self.stream.tell()
+        self.stream.seek(self.start)
+        self.stream.write(buf.trim())
+        self.stream.seek(end)
+
+    def _write_aligned(self, data: bytearray):
+        self.stream.write(data)
+        padding = util.align_up(len(data), self.file_alignment) - len(data)
+        if padding > 0:
+            self.stream.write(bytes(padding))
@@ -1,8 +1,7 @@
-import os
 from bpy_extras.io_utils import ExportHelper
 from bpy.types import Operator
-from bpy.props import StringProperty
-from . import bml
+from bpy.props import StringProperty, EnumProperty
+from . import bml, util
 
 
 class ExportBml(Operator, ExportHelper):
@@ -18,12 +17,17 @@ class ExportBml(Operator, ExportHelper):
         maxlen=255,  # Max internal buffer length, longer would be clamped.
     )
 
+    texture_quality: EnumProperty(
+        name="Texture quality",
+        items=util.TEXTURE_QUALITY_ITEMS,
+        default="MATERIAL"
+    )
+
     filepath: StringProperty(subtype="FILE_PATH")
 
     def execute(self, context):
-        noext, ext = os.path.splitext(self.filepath)
-        bml.write(self.filepath, noext + ".xvm")
+        bml.write(self.filepath, texture_quality=util.texture_quality_override(self.texture_quality))
         return {"FINISHED"}
     
     def draw(self, context):
-        pass
+        self.layout.prop(self, "texture_quality")
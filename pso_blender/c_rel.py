@@ -1,4 +1,5 @@
 import math, os
+import numpy as np
 from mathutils import Vector
 from dataclasses import dataclass, field
 import bpy.types 
@@ -95,7 +96,13 @@ class Crel(Serializable):
 
 
 def write(path: str, objects: list[bpy.types.Object]):
-    rel = Rel()
+    with util.replace_on_success(path) as f:
+        rel = Rel(stream=f)
+        rel.finish(write_rel(rel, objects))
+
+
+def write_rel(rel: Rel, objects: list[bpy.types.Object]) -> int:
+    """Writes collision geometry. Returns pointer to the payload."""
     nodes = []
     for obj in objects:
         blender_mesh = obj.to_mesh()
@@ -170,9 +177,7 @@ def write(path: str, objects: list[bpy.types.Object]):
         ptr = rel.write(node)
         if first_node_ptr is None:
             first_node_ptr = ptr
-    file_contents = rel.finish(rel.write(Crel(nodes=first_node_ptr)))
-    with open(path, "wb") as f:
-        f.write(file_contents)
+    return rel.write(Crel(nodes=first_node_ptr))
 
 
 def flags_to_color(flags: int) -> tuple[float, float, float]:
@@ -182,25 +187,20 @@ def flags_to_color(flags: int) -> tuple[float, float, float]:
 
 
 def to_blender_mesh(rel: Rel, node: CrelNode, node_idx: int) -> bpy.types.Object:
-    blender_vertices = []
     blender_edges = []
-    blender_faces = []
     (mesh, _) = rel.read(Mesh, node.mesh)
     blender_mesh = bpy.data.meshes.new("mesh_" + str(node_idx))
-    faces = []
 
-    vertex_size = Vertex.type_size()
-    for i in range(mesh.vertex_count):
-        (vertex, _) = rel.read(Vertex, mesh.vertices + vertex_size * i)
-        coords = [vertex.x - node.x, vertex.z - node.z, vertex.y - node.y]
-        blender_vertices.append(coords)
+    # Read columns directly from the file instead of creating an object per element
+    vertices = Vertex.read_array(rel.buf.buffer, mesh.vertices, mesh.vertex_count)
+    blender_vertices = np.column_stack((
+        vertices["x"] - node.x,
+        vertices["z"] - node.z,
+        vertices["y"] - node.y)).tolist()
 
-    face_size = Face.type_size()
-    for i in range(mesh.face_count):
-        (face, _) = rel.read(Face, mesh.faces + face_size * i)
-        indices = [face.index0, face.index1, face.index2]
-        blender_faces.append(indices)
-        faces.append(face)
+    faces = Face.read_array(rel.buf.buffer, mesh.faces, mesh.face_count)
+    blender_faces = np.column_stack((faces["index0"], faces["index1"], faces["index2"])).tolist()
+    face_flags = faces["flags"].tolist()
 
     blender_mesh.from_pydata(blender_vertices, blender_edges, blender_faces)
     blender_mesh.update()
@@ -208,7 +208,7 @@ def to_blender_mesh(rel: Rel, node: CrelNode, node_idx: int) -> bpy.types.Object
     face_colors = blender_mesh.attributes.new("collision_type_color", "BYTE_COLOR", "CORNER")
     for (face_idx, poly) in enumerate(blender_mesh.polygons):
         for loop_idx in poly.loop_indices:
-            color = flags_to_color(faces[face_idx].flags)
+            color = flags_to_color(face_flags[face_idx])
             out = face_colors.data[loop_idx].color
             out[0] = color[0]
             out[1] = color[1]
@@ -1,4 +1,6 @@
-import functools, multiprocessing, struct
+import multiprocessing, os
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
 
 
 RGB = tuple[int, int, int]
@@ -116,25 +118,412 @@ def dxt1_compress_block(
 
 
 DXT_BLOCK_DIM = 4
-def compress_image(pixels: list[float], img_width: int, img_height: int, src_channels: int, with_alpha: bool) -> bytearray:
+DXT1_BLOCK_DTYPE = np.dtype([("color0", "<u2"), ("color1", "<u2"), ("indices", "<u4")])
+
+
+class Quality:
+    "How hard the encoder tries to find the best colors of each block"
+    # Colors from the bounding box of the block
+    FAST = 0
+    # Colors along the principal axis of the block, refined with least squares. A few times slower.
+    HIGH = 1
+
+
+def image_to_blocks(pixels, img_width: int, img_height: int, src_channels: int) -> np.ndarray:
+    "Returns pixels as an array of shape (block count, 16, channels) with blocks and their pixels in row order"
+    block_dim = DXT_BLOCK_DIM
+    image = np.asarray(pixels, dtype=np.float64).reshape(img_height // block_dim, block_dim, img_width // block_dim, block_dim, src_channels)
+    return image.transpose(0, 2, 1, 3, 4).reshape(-1, block_dim * block_dim, src_channels)
+
+
+def rgb8_to_rgb565_array(rgb: np.ndarray) -> np.ndarray:
+    return ((rgb[..., 0] & 0xf8) << 8) | ((rgb[..., 1] & 0xfc) << 3) | (rgb[..., 2] >> 3)
+
+
+def decompose_rgb565_array(rgb: np.ndarray) -> np.ndarray:
+    r = rgb >> 11
+    g = (rgb >> 5) & 0x3f
+    b = rgb & 0x1f
+    return np.stack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)), axis=-1)
+
+
+def dxt1_compress_blocks(blocks: np.ndarray, with_alpha: bool) -> np.ndarray:
+    """Same as dxt1_compress_block for every block at once. Returns an array of DXT1_BLOCK_DTYPE."""
+    # Work with the same truncated integers as the scalar version
+    rgb = (blocks[..., 0:3] * 0xff).astype(np.int32)
+    # Find RGB bounds of blocks
+    min_rgb = np.minimum(rgb.min(axis=1), 0xff)
+    max_rgb = np.maximum(rgb.max(axis=1), 0)
+    # Quantize
+    inset = (max_rgb - min_rgb) >> 4
+    color0_565 = rgb8_to_rgb565_array(np.where(min_rgb + inset < 0xff, min_rgb + inset, 0xff))
+    color1_565 = rgb8_to_rgb565_array(np.where(max_rgb >= inset, max_rgb - inset, 0))
+    if with_alpha:
+        # Swap colors to indicate alpha format
+        swap = color0_565 > color1_565
+    else:
+        # Colors might get swapped by quantization
+        swap = color0_565 <= color1_565
+    (color0_565, color1_565) = (np.where(swap, color1_565, color0_565), np.where(swap, color0_565, color1_565))
+    if color0_565.size > 0 and (min(color0_565.min(), color1_565.min()) < 0 or max(color0_565.max(), color1_565.max()) > 0xffff):
+        raise Exception("XVR error: Pixel values must be between 0 and 1")
+    # Compute palettes. Only the first three colors are matched, the fourth is for alpha.
+    palette0 = decompose_rgb565_array(color0_565)
+    palette1 = decompose_rgb565_array(color1_565)
+    palette2 = np.where(
+        (color0_565 <= color1_565)[:, np.newaxis],
+        (palette0 + palette1) // 2,
+        ((palette0 << 1) + palette1) // 3)
+    palette = np.stack((palette0, palette1, palette2), axis=1)
+    # Compute pixel palette indices of blocks. argmin picks the first of equally close colors like the scalar loop.
+    deltas = rgb[:, :, np.newaxis, :] - palette[:, np.newaxis, :, :]
+    palette_indices = (deltas * deltas).sum(axis=3).argmin(axis=2)
+    if with_alpha:
+        palette_indices = np.where(blocks[..., 3] < 1.0, 3, palette_indices)
+    return pack_blocks(color0_565, color1_565, palette_indices)
+
+
+def pack_blocks(color0_565: np.ndarray, color1_565: np.ndarray, palette_indices: np.ndarray) -> np.ndarray:
+    "Returns an array of DXT1_BLOCK_DTYPE from the colors of blocks and the palette indices of their pixels"
+    shifts = np.arange(DXT_BLOCK_DIM * DXT_BLOCK_DIM, dtype=np.uint32) * 2
+    result = np.empty(len(color0_565), dtype=DXT1_BLOCK_DTYPE)
+    result["color0"] = color0_565
+    result["color1"] = color1_565
+    result["indices"] = np.bitwise_or.reduce(palette_indices.astype(np.uint32) << shifts, axis=1)
+    return result
+
+
+def dxt1_block_palettes(color0_565: np.ndarray, color1_565: np.ndarray) -> np.ndarray:
+    """Returns the RGB palettes of blocks as an array of shape (block count, 4, 3), computed the same way as dxt_make_color_palette.
+    The fourth color of blocks in the three color format is black."""
+    palette0 = decompose_rgb565_array(color0_565.astype(np.int32))
+    palette1 = decompose_rgb565_array(color1_565.astype(np.int32))
+    three_colors = (color0_565 <= color1_565)[:, np.newaxis]
+    palette2 = np.where(three_colors, (palette0 + palette1) // 2, ((palette0 << 1) + palette1) // 3)
+    palette3 = np.where(three_colors, 0, ((palette1 << 1) + palette0) // 3)
+    return np.stack((palette0, palette1, palette2, palette3), axis=1)
+
+
+def round_to_rgb565_array(rgb: np.ndarray) -> np.ndarray:
+    "Rounds 8-bit colors to the nearest 5:6:5 color instead of truncating them"
+    rgb = np.clip(rgb, 0, 0xff)
+    r = np.rint(rgb[..., 0] * (0x1f / 0xff)).astype(np.int32)
+    g = np.rint(rgb[..., 1] * (0x3f / 0xff)).astype(np.int32)
+    b = np.rint(rgb[..., 2] * (0x1f / 0xff)).astype(np.int32)
+    return (r << 11) | (g << 5) | b
+
+
+def nearest_palette_colors(rgb: np.ndarray, palettes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    "Returns the indices of the closest palette colors of pixels in blocks, and their squared distances"
+    palettes = palettes.astype(rgb.dtype)
+    # Squared distance without the squared length of the pixel, which is the same for all palette colors
+    distances = (palettes * palettes).sum(axis=2)[:, np.newaxis, :] - 2 * np.matmul(rgb, palettes.transpose(0, 2, 1))
+    indices = distances.argmin(axis=2)
+    nearest = np.take_along_axis(distances, indices[..., np.newaxis], axis=2)[..., 0]
+    return (indices, nearest + (rgb * rgb).sum(axis=2))
+
+
+# Least squares passes of the high quality encoder. More passes rarely improve a block after the second one.
+REFINE_ITERATIONS = 2
+
+
+def dxt1_compress_blocks_high(blocks: np.ndarray, with_alpha: bool) -> np.ndarray:
+    """Same as dxt1_compress_blocks, but colors are fitted along the principal axis of the pixels of each block.
+    Then the colors are refined by solving the least squares problem of the chosen palette indices.
+    The result of each block is the one with the smallest error, including the result of dxt1_compress_blocks,
+    so blocks never look worse than with Quality.FAST."""
+    rgb = blocks[..., 0:3] * 0xff
+    if rgb.size > 0 and (rgb.min() < 0 or rgb.max() > 0xff):
+        raise Exception("XVR error: Pixel values must be between 0 and 1")
+    # Transparent pixels don't affect the colors
+    if with_alpha:
+        opaque = blocks[..., 3] >= 1.0
+    else:
+        opaque = np.ones(blocks.shape[0:2], dtype=bool)
+    weights = opaque.astype(np.float64)
+    # Three colors and transparency in blocks with alpha, four colors otherwise
+    color_count = 3 if with_alpha else 4
+    # Weights of the first and second color in each palette color
+    palette_weights = np.array([[1, 0], [0, 1], [0.5, 0.5], [0, 0]] if with_alpha else [[1, 0], [0, 1], [2 / 3, 1 / 3], [1 / 3, 2 / 3]])
+
+    def block_errors(color0_565: np.ndarray, color1_565: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        palettes = dxt1_block_palettes(color0_565, color1_565)
+        if not with_alpha:
+            # Black is transparent in three color palettes, so the first color is repeated in its place
+            palettes[:, 3] = np.where((color0_565 <= color1_565)[:, np.newaxis], palettes[:, 0], palettes[:, 3])
+        (indices, distances) = nearest_palette_colors(rgb, palettes[:, 0:color_count])
+        return (indices, (distances * weights).sum(axis=1))
+
+    # Start from the fast result
+    fast = dxt1_compress_blocks(blocks, with_alpha)
+    best_color0 = fast["color0"].astype(np.int32)
+    best_color1 = fast["color1"].astype(np.int32)
+    (best_indices, best_errors) = block_errors(best_color0, best_color1)
+
+    # Principal axis of the opaque pixels
+    opaque_count = np.maximum(weights.sum(axis=1), 1)[:, np.newaxis]
+    mean = (rgb * weights[..., np.newaxis]).sum(axis=1) / opaque_count
+    centered = (rgb - mean[:, np.newaxis, :]) * weights[..., np.newaxis]
+    covariance = np.einsum("npi,npj->nij", centered, centered)
+    axis = np.linalg.eigh(covariance)[1][..., -1]
+    projections = (centered * axis[:, np.newaxis, :]).sum(axis=2)
+    endpoint0 = mean + axis * np.where(opaque, projections, np.inf).min(axis=1, initial=np.inf)[:, np.newaxis]
+    endpoint1 = mean + axis * np.where(opaque, projections, -np.inf).max(axis=1, initial=-np.inf)[:, np.newaxis]
+    # Blocks without opaque pixels have no axis
+    endpoint0 = np.where(np.isfinite(endpoint0), endpoint0, 0)
+    endpoint1 = np.where(np.isfinite(endpoint1), endpoint1, 0)
+
+    for _ in range(REFINE_ITERATIONS + 1):
+        color0_565 = round_to_rgb565_array(endpoint0)
+        color1_565 = round_to_rgb565_array(endpoint1)
+        # The order of the colors selects the palette format
+        if with_alpha:
+            swap = color0_565 > color1_565
+        else:
+            swap = color0_565 < color1_565
+        (color0_565, color1_565) = (np.where(swap, color1_565, color0_565), np.where(swap, color0_565, color1_565))
+        (endpoint0, endpoint1) = (np.where(swap[:, np.newaxis], endpoint1, endpoint0), np.where(swap[:, np.newaxis], endpoint0, endpoint1))
+        (indices, errors) = block_errors(color0_565, color1_565)
+
+        better = errors < best_errors
+        best_color0 = np.where(better, color0_565, best_color0)
+        best_color1 = np.where(better, color1_565, best_color1)
+        best_indices = np.where(better[:, np.newaxis], indices, best_indices)
+        best_errors = np.where(better, errors, best_errors)
+
+        # Solve the colors that would best match the pixels with these indices
+        pixel_weights = palette_weights[indices] * weights[..., np.newaxis]
+        aa = (pixel_weights[..., 0] * pixel_weights[..., 0]).sum(axis=1)
+        ab = (pixel_weights[..., 0] * pixel_weights[..., 1]).sum(axis=1)
+        bb = (pixel_weights[..., 1] * pixel_weights[..., 1]).sum(axis=1)
+        a_rgb = (pixel_weights[..., 0:1] * rgb).sum(axis=1)
+        b_rgb = (pixel_weights[..., 1:2] * rgb).sum(axis=1)
+        determinant = aa * bb - ab * ab
+        solvable = (np.abs(determinant) > 1e-6)[:, np.newaxis]
+        determinant = np.where(solvable[:, 0], determinant, 1)[:, np.newaxis]
+        endpoint0 = np.where(solvable, (a_rgb * bb[:, np.newaxis] - b_rgb * ab[:, np.newaxis]) / determinant, endpoint0)
+        endpoint1 = np.where(solvable, (b_rgb * aa[:, np.newaxis] - a_rgb * ab[:, np.newaxis]) / determinant, endpoint1)
+
+    if with_alpha:
+        best_indices = np.where(opaque, best_indices, 3)
+    return pack_blocks(best_color0, best_color1, best_indices)
+
+
+def compress_blocks(blocks: np.ndarray, with_alpha: bool, quality: int=Quality.FAST) -> np.ndarray:
+    if quality == Quality.HIGH:
+        return dxt1_compress_blocks_high(blocks, with_alpha)
+    return dxt1_compress_blocks(blocks, with_alpha)
+
+
+def dxt1_decompress_blocks(blocks: np.ndarray) -> np.ndarray:
+    """Decodes an array of DXT1_BLOCK_DTYPE into RGBA pixels as an array of shape (block count, 16, 4) of floats between 0 and 1.
+    The fourth color of blocks in the three color format is transparent black."""
+    palettes = np.empty((len(blocks), 4, 4), dtype=np.float32)
+    palettes[..., 0:3] = dxt1_block_palettes(blocks["color0"], blocks["color1"]) * np.float32(1 / 0xff)
+    palettes[..., 3] = 1.0
+    palettes[:, 3, 3] = np.where(blocks["color0"] <= blocks["color1"], 0.0, 1.0)
+    shifts = np.arange(DXT_BLOCK_DIM * DXT_BLOCK_DIM, dtype=np.uint32) * 2
+    palette_indices = (blocks["indices"][:, np.newaxis] >> shifts) & 3
+    # Index into all palettes at once
+    palette_indices += np.arange(len(blocks), dtype=np.uint32)[:, np.newaxis] * 4
+    return palettes.reshape(-1, 4)[palette_indices]
+
+
+def blocks_to_image(blocks: np.ndarray, img_width: int, img_height: int) -> np.ndarray:
+    "Inverse of image_to_blocks. Returns pixels as an array of shape (height, width, channels)."
+    block_dim = DXT_BLOCK_DIM
+    channels = blocks.shape[-1]
+    image = blocks.reshape(img_height // block_dim, img_width // block_dim, block_dim, block_dim, channels)
+    return image.transpose(0, 2, 1, 3, 4).reshape(img_height, img_width, channels)
+
+
+def decompress_image(data: bytes, img_width: int, img_height: int) -> np.ndarray:
+    """Decodes a DXT1 image into RGBA pixels as a flat float32 array, in the same order as the pixels given to compress_image.
+    Data may be longer than the image, like when mip levels come after it."""
+    if img_width % DXT_BLOCK_DIM != 0 or img_height % DXT_BLOCK_DIM != 0:
+        raise Exception("XVR error: Image dimensions must be multiples of {}".format(DXT_BLOCK_DIM))
+    block_count = (img_width // DXT_BLOCK_DIM) * (img_height // DXT_BLOCK_DIM)
+    if len(data) < block_count * DXT1_BLOCK_DTYPE.itemsize:
+        raise Exception("XVR error: Image data is too short for a {}x{} image".format(img_width, img_height))
+    blocks = np.frombuffer(data, dtype=DXT1_BLOCK_DTYPE, count=block_count)
+    return blocks_to_image(dxt1_decompress_blocks(blocks), img_width, img_height).ravel()
+
+
+def check_image(pixels: list[float], img_width: int, img_height: int, src_channels: int, with_alpha: bool) -> np.ndarray:
+    "Returns pixels as a NumPy array after checking that the image can be compressed"
     if src_channels < 3 or (with_alpha and src_channels < 4):
         raise Exception("XVR error: Image must have either 3 or 4 channels")
     if img_width % DXT_BLOCK_DIM != 0 or img_height % DXT_BLOCK_DIM != 0:
         raise Exception("XVR error: Image dimensions must be multiples of {}".format(DXT_BLOCK_DIM))
-    dst_block_size = 2 + 2 + 4
-    dst_buf = bytearray(img_width * img_height // (DXT_BLOCK_DIM * DXT_BLOCK_DIM) * dst_block_size)
-    # Create work
-    block_coords = []
-    for y in range(0, img_height, DXT_BLOCK_DIM):
-        for x in range(0, img_width, DXT_BLOCK_DIM):
-            block_coords.append((x, y))
-    # Start workers
-    worker_fn = functools.partial(dxt1_compress_block, pixels, img_width, DXT_BLOCK_DIM, src_channels, with_alpha)
-    with multiprocessing.Pool() as pool:
-        results = pool.map(worker_fn, block_coords)
-    # Write results into buffer
-    for (block_idx, result) in enumerate(results):
-        dst_offset = block_idx * dst_block_size
-        (color0, color1, color_indices) = result
-        struct.pack_into("<HHL", dst_buf, dst_offset, color0, color1, color_indices)
-    return dst_buf
+    pixels = np.asarray(pixels)
+    # float32 pixels from Blender are converted exactly, other values need the precision of float64
+    if pixels.dtype != np.float32:
+        pixels = pixels.astype(np.float64)
+    return pixels
+
+
+def compress_pixels(pixels: np.ndarray, img_width: int, img_height: int, src_channels: int, with_alpha: bool, quality: int=Quality.FAST) -> bytes:
+    return compress_blocks(image_to_blocks(pixels, img_width, img_height, src_channels), with_alpha, quality).tobytes()
+
+
+def compress_band(shm_name: str, shape: tuple[int, int], dtype: str, img_width: int, src_channels: int, with_alpha: bool, quality: int, first_row: int, end_row: int) -> bytes:
+    "Compresses rows of blocks from an image in shared memory"
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        band = image[first_row * DXT_BLOCK_DIM:end_row * DXT_BLOCK_DIM]
+        # Blocks are a copy, views of the shared memory must be gone before closing it
+        blocks = image_to_blocks(band, img_width, (end_row - first_row) * DXT_BLOCK_DIM, src_channels)
+        del image, band
+        return compress_blocks(blocks, with_alpha, quality).tobytes()
+    finally:
+        shm.close()
+
+
+# Images with fewer blocks than this are compressed in this process, because starting workers would take longer
+MIN_PARALLEL_BLOCKS = 0x4000
+
+
+def share_pixels(pixels: np.ndarray, shape: tuple[int, int]) -> shared_memory.SharedMemory:
+    "Copies pixels into new shared memory for compress_band. The caller closes and unlinks it."
+    shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    try:
+        shared_pixels = np.ndarray(shape, dtype=pixels.dtype, buffer=shm.buf)
+        shared_pixels[:] = pixels.reshape(shape)
+        del shared_pixels
+    except BaseException:
+        release_shared(shm)
+        raise
+    return shm
+
+
+def release_shared(shm: shared_memory.SharedMemory):
+    shm.close()
+    shm.unlink()
+
+
+def compress_image(pixels: list[float], img_width: int, img_height: int, src_channels: int, with_alpha: bool, workers: int=None, quality: int=Quality.FAST) -> bytearray:
+    """Pixels can be a list or a NumPy array of floats. Blocks are compressed all at once with NumPy.
+    Big images are split into bands of block rows for a pool of workers (default is one per CPU),
+    which read the pixels from shared memory."""
+    pixels = check_image(pixels, img_width, img_height, src_channels, with_alpha)
+    block_rows = img_height // DXT_BLOCK_DIM
+    block_count = block_rows * (img_width // DXT_BLOCK_DIM)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, block_rows)
+    if workers <= 1 or block_count < MIN_PARALLEL_BLOCKS:
+        return bytearray(compress_pixels(pixels, img_width, img_height, src_channels, with_alpha, quality))
+
+    shape = (img_height, img_width * src_channels)
+    shm = share_pixels(pixels, shape)
+    try:
+        # A few bands per worker evens out the load
+        band_count = min(workers * 4, block_rows)
+        row_splits = [block_rows * i // band_count for i in range(band_count + 1)]
+        tasks = [
+            (shm.name, shape, pixels.dtype.str, img_width, src_channels, with_alpha, quality, first_row, end_row)
+            for (first_row, end_row) in zip(row_splits, row_splits[1:])]
+        with multiprocessing.Pool(workers) as pool:
+            bands = pool.starmap(compress_band, tasks)
+    finally:
+        release_shared(shm)
+    return bytearray(b"".join(bands))
+
+
+class PendingImage:
+    "Image whose bands are being compressed by an Encoder from shared memory"
+    def __init__(self, bands: list, shm: shared_memory.SharedMemory=None):
+        self._bands = bands
+        self._shm = shm
+        self._result = None
+
+    def result(self) -> bytearray:
+        "Can be called more than once, like when the same texture is in several XVMs"
+        if self._result is not None:
+            return self._result
+        try:
+            # Every band must be done with the shared memory before it's released
+            for band in self._bands:
+                if not isinstance(band, bytes):
+                    band.wait()
+            self._result = bytearray(b"".join(band if isinstance(band, bytes) else band.get() for band in self._bands))
+            return self._result
+        finally:
+            self.release()
+
+    def release(self):
+        if self._shm is not None:
+            release_shared(self._shm)
+            self._shm = None
+
+
+class Encoder:
+    """Process pool that stays alive for compressing many images, like all textures and mip levels of an export.
+    Images are split into bands of block rows so that a single big image is compressed in parallel too.
+    Workers read the bands from shared memory like in compress_image, which is released when the result is taken.
+    With a single worker images are compressed in this process when they are submitted.
+    Use it in a with statement so that the workers are stopped and shared memory released even if the export fails."""
+    # Bands have about this many blocks
+    BAND_BLOCKS = 0x1000
+
+    def __init__(self, workers: int=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._pool = None
+        if workers > 1:
+            # Workers must share the tracker of this process, otherwise each one would start its own
+            # that complains about shared memory it sees at exit, which this process has already unlinked
+            resource_tracker.ensure_running()
+            self._pool = multiprocessing.Pool(workers)
+        self._pending: list[PendingImage] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't wait for work that nobody will use
+            self.terminate()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._release_all()
+
+    def terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._release_all()
+
+    def submit(self, pixels: list[float], img_width: int, img_height: int, src_channels: int, with_alpha: bool, quality: int=Quality.FAST) -> PendingImage:
+        "Starts compressing an image and returns right away. Takes the same arguments as compress_image."
+        pixels = check_image(pixels, img_width, img_height, src_channels, with_alpha)
+        if self._pool is None:
+            return PendingImage([compress_pixels(pixels, img_width, img_height, src_channels, with_alpha, quality)])
+        shape = (img_height, img_width * src_channels)
+        shm = share_pixels(pixels, shape)
+        block_rows = img_height // DXT_BLOCK_DIM
+        band_rows = max(1, Encoder.BAND_BLOCKS // max(1, img_width // DXT_BLOCK_DIM))
+        bands = []
+        try:
+            for first_row in range(0, block_rows, band_rows):
+                end_row = min(first_row + band_rows, block_rows)
+                bands.append(self._pool.apply_async(
+                    compress_band, (shm.name, shape, pixels.dtype.str, img_width, src_channels, with_alpha, quality, first_row, end_row)))
+        except BaseException:
+            release_shared(shm)
+            raise
+        image = PendingImage(bands, shm)
+        self._pending.append(image)
+        return image
+
+    def _release_all(self):
+        "Releases shared memory of images whose result was never taken"
+        for image in self._pending:
+            image.release()
+        self._pending = []
@@ -1,3 +1,5 @@
+import io
+from typing import Iterator
 from warnings import warn
 from struct import pack_into, unpack_from
 from dataclasses import dataclass, field
@@ -25,8 +27,10 @@ class IffHeader(Serializable):
 class IffChunk(util.AbstractFileArchive):
     ALIGNMENT = 4
 
-    def __init__(self, type_name: str):
-        self.buf = ResizableBuffer(0)
+    def __init__(self, type_name: str, size_hint=0, endianness_prefix: str=None):
+        self.buf = ResizableBuffer(0, endianness_prefix=endianness_prefix)
+        # Writers can estimate their output size to avoid reallocating while writing
+        self.buf.reserve(size_hint)
         self.pointer_offsets: list[int] = []
         self.warned_misalignment = False
         header = IffHeader(
@@ -37,15 +41,17 @@ class IffChunk(util.AbstractFileArchive):
     def write(self, item: Serializable, ensure_aligned=False) -> int:
         header_size = IffHeader.type_size()
         # Subtract header to make pointers relative to body
-        item_offset = item.serialize_into(self.buf, IffChunk.ALIGNMENT if ensure_aligned else None) - header_size
+        # Pointer offsets are collected in the same pass that writes the item
+        pointers = []
+        item_offset = item.serialize_into(self.buf, IffChunk.ALIGNMENT if ensure_aligned else None, pointers) - header_size
         if not self.warned_misalignment and self.buf.offset % IffChunk.ALIGNMENT != 0:
             self.warned_misalignment = True
             warn("BML warning: Potential misalignment after writing \"{}\"".format(type(item).__name__))
         # Remember where pointers are written
-        for member_offset in item.nonnull_pointer_member_offsets():
-            ptr_offset = item_offset + member_offset
+        for abs_offset in pointers:
+            ptr_offset = abs_offset - header_size
             if ptr_offset % IffChunk.ALIGNMENT != 0:
-                raise Exception("BML error: Misaligned pointer in \"{}\" ({} + {})".format(type(item).__name__, item_offset, member_offset))
+                raise Exception("BML error: Misaligned pointer in \"{}\" ({} + {})".format(type(item).__name__, item_offset, ptr_offset - item_offset))
             self.pointer_offsets.append(ptr_offset)
         return item_offset
     
@@ -56,7 +62,7 @@ class IffChunk(util.AbstractFileArchive):
         size_offset = 4
         header_size = IffHeader.type_size()
         # Write size of body into header
-        pack_into(Numeric.endianness_prefix + "L", self.buf.buffer, size_offset, self.buf.offset - header_size)
+        pack_into(self.buf.endianness_prefix + "L", self.buf.buffer, size_offset, self.buf.offset - header_size)
         # Write pointer table header
         pof0_offset = self.buf.offset
         pof0_header = IffHeader(
@@ -82,19 +88,51 @@ class IffChunk(util.AbstractFileArchive):
             else:
                 raise Exception("BML error: Gap between pointers is too big ({})".format(abs_offset - prev_pointer_offset))
         # Write POF0 body size
-        pack_into(Numeric.endianness_prefix + "L", self.buf.buffer, pof0_offset + size_offset, self.buf.offset - pof0_offset - header_size)
-        return self.buf.buffer
+        pack_into(self.buf.endianness_prefix + "L", self.buf.buffer, pof0_offset + size_offset, self.buf.offset - pof0_offset - header_size)
+        return self.buf.trim()
 
 
-def parse_pof0(filename: str, file_data: bytearray, prev_chunk_offset: int, prev_chunk_size: int, pof0_offset: int, pof0_size: int) -> list[int]:
+def read_chunks(stream, skip_types: tuple[str]=(), endianness_prefix: str=None) -> Iterator[tuple[str, int, bytearray]]:
+    """Reads chunks one at a time from a file-like object and yields the type, offset and body of each.
+    Bodies of chunks in skip_types are seeked past and yielded as None."""
+    header_size = IffHeader.type_size()
+    chunk_offset = 0
+    while True:
+        header_buf = stream.read(header_size)
+        if len(header_buf) < header_size:
+            break
+        (chunk_header, _) = IffHeader.deserialize_from(header_buf, endianness_prefix=endianness_prefix)
+        chunk_type = util.bytes_to_string(chunk_header.type_name)
+        if chunk_type in skip_types:
+            stream.seek(chunk_header.body_size, io.SEEK_CUR)
+            chunk_body = None
+        else:
+            chunk_body = stream.read(chunk_header.body_size)
+        yield (chunk_type, chunk_offset, chunk_body)
+        chunk_offset += header_size + chunk_header.body_size
+
+
+def parse_pof0(filename: str, file_data: bytearray, prev_chunk_offset: int, prev_chunk_size: int, pof0_offset: int, pof0_size: int, endianness_prefix: str=None) -> list[int]:
     "POF0 chunk contains a pointer rewrite table for the preceding chunk"
     header_size = IffHeader.type_size()
+    view = memoryview(file_data)
+    return read_pof0(
+        view[pof0_offset + header_size:pof0_offset + header_size + pof0_size],
+        view[prev_chunk_offset + header_size:prev_chunk_offset + header_size + prev_chunk_size],
+        prev_chunk_offset,
+        endianness_prefix)
+
+
+def read_pof0(pof0_body: bytearray, prev_chunk_body: bytearray, prev_chunk_offset: int, endianness_prefix: str=None) -> list[int]:
+    "Same as parse_pof0, but takes the chunk bodies instead of the whole file"
+    header_size = IffHeader.type_size()
+    pointer_format = Numeric.format_of_type(U32, endianness_prefix)
     pointer_table = []
-    read_cursor = pof0_offset + header_size
-    pointer_offset = prev_chunk_offset + header_size
-    
-    while read_cursor < pof0_offset + header_size + pof0_size:
-        pof_byte = file_data[read_cursor]
+    read_cursor = 0
+    pointer_offset = 0
+
+    while read_cursor < len(pof0_body):
+        pof_byte = pof0_body[read_cursor]
         pof_flags = pof_byte & (0x40 | 0x80)
         if pof_flags == 0:
             # Not a valid flag, but not necessarily malformed
@@ -102,22 +140,22 @@ def parse_pof0(filename: str, file_data: bytearray, prev_chunk_offset: int, prev
             continue
         elif pof_flags == 0x40:
             # One byte offset
-            relative_offset = file_data[read_cursor] & 0x3f
+            relative_offset = pof0_body[read_cursor] & 0x3f
             read_cursor += 1
         elif pof_flags == 0x80:
             # Two byte offset
-            relative_offset = (file_data[read_cursor] & 0x3f) << 0x8 | file_data[read_cursor + 1]
+            relative_offset = (pof0_body[read_cursor] & 0x3f) << 0x8 | pof0_body[read_cursor + 1]
             read_cursor += 2
         elif pof_flags == (0x40 | 0x80):
             # Four byte offset
             relative_offset = (
-                (file_data[read_cursor] & 0x3f) << 0x18 |
-                file_data[read_cursor + 1] << 0x10 |
-                file_data[read_cursor + 2] << 0x8 |
-                file_data[read_cursor + 3])
+                (pof0_body[read_cursor] & 0x3f) << 0x18 |
+                pof0_body[read_cursor + 1] << 0x10 |
+                pof0_body[read_cursor + 2] << 0x8 |
+                pof0_body[read_cursor + 3])
             read_cursor += 4
         # Offsets are relative to the previous offset and divided by four (similar to REL)
         pointer_offset += relative_offset * 4
-        (pointer, ) = unpack_from(Numeric.endianness_prefix + "L", file_data, offset=pointer_offset)
-        pointer_table.append((pointer_offset, pointer))
+        (pointer, ) = unpack_from(pointer_format, prev_chunk_body, offset=pointer_offset)
+        pointer_table.append((prev_chunk_offset + header_size + pointer_offset, pointer))
     return pointer_table
@@ -1,13 +1,13 @@
-import math
+import math, os
 from mathutils import Vector
 from dataclasses import dataclass, field
 from warnings import warn
 import bpy.types
 from .rel import Rel
-from .serialization import Serializable, Numeric, AlignedString, FixedArray
+from .serialization import Serializable, Numeric, FixedArray
 from . import util, xvm, xj, tam
 from .njcm import MeshTreeNode
-from .njtl import TextureList, TextureListEntry
+from .njtl import TextureList, read_texture_names, write_texture_entries
 
 
 U8 = Numeric.U8
@@ -148,10 +148,21 @@ def assign_objects_to_chunks(objects: list[bpy.types.Object], chunk_markers: lis
     return chunk_to_children
 
 
-def write(nrel_path: str, xvm_path: str, tam_path: str, objects: list[bpy.types.Object], chunk_markers: list[bpy.types.Object]):
-    rel = Rel()
+def write(nrel_path: str, xvm_path: str, tam_path: str, objects: list[bpy.types.Object], chunk_markers: list[bpy.types.Object], texture_quality: int=None):
+    texture_man = xvm.TextureManager(objects, texture_quality)
+    with util.replace_on_success(nrel_path) as f:
+        rel = Rel(stream=f)
+        rel.finish(write_rel(rel, objects, chunk_markers, texture_man))
+    textures = texture_man.get_all_textures()
+    if xvm_path and len(textures) > 0:
+        xvm.write(xvm_path, textures)
+    if tam_path and texture_man.has_animated_textures():
+        tam.write(tam_path, texture_man, objects)
+
+
+def write_rel(rel: Rel, objects: list[bpy.types.Object], chunk_markers: list[bpy.types.Object], texture_man: xvm.TextureManager) -> int:
+    """Writes render geometry. Returns pointer to the payload."""
     nrel = NrelFmt2(magic=util.magic_bytes("fmt2"))
-    texture_man = xvm.TextureManager(objects)
     # Create chunks
     chunk_to_children = assign_objects_to_chunks(objects, chunk_markers)
     nrel.chunk_count = len(chunk_to_children)
@@ -214,24 +225,10 @@ def write(nrel_path: str, xvm_path: str, tam_path: str, objects: list[bpy.types.
     # Texture metadata
     textures = texture_man.get_all_textures()
     if len(textures) > 0:
-        first_texlist_entry_ptr = NULLPTR
         texlist = TextureList(count=len(textures))
-        for tex in textures:
-            tex_name = tex.image.name[0:10]
-            name_ptr = rel.write(AlignedString(tex_name, Rel.ALIGNMENT))
-            ptr = rel.write(TextureListEntry(name=name_ptr))
-            if first_texlist_entry_ptr == NULLPTR:
-                first_texlist_entry_ptr = ptr
-        texlist.elements = first_texlist_entry_ptr
+        texlist.elements = write_texture_entries(rel, [tex.image.name[0:10] for tex in textures], Rel.ALIGNMENT)
         nrel.texture_data = rel.write(texlist)
-    # Write files
-    file_contents = rel.finish(rel.write(nrel))
-    with open(nrel_path, "wb") as f:
-        f.write(file_contents)
-    if xvm_path and len(textures) > 0:
-        xvm.write(xvm_path, textures)
-    if tam_path and texture_man.has_animated_textures():
-        tam.write(tam_path, texture_man, objects)
+    return rel.write(nrel)
 
 
 def read(path: str) -> NrelFmt2:
@@ -261,9 +258,24 @@ def read(path: str) -> NrelFmt2:
             (root_node, _) = MeshTreeNode.read_tree(xj.Mesh, rel.buf.buffer, tree.root_node)
             tree.root_node = root_node
 
+    # Texture names
+    if nrel.texture_data == NULLPTR:
+        nrel.texture_data = []
+    else:
+        nrel.texture_data = read_texture_names(rel.buf.buffer, nrel.texture_data, rel.buf.endianness_prefix)
+
     return nrel
 
 
+def read_textures(nrel_path: str, nrel: NrelFmt2) -> list[bpy.types.Image]:
+    "Loads the textures from the XVM that is exported next to the n.rel, if there is one"
+    noext, _ = os.path.splitext(nrel_path)
+    xvm_path = noext[0:-1] + ".xvm"
+    if not os.path.isfile(xvm_path):
+        return []
+    return xvm.to_blender_images(xvm.read(xvm_path), nrel.texture_data)
+
+
 def to_blender(name: str, nrel: NrelFmt2) -> bpy.types.Collection:
     collection = bpy.data.collections.new(name)
     world_scale = util.get_pso_world_scale()
@@ -1,6 +1,6 @@
 import bpy, warnings
 from dataclasses import dataclass, field
-from .serialization import Serializable, Numeric
+from .serialization import Serializable, Numeric, PackedArray
 from .njcm import MeshTreeNode
 
 
@@ -38,7 +38,7 @@ class VertexListNode(Serializable):
 @dataclass
 class IndexArray(Serializable):
     length: U16 = 0
-    indices: list[U16] = field(default_factory=list)
+    indices: PackedArray(U16) = field(default_factory=list)
 
 
 @dataclass
@@ -59,8 +59,8 @@ class Mesh(Serializable):
     z: F32 = 0.0
 
     @classmethod
-    def deserialize_from(cls, buf, offset):
-        (mesh, after) = super(Mesh, cls).deserialize_from(buf, offset)
+    def deserialize_from(cls, buf, offset, endianness_prefix=None):
+        (mesh, after) = super(Mesh, cls).deserialize_from(buf, offset, endianness_prefix)
         vertex_list_offset = mesh.vertex_list - offset
         mesh.vertex_list = []
         while True:
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from .serialization import Serializable, Numeric
+from .serialization import Serializable, Numeric, AlignedString
+from .util import AbstractFileArchive
 
 
 U8 = Numeric.U8
@@ -24,3 +25,21 @@ class TextureListEntry(Serializable):
 class TextureList(Serializable):
     elements: Ptr32 = NULLPTR # TextureListEntry
     count: U32 = 0
+
+
+def read_texture_names(buf, texture_list_offset: int, endianness_prefix: str=None) -> list[str]:
+    "Pointers in the texture list must be offsets into buf"
+    (texture_list, _) = TextureList.deserialize_from(buf, texture_list_offset, endianness_prefix)
+    names = []
+    for entry in TextureListEntry.read_sequence(buf, texture_list.elements, texture_list.count, endianness_prefix):
+        end = buf.index(0, entry.name)
+        names.append(bytes(buf[entry.name:end]).decode())
+    return names
+
+
+def write_texture_entries(destination: AbstractFileArchive, names: list[str], alignment: int) -> int:
+    """Entries are an array that the texture list points to, so all names are written before them.
+    Returns pointer to the first entry."""
+    name_ptrs = [destination.write(AlignedString(name, alignment)) for name in names]
+    entry_ptrs = [destination.write(TextureListEntry(name=name_ptr)) for name_ptr in name_ptrs]
+    return entry_ptrs[0] if len(entry_ptrs) > 0 else NULLPTR
@@ -1,89 +1,397 @@
+import io
+import sys
+from array import array
+
+
+# Furthest distance a back-reference can reach
+WINDOW_SIZE = 0x2000
+
+
+# Kinds of commands in COMMAND_TABLE
+LITERALS = 0
+SHORT_COPY = 1
+LONG_COPY = 2
+
+
+# Bits of an unfinished command that can be left over from a control byte, with a marker bit above them:
+# none, 0, 00, 000 and 001 (read from the lowest bit up)
+LEFTOVER_BITS = (0b1, 0b10, 0b100, 0b1000, 0b1100)
+
+
+def decode_commands(leftover: int, control_byte: int) -> tuple[tuple, int]:
+    """Splits the bits left over from the previous control byte and the bits of the next one into whole commands.
+    Returns the commands and the index of what is left over in LEFTOVER_BITS times 0x100.
+    Each command is (LITERALS, count), (SHORT_COPY, size) or (LONG_COPY, 0), since the size of long copies is in the data."""
+    top = LEFTOVER_BITS[leftover].bit_length() - 1
+    cmds = LEFTOVER_BITS[leftover] ^ (1 << top) | (control_byte | 0x100) << top
+    commands = []
+    while cmds != 1:
+        if cmds & 1:
+            count = 0
+            while cmds != 1 and cmds & 1:
+                count += 1
+                cmds >>= 1
+            commands.append((LITERALS, count))
+        elif cmds < 0b100:
+            break
+        elif cmds & 0b10:
+            commands.append((LONG_COPY, 0))
+            cmds >>= 2
+        elif cmds < 0b10000:
+            break
+        else:
+            commands.append((SHORT_COPY, ((cmds >> 1) & 0b10 | (cmds >> 3) & 1) + 2))
+            cmds >>= 4
+    return (tuple(commands), LEFTOVER_BITS.index(cmds) << 8)
+
+
+# Commands for each leftover (times 0x100) plus control byte, so commands are decoded a whole control byte at a time
+COMMAND_TABLE = [decode_commands(leftover, control_byte) for leftover in range(len(LEFTOVER_BITS)) for control_byte in range(0x100)]
+
+
 class Decoder:
-    def __init__(self, compressed_buf: bytes):
-        self._cmds = 0
-        self._rem = 0
-        self._read_cursor = 0
+    """Decodes into a preallocated buffer if the decompressed size is known.
+    Control bytes are decoded with COMMAND_TABLE, and runs of literals and back-references are copied
+    with slices instead of one byte at a time. Decoding can be done in steps with decode_until."""
+    def __init__(self, compressed_buf: bytes, decompressed_size: int=None):
         self.compressed_buf = compressed_buf
-        self.decompressed_buf = bytearray()
-
-    def _read_bit(self) -> bool:
-        if self._rem == 0:
-            self._cmds = self.compressed_buf[self._read_cursor]
-            self._read_cursor += 1
-            self._rem = 8
-        ret = self._cmds & 1
-        self._cmds >>= 1
-        self._rem -= 1
-        return ret != 0
-    
-    def decompress(self):
-        while True:
-            if self._read_bit():
-                literal = self.compressed_buf[self._read_cursor]
-                self._read_cursor += 1
-                self.decompressed_buf.append(literal)
-                continue
-            if self._read_bit():
-                offset = self.compressed_buf[self._read_cursor] | (self.compressed_buf[self._read_cursor + 1] << 8)
-                self._read_cursor += 2
-                if offset == 0:
-                    break
-                size = offset & 0b111
-                offset >>= 3
-                if size == 0:
-                    size = self.compressed_buf[self._read_cursor] + 1
-                    self._read_cursor += 1
+        # Writing past the end with a slice grows the buffer, so it doesn't need to be big enough
+        self.decompressed_buf = bytearray(decompressed_size or 0)
+        # Number of bytes decoded into decompressed_buf
+        self.pos = 0
+        self.finished = False
+        self._cursor = 0
+        # Index of the bits left over from the previous control byte in LEFTOVER_BITS, times 0x100
+        self._leftover = 0
+
+    def decode_until(self, target: int):
+        "Decodes whole control bytes until at least target bytes are in decompressed_buf or the end is reached"
+        src = self.compressed_buf
+        out = self.decompressed_buf
+        table = COMMAND_TABLE
+        cursor = self._cursor
+        pos = self.pos
+        leftover = self._leftover
+        while pos < target and not self.finished:
+            (commands, leftover) = table[leftover | src[cursor]]
+            cursor += 1
+            for (kind, size) in commands:
+                if kind == LITERALS:
+                    out[pos:pos + size] = src[cursor:cursor + size]
+                    cursor += size
+                    pos += size
+                    continue
+                if kind == SHORT_COPY:
+                    offset = src[cursor] - 256
+                    cursor += 1
                 else:
-                    size += 2
-                offset |= -8192
-            else:
-                flag = 1 if self._read_bit() else 0
-                bit = 1 if self._read_bit() else 0
-                size = (bit | (flag << 1)) + 2
-                offset = self.compressed_buf[self._read_cursor]
-                self._read_cursor += 1
-                offset |= -256
-            for _ in range(size):
-                self.decompressed_buf.append(self.decompressed_buf[offset])
-
-
-def decompress(compressed_buf: bytearray) -> bytearray:
-    dec = Decoder(compressed_buf)
+                    offset = src[cursor] | (src[cursor + 1] << 8)
+                    cursor += 2
+                    if offset == 0:
+                        self.finished = True
+                        break
+                    size = offset & 0b111
+                    offset = (offset >> 3) - 8192
+                    if size == 0:
+                        size = src[cursor] + 1
+                        cursor += 1
+                    else:
+                        size += 2
+                start = pos + offset
+                if size <= -offset:
+                    out[pos:pos + size] = out[start:start + size]
+                else:
+                    # Overlapping copy repeats the bytes between start and pos
+                    pattern = out[start:pos]
+                    out[pos:pos + size] = (pattern * (size // len(pattern) + 1))[:size]
+                pos += size
+        self._cursor = cursor
+        self.pos = pos
+        self._leftover = leftover
+
+    def discard(self, count: int):
+        "Removes bytes from the start of decompressed_buf. The last WINDOW_SIZE bytes must be kept."
+        del self.decompressed_buf[:count]
+        self.pos -= count
+
+    def decompress(self):
+        self.decode_until(sys.maxsize)
+        del self.decompressed_buf[self.pos:]
+
+
+class Reader:
+    """Read-only file-like object that decompresses only as far as it has been read.
+    Everything except the window that back-references can reach is dropped after reading.
+    If the decompressed size is known, the decoder buffer is preallocated with it."""
+    # Bytes that were read are only dropped in batches of this size to avoid moving the window every read
+    DISCARD_THRESHOLD = 0x10000
+
+    def __init__(self, compressed_buf: bytes, decompressed_size: int=None):
+        self._decoder = Decoder(compressed_buf, decompressed_size)
+        # Read position in the decoder buffer, and how many bytes have been dropped from before it
+        self._read_pos = 0
+        self._discarded = 0
+
+    def tell(self) -> int:
+        return self._discarded + self._read_pos
+
+    def read(self, size: int=-1) -> bytearray:
+        end = sys.maxsize if size is None or size < 0 else self._read_pos + size
+        self._decoder.decode_until(end)
+        # The preallocated part of the buffer past pos hasn't been decoded yet
+        data = self._decoder.decompressed_buf[self._read_pos:min(end, self._decoder.pos)]
+        self._advance(len(data))
+        return data
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        "Only seeking forward is supported, since the bytes before the window are gone"
+        if whence == io.SEEK_SET:
+            offset -= self.tell()
+        elif whence != io.SEEK_CUR:
+            raise ValueError("PRS error: Unsupported seek mode {}".format(whence))
+        if offset < 0:
+            raise ValueError("PRS error: Can't seek backwards")
+        self._decoder.decode_until(self._read_pos + offset)
+        self._advance(min(offset, self._decoder.pos - self._read_pos))
+        return self.tell()
+
+    def _advance(self, count: int):
+        self._read_pos += count
+        discard = self._read_pos - WINDOW_SIZE
+        if discard >= Reader.DISCARD_THRESHOLD:
+            self._decoder.discard(discard)
+            self._read_pos -= discard
+            self._discarded += discard
+
+
+def decompress(compressed_buf: bytearray, decompressed_size: int=None) -> bytearray:
+    dec = Decoder(compressed_buf, decompressed_size)
     dec.decompress()
     return dec.decompressed_buf
 
 
 class Encoder:
-    def __init__(self, uncompressed_buf: bytearray):
+    """Greedy LZ77 compressor. Previous occurrences of each two byte sequence are kept in hash chains
+    so that finding matches doesn't require scanning the whole window."""
+    MAX_SHORT_OFFSET = 0x100
+    MAX_SHORT_LENGTH = 5
+    MAX_LONG_LENGTH = 9
+    MAX_LENGTH = 0x100
+
+    def __init__(self, uncompressed_buf: bytearray, max_chain=0x40):
         self._max_offset = 0x1fff
-        self._bit_position = 0
+        self._max_chain = max_chain
+        self._bit_position = 8
         self._byte_position = 0
         self._read_cursor = 0
-        self._uncompressed_buf = uncompressed_buf
+        self._uncompressed_buf = bytes(uncompressed_buf)
         self._uncompressed_len = len(uncompressed_buf)
         self._compressed_buf = bytearray()
+        # Most recent position of each two byte sequence, and previous position of the same sequence for each position
+        self._head = array("i", [-1]) * 0x10000
+        self._prev = array("i", [-1]) * self._uncompressed_len
+
+    def _put_bit(self, bit: int):
+        # Control byte is read by the decoder when it needs the next bit, so it's placed right where it's needed
+        if self._bit_position == 8:
+            self._byte_position = len(self._compressed_buf)
+            self._compressed_buf.append(0)
+            self._bit_position = 0
+        self._compressed_buf[self._byte_position] |= bit << self._bit_position
+        self._bit_position += 1
+
+    def _put_literal(self, literal: int):
+        self._put_bit(1)
+        self._compressed_buf.append(literal)
+
+    def _put_short_match(self, offset: int, length: int):
+        length -= 2
+        self._put_bit(0)
+        self._put_bit(0)
+        self._put_bit(length >> 1)
+        self._put_bit(length & 1)
+        self._compressed_buf.append(offset & 0xff)
+
+    def _put_long_match(self, offset: int, length: int):
+        self._put_bit(0)
+        self._put_bit(1)
+        if length <= Encoder.MAX_LONG_LENGTH:
+            word = ((offset << 3) & 0xfff8) | (length - 2)
+            self._compressed_buf += bytes((word & 0xff, word >> 8))
+        else:
+            word = (offset << 3) & 0xfff8
+            self._compressed_buf += bytes((word & 0xff, word >> 8, length - 1))
+
+    def _put_end(self):
+        self._put_bit(0)
+        self._put_bit(1)
+        self._compressed_buf += bytes(2)
+
+    def _insert(self, pos: int):
+        if pos + 1 < self._uncompressed_len:
+            key = self._uncompressed_buf[pos] | (self._uncompressed_buf[pos + 1] << 8)
+            self._prev[pos] = self._head[key]
+            self._head[key] = pos
+
+    def _match_length(self, pos: int, limit: int) -> int:
+        """Length of the common prefix of data at pos and at read cursor, at most limit"""
+        buf = self._uncompressed_buf
+        cursor = self._read_cursor
+        low = 2
+        high = limit
+        while low < high:
+            mid = (low + high + 1) >> 1
+            if buf[pos:pos + mid] == buf[cursor:cursor + mid]:
+                low = mid
+            else:
+                high = mid - 1
+        return low
 
-    def _lz77_longest_match(self):
-        max_len = 0x100
+    def _lz77_longest_match(self) -> tuple[int, int]:
+        """Returns (negative offset, length) of the longest match at read cursor, or length 0 if there is none"""
+        buf = self._uncompressed_buf
+        cursor = self._read_cursor
+        max_len = min(Encoder.MAX_LENGTH, self._uncompressed_len - cursor)
         best_offset = 0
         best_len = 0
-        cur_len = 0
-        min_pos = max(self._read_cursor - self._max_offset, 0)
-        if self._read_cursor + max_len + 4 >= self._uncompressed_len:
-            for i in range(self._read_cursor - 1, min_pos, -1):
-                if self._uncompressed_buf[i] == self._uncompressed_buf[self._read_cursor]:
-                    cur_len = 1
-                    while self._read_cursor + cur_len < self._uncompressed_len and self._uncompressed_buf[i + cur_len] == self._uncompressed_buf[self._read_cursor + cur_len]:
-                        cur_len += 1
-                    if cur_len > max_len:
-                        cur_len = max_len
-                        best_len = cur_len
-                        best_offset = i - self._read_cursor
-                        #goto(hell)
-                    elif cur_len > best_len:
-                        best_len = cur_len
-                        best_offset = i - self._read_cursor
-
-    def compress(self):
+        if max_len < 2:
+            return (best_offset, best_len)
+        min_pos = cursor - self._max_offset
+        pos = self._head[buf[cursor] | (buf[cursor + 1] << 8)]
+        chain = self._max_chain
+        while pos >= min_pos and pos >= 0 and chain > 0:
+            chain -= 1
+            # Candidates that can't be longer than the current best are skipped without comparing them fully
+            if best_len == 0 or buf[pos + best_len] == buf[cursor + best_len]:
+                cur_len = self._match_length(pos, max_len)
+                # Two byte matches are only worth it if they fit in a short match
+                if cur_len > best_len and (cur_len > 2 or cursor - pos <= Encoder.MAX_SHORT_OFFSET):
+                    best_len = cur_len
+                    best_offset = pos - cursor
+                    if best_len == max_len:
+                        break
+            pos = self._prev[pos]
+        return (best_offset, best_len)
+
+    def compress(self) -> bytearray:
         while self._read_cursor < self._uncompressed_len:
-            self._lz77_longest_match()
+            (offset, length) = self._lz77_longest_match()
+            if length == 0:
+                self._put_literal(self._uncompressed_buf[self._read_cursor])
+                length = 1
+            elif -offset <= Encoder.MAX_SHORT_OFFSET and length <= Encoder.MAX_SHORT_LENGTH:
+                self._put_short_match(offset, length)
+            else:
+                self._put_long_match(offset, length)
+            for pos in range(self._read_cursor, self._read_cursor + length):
+                self._insert(pos)
+            self._read_cursor += length
+        self._put_end()
+        return self._compressed_buf
+
+
+class OptimalEncoder(Encoder):
+    """Chooses the encoding with the fewest bits for the whole input instead of always taking the longest match.
+    All matches are found first, then the cheapest encoding of each suffix of the input is solved from the end."""
+    LITERAL_BITS = 9
+    SHORT_MATCH_BITS = 12
+    LONG_MATCH_BITS = 18
+    EXTENDED_MATCH_BITS = 26
+
+    def __init__(self, uncompressed_buf: bytearray, max_chain=0x40, nice_length=0x40):
+        super().__init__(uncompressed_buf, max_chain)
+        # Matches this long are good enough, longer ones cost the same and are rarely worth searching for
+        self._nice_length = nice_length
+
+    def _find_matches(self) -> tuple[int, int, int, int]:
+        """Returns (offset, length) of the longest short match and the longest match at read cursor"""
+        buf = self._uncompressed_buf
+        cursor = self._read_cursor
+        max_len = min(Encoder.MAX_LENGTH, self._uncompressed_len - cursor)
+        nice_len = min(self._nice_length, max_len)
+        short_offset = short_len = best_offset = best_len = 0
+        if max_len < 2:
+            return (short_offset, short_len, best_offset, best_len)
+        min_pos = cursor - self._max_offset
+        short_min_pos = cursor - Encoder.MAX_SHORT_OFFSET
+        pos = self._head[buf[cursor] | (buf[cursor + 1] << 8)]
+        chain = self._max_chain
+        while pos >= min_pos and pos >= 0 and chain > 0:
+            chain -= 1
+            is_short = pos >= short_min_pos and short_len < Encoder.MAX_SHORT_LENGTH
+            if is_short or buf[pos + best_len] == buf[cursor + best_len]:
+                cur_len = self._match_length(pos, max_len)
+                if is_short and cur_len > short_len:
+                    short_len = min(cur_len, Encoder.MAX_SHORT_LENGTH)
+                    short_offset = pos - cursor
+                if cur_len > best_len:
+                    best_len = cur_len
+                    best_offset = pos - cursor
+                    if best_len >= nice_len:
+                        break
+            pos = self._prev[pos]
+        return (short_offset, short_len, best_offset, best_len)
+
+    def compress(self) -> bytearray:
+        n = self._uncompressed_len
+        short_offsets = array("i", bytes(4 * n))
+        short_lens = array("H", bytes(2 * n))
+        long_offsets = array("i", bytes(4 * n))
+        long_lens = array("H", bytes(2 * n))
+        for cursor in range(n):
+            self._read_cursor = cursor
+            (short_offsets[cursor], short_lens[cursor], long_offsets[cursor], long_lens[cursor]) = self._find_matches()
+            self._insert(cursor)
+        # Bits needed to encode data starting at each position and length of the first command of that encoding
+        costs = array("q", bytes(8 * (n + 1)))
+        lengths = array("H", bytes(2 * (n + 1)))
+        for cursor in range(n - 1, -1, -1):
+            best_cost = OptimalEncoder.LITERAL_BITS + costs[cursor + 1]
+            best_len = 1
+            short_len = short_lens[cursor]
+            for length in range(2, short_len + 1):
+                cost = OptimalEncoder.SHORT_MATCH_BITS + costs[cursor + length]
+                if cost < best_cost:
+                    best_cost = cost
+                    best_len = length
+            long_len = long_lens[cursor]
+            for length in range(max(3, short_len + 1), min(long_len, Encoder.MAX_LONG_LENGTH) + 1):
+                cost = OptimalEncoder.LONG_MATCH_BITS + costs[cursor + length]
+                if cost < best_cost:
+                    best_cost = cost
+                    best_len = length
+            if long_len > Encoder.MAX_LONG_LENGTH:
+                # Every extended length costs the same so only the cheapest remainder matters
+                first = cursor + Encoder.MAX_LONG_LENGTH + 1
+                remainders = costs[first:cursor + long_len + 1]
+                cost = OptimalEncoder.EXTENDED_MATCH_BITS + min(remainders)
+                if cost < best_cost:
+                    best_cost = cost
+                    best_len = remainders.index(cost - OptimalEncoder.EXTENDED_MATCH_BITS) + first - cursor
+            costs[cursor] = best_cost
+            lengths[cursor] = best_len
+        cursor = 0
+        while cursor < n:
+            length = lengths[cursor]
+            if length == 1:
+                self._put_literal(self._uncompressed_buf[cursor])
+            elif length <= short_lens[cursor]:
+                self._put_short_match(short_offsets[cursor], length)
+            else:
+                self._put_long_match(long_offsets[cursor], length)
+            cursor += length
+        self._put_end()
+        return self._compressed_buf
+
+
+class Level:
+    # Greedy longest match
+    FAST = 0
+    # Fewest bits, much slower
+    OPTIMAL = 1
+
+
+def compress(uncompressed_buf: bytearray, level=Level.FAST) -> bytearray:
+    if level == Level.OPTIMAL:
+        return OptimalEncoder(uncompressed_buf).compress()
+    return Encoder(uncompressed_buf).compress()
@@ -53,7 +53,13 @@ class Minimap(Serializable):
 
 
 def write(path: str, room_objects: list[bpy.types.Object]):
-    rel = Rel()
+    with util.replace_on_success(path) as f:
+        rel = Rel(stream=f)
+        rel.finish(write_rel(rel, room_objects))
+
+
+def write_rel(rel: Rel, room_objects: list[bpy.types.Object]) -> int:
+    """Writes minimap geometry. Returns pointer to the payload."""
     minimap = Minimap()
     minimap.room_count = len(room_objects)
     rooms = []
@@ -111,9 +117,9 @@ def write(path: str, room_objects: list[bpy.types.Object]):
 
         # Due to variable amount of 16bit values we need to ensure alignment
         padding = None
-        if (rel.buf.offset + IndexListNode.type_size() + indices_size) % 4 != 0:
+        if (rel.offset + IndexListNode.type_size() + indices_size) % 4 != 0:
             index_node.offset_to_next += 1
-            padding = Numeric.endianness_prefix + "H"
+            padding = rel.buf.endianness_prefix + "H"
 
         index_node_ptr = rel.write(index_node)
 
@@ -140,7 +146,4 @@ def write(path: str, room_objects: list[bpy.types.Object]):
         if first_room_ptr is None:
             first_room_ptr = room_ptr
     minimap.rooms = first_room_ptr
-    minimap_ptr = rel.write(minimap)
-    file_contents = rel.finish(minimap_ptr)
-    with open(path, "wb") as f:
-        f.write(file_contents)
+    return rel.write(minimap)
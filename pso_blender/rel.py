@@ -1,77 +1,129 @@
-from struct import pack_into, unpack_from
+from array import array
+from itertools import chain, pairwise
+from struct import pack, pack_into, unpack_from
+from typing import BinaryIO
 from warnings import warn
 from .serialization import Serializable, ResizableBuffer, Numeric
 from .util import AbstractFileArchive
 
 
+NULLPTR = Numeric.NULLPTR
+
+
 class Rel(AbstractFileArchive):
+    """Relocatable file with a pointer table.
+    By default the file is built in memory. If a stream is given, records are written into it as they come
+    and only the record that is currently being written is kept in memory."""
     ALIGNMENT = 4
     POINTER_TABLE_POINTER_OFFSET = -0x20
     POINTER_COUNT_OFFSET = -0x1c
     PAYLOAD_POINTER_OFFSET = -0x10
+    TRAILER_SIZE = 0x20
 
-    def __init__(self, *args, buf=None):
+    def __init__(self, *args, buf=None, size_hint=0, endianness_prefix: str=None, stream: BinaryIO=None):
+        self.stream = stream
+        # Size of data that has been written into the stream
+        self.flushed = 0
         if buf is None:
-            self.buf = ResizableBuffer(0)
+            self.buf = ResizableBuffer(0, endianness_prefix=endianness_prefix)
+            # Writers can estimate their output size to avoid reallocating while writing
+            self.buf.reserve(size_hint)
             # Consume the 0th offset to ensure that no userdata can have pointers that point to 0
             # because we use 0 as nullptr even though technically it would be a valid offset
-            self.buf.pack(Numeric.endianness_prefix + "L", 0)
+            self.buf.pack(self.buf.endianness_prefix + "L", 0)
             self.payload_offset = None
         else:
             self.buf = buf
-        self.pointer_offsets: list[int] = []
+        self.pointer_offsets = array("I")
         self.warned_misalignment = False
 
+    @property
+    def offset(self) -> int:
+        """Absolute offset of where the next record will be written"""
+        return self.flushed + self.buf.offset
+
+    def flush(self):
+        """Moves buffered data into the stream"""
+        if self.stream is None:
+            return
+        self.stream.write(memoryview(self.buf.buffer)[:self.buf.length])
+        self.flushed += self.buf.length
+        self.buf.clear()
+
     def write(self, item: Serializable, ensure_aligned=False) -> int:
-        item_offset = item.serialize_into(self.buf, Rel.ALIGNMENT if ensure_aligned else None)
-        if not self.warned_misalignment and self.buf.offset % Rel.ALIGNMENT != 0:
+        self.flush()
+        # Pointer offsets are collected in the same pass that writes the item
+        pointers = []
+        item_offset = self.flushed + item.serialize_into(self.buf, Rel.ALIGNMENT if ensure_aligned else None, pointers, self.flushed)
+        if not self.warned_misalignment and self.offset % Rel.ALIGNMENT != 0:
             self.warned_misalignment = True
             warn("REL warning: Potential misalignment after writing \"{}\"".format(type(item).__name__))
         # Remember where pointers are written
-        for member_offset in item.nonnull_pointer_member_offsets():
-            ptr_offset = item_offset + member_offset
+        for (i, ptr_offset) in enumerate(pointers):
+            ptr_offset += self.flushed
             if ptr_offset % Rel.ALIGNMENT != 0:
-                raise Exception("REL error: Misaligned pointer in \"{}\" ({} + {})".format(type(item).__name__, item_offset, member_offset))
-            self.pointer_offsets.append(ptr_offset)
+                raise Exception("REL error: Misaligned pointer in \"{}\" ({} + {})".format(type(item).__name__, item_offset, ptr_offset - item_offset))
+            pointers[i] = ptr_offset
+        self.pointer_offsets.extend(pointers)
         return item_offset
 
-    def finish(self, payload_offset: int) -> bytearray:
-        # Create pointer table
-        self.pointer_offsets.sort()
-        pointer_count = len(self.pointer_offsets)
-        pointer_size = 2
-        pointer_table_size = pointer_count * pointer_size
-        self.buf.grow_by(pointer_table_size)
-        prev_pointer_offset = 0
-        pointer_table_offset = self.buf.offset
+    def patch_pointer(self, offset: int, pointer: int):
+        """Writes pointer over an already written null pointer.
+        Used when a record has to be written before the record that it points to."""
+        fmt = self.buf.endianness_prefix + "L"
+        if offset >= self.flushed:
+            pack_into(fmt, self.buf.buffer, offset - self.flushed, pointer)
+        else:
+            self.stream.seek(offset)
+            self.stream.write(pack(fmt, pointer))
+            self.stream.seek(self.flushed)
+        if pointer != NULLPTR:
+            self.pointer_offsets.append(offset)
+
+    def pointer_table(self) -> bytes:
+        offsets = self.pointer_offsets
+        # Offsets are in order unless pointers have been patched
+        if any(a > b for (a, b) in pairwise(offsets)):
+            offsets = array("I", sorted(offsets))
         # Pointer table contains locations of pointers within the payload
         # Offsets are from the previous pointer's location (the first one is absolute)
         # Offsets are divided by 4 (and thus pointers must be aligned to 4 bytes)
-        for abs_offset in self.pointer_offsets:
-            rel_offset = (abs_offset - prev_pointer_offset) // 4
-            prev_pointer_offset = abs_offset
-            self.buf.pack(Numeric.endianness_prefix + "H", rel_offset)
+        table = array("H", ((b - a) // 4 for (a, b) in pairwise(chain((0, ), offsets))))
+        if Numeric.needs_byteswap(self.buf.endianness_prefix):
+            table.byteswap()
+        return table.tobytes()
+
+    def finish(self, payload_offset: int) -> bytearray:
+        """Writes pointer table and trailer. Returns contents of the file, or None if it was written into a stream"""
+        pointer_table_offset = self.offset
+        self.buf.pack_bytes(self.pointer_table())
         # Create trailer
-        self.buf.grow_by(0x20)
-        pack_into(Numeric.endianness_prefix + "L", self.buf.buffer, Rel.POINTER_TABLE_POINTER_OFFSET, pointer_table_offset)
-        pack_into(Numeric.endianness_prefix + "L", self.buf.buffer, Rel.POINTER_COUNT_OFFSET, pointer_count)
-        pack_into(Numeric.endianness_prefix + "L", self.buf.buffer, Rel.PAYLOAD_POINTER_OFFSET, payload_offset)
+        trailer = bytearray(Rel.TRAILER_SIZE)
+        fmt = self.buf.endianness_prefix + "L"
+        pack_into(fmt, trailer, Rel.TRAILER_SIZE + Rel.POINTER_TABLE_POINTER_OFFSET, pointer_table_offset)
+        pack_into(fmt, trailer, Rel.TRAILER_SIZE + Rel.POINTER_COUNT_OFFSET, len(self.pointer_offsets))
+        pack_into(fmt, trailer, Rel.TRAILER_SIZE + Rel.PAYLOAD_POINTER_OFFSET, payload_offset)
+        self.buf.pack_bytes(trailer)
         self.payload_offset = payload_offset
-        return self.buf.buffer
+        if self.stream is not None:
+            self.flush()
+            return None
+        return self.buf.trim()
 
     @staticmethod
-    def read_from(data: bytearray) -> "Rel":
-        (pointer_count, ) = unpack_from(Numeric.endianness_prefix + "L", data, Rel.POINTER_COUNT_OFFSET)
-        (pointer_table_offset, ) = unpack_from(Numeric.endianness_prefix + "L", data, Rel.POINTER_TABLE_POINTER_OFFSET)
-        (payload_offset, ) = unpack_from(Numeric.endianness_prefix + "L", data, Rel.PAYLOAD_POINTER_OFFSET)
-        rel = Rel(buf=ResizableBuffer(buf=data))
+    def read_from(data: bytearray, endianness_prefix: str=None) -> "Rel":
+        rel = Rel(buf=ResizableBuffer(buf=data, endianness_prefix=endianness_prefix))
+        endianness_prefix = rel.buf.endianness_prefix
+        (pointer_count, ) = unpack_from(endianness_prefix + "L", data, Rel.POINTER_COUNT_OFFSET)
+        (pointer_table_offset, ) = unpack_from(endianness_prefix + "L", data, Rel.POINTER_TABLE_POINTER_OFFSET)
+        (payload_offset, ) = unpack_from(endianness_prefix + "L", data, Rel.PAYLOAD_POINTER_OFFSET)
         rel.payload_offset = payload_offset
 
         pointer_size = 2
         prev_pointer_offset = 0
         for i in range(pointer_count):
             table_entry_offset = pointer_table_offset + i * pointer_size
-            (rel_offset, ) = unpack_from(Numeric.endianness_prefix + "H", data, table_entry_offset)
+            (rel_offset, ) = unpack_from(endianness_prefix + "H", data, table_entry_offset)
             abs_offset = prev_pointer_offset + rel_offset * 4
             prev_pointer_offset = abs_offset
             rel.pointer_offsets.append(abs_offset)
@@ -79,7 +131,7 @@ class Rel(AbstractFileArchive):
         return rel
     
     def read(self, cls, offset=0):
-        return cls.deserialize_from(self.buf.buffer, offset)
+        return cls.deserialize_from(self.buf.buffer, offset, self.buf.endianness_prefix)
     
     def is_nonnull_pointer(self, offset: int) -> bool:
         return offset in self.pointer_offsets
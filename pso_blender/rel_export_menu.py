@@ -4,7 +4,7 @@ import bpy
 from bpy_extras.io_utils import ExportHelper
 from bpy.props import StringProperty, EnumProperty
 from bpy.types import Operator, Panel
-from . import r_rel, n_rel, c_rel
+from . import r_rel, n_rel, c_rel, util
 
 
 class ExportRel(Operator, ExportHelper):
@@ -43,6 +43,12 @@ class ExportRel(Operator, ExportHelper):
         default="EXPORT_AS_ALL"
     )
 
+    texture_quality: EnumProperty(
+        name="Texture quality",
+        items=util.TEXTURE_QUALITY_ITEMS,
+        default="MATERIAL"
+    )
+
     filepath: StringProperty(subtype="FILE_PATH")
 
     def cancel_with_error(self, ex: Exception):
@@ -62,7 +68,7 @@ class ExportRel(Operator, ExportHelper):
         noext, ext = os.path.splitext(self.filepath)
         format_info = {
             "EXPORT_AS_NREL": lambda: n_rel.write(self.filepath, None, objs),
-            "EXPORT_AS_NREL_XVM": lambda: n_rel.write(self.filepath, noext[0:-1] + ".xvm", objs, []),
+            "EXPORT_AS_NREL_XVM": lambda: n_rel.write(self.filepath, noext[0:-1] + ".xvm", objs, [], texture_quality=util.texture_quality_override(self.texture_quality)),
             "EXPORT_AS_CREL": lambda: c_rel.write(self.filepath, objs),
             "EXPORT_AS_RREL": lambda: r_rel.write(self.filepath, objs),
             "EXPORT_AS_ALL": lambda: self.export_all(objs, objs, objs)
@@ -78,7 +84,7 @@ class ExportRel(Operator, ExportHelper):
         if minimap_objs and len(minimap_objs) > 0:
             r_rel.write(noext + "r" + ext, minimap_objs)
         if render_objs and len(render_objs) > 0:
-            n_rel.write(noext + "n" + ext, noext + ".xvm", noext + ".tam", render_objs, chunk_markers)
+            n_rel.write(noext + "n" + ext, noext + ".xvm", noext + ".tam", render_objs, chunk_markers, util.texture_quality_override(self.texture_quality))
         if collision_objs and len(collision_objs):
             c_rel.write(noext + "c" + ext, collision_objs)
         return {"FINISHED"}
@@ -143,3 +149,4 @@ class CUSTOM_PT_export_settings(Panel):
         export_as_format_row.enabled = "EXPORT_SELECTED" in operator.export_strategy
         if not export_as_format_row.enabled:
             operator.export_as_format = "EXPORT_AS_ALL"
+        box.prop(operator, "texture_quality")
@@ -26,7 +26,13 @@ class ImportRel(Operator, ImportHelper):
         if suffix == "c":
             collection = c_rel.read(self.filepath)
         elif suffix == "n":
-            collection = n_rel.to_blender(filename, n_rel.read(self.filepath))
+            nrel = n_rel.read(self.filepath)
+            collection = n_rel.to_blender(filename, nrel)
+            try:
+                n_rel.read_textures(self.filepath, nrel)
+            except Exception as ex:
+                # Geometry is still usable without its textures
+                self.report({"WARNING"}, "Skipped textures: {}".format(ex))
         elif suffix == "r":
             self.report({"ERROR"}, "Unimplemented file type for import")
         else:
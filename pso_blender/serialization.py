@@ -1,7 +1,8 @@
 import sys
+from array import array
 from dataclasses import dataclass, field
 from typing import NewType, get_type_hints, get_args, get_origin, Annotated
-from struct import pack_into, unpack_from, error as StructError
+from struct import Struct, pack_into, unpack_from, error as StructError
 from warnings import warn
 from operator import itemgetter
 
@@ -14,6 +15,15 @@ def FixedArray(tp, length):
     return NewType("FixedArray", Annotated[tp, length])
 
 
+def PackedArray(tp):
+    """Variable length array of numbers whose value is an array.array (or bytes) instead of a list"""
+    return NewType("PackedArray", Annotated[array, tp])
+
+
+def is_packed_array_type(tp) -> bool:
+    return getattr(tp, "__name__", None) == "PackedArray"
+
+
 @dataclass
 class Numeric:
     """Contains numeric types"""
@@ -41,24 +51,50 @@ class Numeric:
         "f": 4,
     }
 
-    endianness_prefix = "<"
+    # structlib format: array.array typecode of the same size
+    array_typecodes = {
+        "B": "B",
+        "H": "H",
+        "L": "I",
+        "b": "b",
+        "h": "h",
+        "l": "i",
+        "f": "f",
+    }
+
+    # structlib format: NumPy type without byte order
+    numpy_types = {
+        "B": "u1",
+        "H": "u2",
+        "L": "u4",
+        "b": "i1",
+        "h": "i2",
+        "l": "i4",
+        "f": "f4",
+    }
 
-    @staticmethod
-    def use_little_endian():
-        Numeric.endianness_prefix = "<"
-    
-    @staticmethod
-    def use_big_endian():
-        Numeric.endianness_prefix = ">"
+    LITTLE_ENDIAN = "<"
+    BIG_ENDIAN = ">"
+    # Byte order of buffers that don't specify one. Byte order is chosen per buffer so this should not be changed
+    endianness_prefix = LITTLE_ENDIAN
 
     @staticmethod
-    def format_of_type(tp) -> str:
+    def format_of_type(tp, endianness_prefix: str=None) -> str:
         """Returns the structlib format of the given type"""
         entry = Numeric.type_info.get(tp.__name__)
         if not entry:
             return None
-        return Numeric.endianness_prefix + entry[1]
+        if endianness_prefix is None:
+            endianness_prefix = Numeric.endianness_prefix
+        return endianness_prefix + entry[1]
     
+    @staticmethod
+    def needs_byteswap(endianness_prefix: str=None) -> bool:
+        """Whether values in native byte order have to be swapped to get the given byte order"""
+        if endianness_prefix is None:
+            endianness_prefix = Numeric.endianness_prefix
+        return (endianness_prefix == Numeric.BIG_ENDIAN) != (sys.byteorder == "big")
+
     @staticmethod
     def size_of_format(fmt: str) -> int:
         size_sum = 0
@@ -76,44 +112,404 @@ generate_numeric_types()
 
 
 class ResizableBuffer:
-    def __init__(self, *args, size=0, buf=None):
+    """Byte buffer that grows geometrically as data is written into it.
+    length is the size of the written data and capacity is the size of the allocation.
+    The allocation may be bigger than the data, so use trim() to get the final data.
+    Serializables written into the buffer use its byte order."""
+    MIN_CAPACITY = 0x1000
+
+    def __init__(self, *args, size=0, buf=None, endianness_prefix: str=None):
         if buf is None:
             self.buffer = bytearray(size)
         else:
             self.buffer = buf
-        self.capacity = size
+        self.length = len(self.buffer)
         self.offset = 0
-    
+        # Bytes between length and this were written before clear()
+        self._stale_end = 0
+        self.endianness_prefix = endianness_prefix or Numeric.endianness_prefix
+
+    @property
+    def capacity(self) -> int:
+        return len(self.buffer)
+
+    def reserve(self, size: int):
+        """Makes sure that buffer can hold at least size bytes without reallocating"""
+        if size > len(self.buffer):
+            self.buffer += bytes(size - len(self.buffer))
+
+    def _set_length(self, length: int):
+        if length > len(self.buffer):
+            self.reserve(max(length, len(self.buffer) * 2, ResizableBuffer.MIN_CAPACITY))
+        self.length = length
+
+    def _zero_stale(self, end: int):
+        """Zeroes stale bytes up to end before they are claimed without being written, like a new allocation would be.
+        Bytes that are claimed by packing are overwritten anyway."""
+        stale_end = min(end, self._stale_end)
+        if stale_end > self.length:
+            self.buffer[self.length:stale_end] = bytes(stale_end - self.length)
+
+    def _claim(self, size: int) -> int:
+        """Grows buffer if needed and moves past size bytes. Returns absolute offset of the claimed bytes"""
+        offset_before = self.offset
+        end = offset_before + size
+        if end > self.length:
+            self._set_length(end)
+        self.offset = end
+        return offset_before
+
     def grow_by(self, by: int):
-        self.buffer += bytearray(by)
-        self.capacity += by
+        self._zero_stale(self.length + by)
+        self._set_length(self.length + by)
     
     def grow_to(self, to: int):
-        if self.capacity > to:
-            raise Exception("Failed to grow ResizableBuffer because it is already bigger than requested size ({}/{})".format(self.capacity, to))
-        self.grow_by(to - self.capacity)
+        if self.length > to:
+            raise Exception("Failed to grow ResizableBuffer because it is already bigger than requested size ({}/{})".format(self.length, to))
+        self.grow_by(to - self.length)
 
     def append(self, other: bytearray) -> int:
         offset_before = self.offset
-        self.buffer += other
-        self.capacity += len(other)
+        start = self.length
+        self._set_length(start + len(other))
+        self.buffer[start:self.length] = other
         return offset_before
     
+    def clear(self):
+        """Forgets written data but keeps the allocation.
+        Bytes past length are stale and are zeroed only if they are skipped or grown into."""
+        self._stale_end = max(self._stale_end, self.length)
+        self.length = 0
+        self.offset = 0
+
     def seek_to_end(self):
-        self.offset = self.capacity
+        self.offset = self.length
+
+    def trim(self) -> bytearray:
+        """Frees unused capacity. Returns the underlying buffer which then contains only the written data."""
+        if len(self.buffer) > self.length:
+            del self.buffer[self.length:]
+        return self.buffer
 
     def pack(self, fmt: str, *vals) -> int:
         """Returns absolute offset of where data was written"""
-        offset_before = self.offset
-        item_size = Numeric.size_of_format(fmt)
-        remaining = self.capacity - self.offset
-        # Grow if needed
-        if item_size > remaining:
-            need = item_size - remaining
-            self.grow_by(need)
-        pack_into(fmt, self.buffer, self.offset, *vals)
-        self.offset += item_size
-        return offset_before
+        offset = self._claim(Numeric.size_of_format(fmt))
+        pack_into(fmt, self.buffer, offset, *vals)
+        return offset
+
+    def pack_struct(self, st: Struct, *vals) -> int:
+        """Like pack but with a precompiled struct. Returns absolute offset of where data was written"""
+        offset = self._claim(st.size)
+        st.pack_into(self.buffer, offset, *vals)
+        return offset
+
+    def pack_array(self, fmt: str, vals) -> int:
+        """Packs a sequence of values that all have the same format.
+        Returns absolute offset of where data was written"""
+        count = len(vals)
+        offset = self._claim(Numeric.size_of_format(fmt) * count)
+        pack_into(fmt[0] + str(count) + fmt[1:], self.buffer, offset, *vals)
+        return offset
+
+    def skip(self, size: int) -> int:
+        """Grows buffer if needed and moves past size bytes so that they can be written directly into self.buffer.
+        Returns absolute offset of the skipped bytes"""
+        self._zero_stale(self.offset + size)
+        return self._claim(size)
+
+    def pack_bytes(self, data) -> int:
+        """Unlike append this writes at the current offset. Returns absolute offset of where data was written"""
+        offset = self._claim(len(data))
+        self.buffer[offset:self.offset] = data
+        return offset
+
+
+def is_variable_length_type(tp) -> bool:
+    """Lists, tuples, packed arrays and buffers don't have a size that is known from the type alone"""
+    return (get_origin(tp) is list or get_origin(tp) is tuple or tp is list or tp is tuple or tp is bytes or tp is bytearray
+            or is_packed_array_type(tp))
+
+
+def is_serializable_type(tp) -> bool:
+    return isinstance(tp, type) and issubclass(tp, Serializable)
+
+
+def fit_fixed_array(value, length: int, owner: str, name: str) -> list:
+    """Truncates or zero pads value to the length of a FixedArray member"""
+    if len(value) > length:
+        warn("FixedArray member '{}' of class '{}' was truncated during serialization".format(name, owner))
+        return value[:length]
+    if len(value) < length:
+        return list(value) + [0] * (length - len(value))
+    return value
+
+
+def read_packed_array(elem_type, buf, offset: int, count: int, endianness_prefix: str=None) -> array:
+    """Reads count consecutive numbers of given type into an array.array"""
+    typecode = Numeric.array_typecodes[Numeric.format_of_type(elem_type, "")]
+    result = array(typecode)
+    result.frombytes(memoryview(buf)[offset:offset + count * result.itemsize])
+    if Numeric.needs_byteswap(endianness_prefix):
+        result.byteswap()
+    return result
+
+
+class Layout:
+    """Serialization layout of a Serializable class, compiled once per class and byte order.
+
+    Consecutive members with a size known from the type alone are packed with a single precompiled struct.
+    The serializer, deserializer and size functions are generated as Python source specifically for the class
+    (like dataclasses generates __init__) so that no type hints need to be looked up when they are called.
+    The serializer also collects the offsets of non-null pointers while writing."""
+
+    def __init__(self, cls, endianness_prefix: str):
+        self.cls = cls
+        self.endianness_prefix = endianness_prefix
+        # (name, offset) of pointers that are within the static part
+        self.pointer_members: list[tuple[str, int]] = []
+        # (name, structlib format without byte order, fixed array length or None for scalars)
+        self.static_members: list[tuple[str, str, int]] = []
+        self.has_variable_members = False
+        self.struct: Struct = None
+        self._dtype = None
+        self.size = 0
+        self._ns = {
+            "cls": cls,
+            "array": array,
+            "fit_fixed_array": fit_fixed_array,
+            "Serializable": Serializable}
+        self._serialize_src = ["def serialize(self, buf, pointers):"]
+        self._deserialize_src = [
+            "def deserialize(buf, offset):",
+            "    result = cls()",
+            "    members = result.__dict__"]
+        self._size_src = ["def instance_size(self):", "    size = 0"]
+        # Members of current struct run: (name, fixed array length or None for scalars)
+        self._run: list[tuple[str, int]] = []
+        self._run_fmt = ""
+        self._run_args = ""
+        self._run_size = 0
+        # (name, offset) of pointers in current struct run
+        self._run_pointers: list[tuple[str, int]] = []
+        self._struct_count = 0
+        has_nested_members = False
+        for (name, tp) in get_type_hints(cls).items():
+            if name.startswith("_"):
+                continue
+            if is_variable_length_type(tp):
+                self._flush_run()
+                self._add_variable_member(name, tp)
+                self.has_variable_members = True
+            elif is_serializable_type(tp):
+                self._flush_run()
+                self._add_nested_member(name, tp)
+                has_nested_members = True
+            else:
+                self._add_static_member(name, tp)
+        self._flush_run()
+        self.is_fixed_size = not self.has_variable_members and not has_nested_members
+        self.serialize = self._create_fn("serialize", self._serialize_src + ["    pass"])
+        if not self.is_fixed_size:
+            self.pointer_members = []
+        self.deserialize = self._create_fn("deserialize", self._deserialize_src + ["    return (result, offset)"])
+        if self.is_fixed_size:
+            self.struct = self._ns.get("_s0", Struct(endianness_prefix))
+            self.instance_size = lambda _: self.size
+            self.pack_sequence = self._create_pack_sequence()
+        else:
+            self.instance_size = self._create_fn("instance_size", self._size_src + ["    return size"])
+        del self._ns, self._serialize_src, self._deserialize_src, self._size_src, self._run, self._run_fmt, self._run_args, self._run_size, self._run_pointers, self._struct_count
+
+    def _create_pack_sequence(self):
+        """Creates a function that packs many instances of the class into a buffer without visiting each member"""
+        lines = [
+            "def pack_sequence(items, buffer, offset):",
+            "    pack_into = _s0.pack_into",
+            "    for (offset, self) in zip(range(offset, offset + len(items) * {0}, {0}), items):".format(self.size)]
+        lines.append("        pack_into(buffer, offset, {})".format(self._run_args))
+        return self._create_fn("pack_sequence", lines)
+
+    def dtype(self):
+        """NumPy structured dtype equivalent to the struct of a fixed size layout"""
+        import numpy as np
+        if not self.is_fixed_size:
+            raise TypeError("Class \"{}\" has no NumPy dtype because its size is not fixed".format(self.cls.__name__))
+        if self._dtype is None:
+            fields = []
+            for (name, fmt, length) in self.static_members:
+                np_type = self.endianness_prefix + Numeric.numpy_types[fmt]
+                fields.append((name, np_type) if length is None else (name, np_type, (length, )))
+            self._dtype = np.dtype(fields)
+        return self._dtype
+
+    def _create_fn(self, name: str, lines: list[str]):
+        exec("\n".join(lines), self._ns)
+        return self._ns[name]
+
+    def _add_static_member(self, name: str, tp):
+        if getattr(tp, "__name__", None) == "FixedArray":
+            (elem_type, length) = get_args(tp.__supertype__)
+        else:
+            (elem_type, length) = (tp, None)
+        elem_fmt = Numeric.format_of_type(elem_type, "")
+        if elem_fmt is None:
+            raise TypeError("Can't compile layout of \"{}\" because member \"{}\" is not serializable".format(self.cls.__name__, name))
+        elem_size = Numeric.size_of_format(elem_fmt)
+        if elem_type is Numeric.Ptr32:
+            if length is not None:
+                raise TypeError("Can't compile layout of \"{}\" because member \"{}\" is an array of pointers".format(self.cls.__name__, name))
+            self.pointer_members.append((name, self.size))
+            self._run_pointers.append((name, self._run_size))
+        self._run.append((name, length))
+        self.static_members.append((name, elem_fmt, length))
+        if length is None:
+            self._run_fmt += elem_fmt
+            self._run_size += elem_size
+            self.size += elem_size
+        else:
+            self._run_fmt += str(length) + elem_fmt
+            self._run_size += elem_size * length
+            self.size += elem_size * length
+
+    def _add_struct(self, st: Struct) -> str:
+        st_name = "_s{}".format(self._struct_count)
+        self._ns[st_name] = st
+        self._struct_count += 1
+        return st_name
+
+    def _flush_run(self):
+        """Emits code for the current run of static members"""
+        if len(self._run) < 1:
+            return
+        st = Struct(self.endianness_prefix + self._run_fmt)
+        st_name = self._add_struct(st)
+        args = []
+        for (name, length) in self._run:
+            if length is None:
+                args.append("self.{}".format(name))
+            else:
+                args.append("*fit_fixed_array(self.{}, {}, cls.__name__, \"{}\")".format(name, length, name))
+        self._run_args = ", ".join(args)
+        if len(self._run_pointers) < 1:
+            self._serialize_src.append("    buf.pack_struct({}, {})".format(st_name, self._run_args))
+        else:
+            self._serialize_src.append("    offset = buf.pack_struct({}, {})".format(st_name, self._run_args))
+            self._serialize_src.append("    if pointers is not None:")
+            for (name, run_offset) in self._run_pointers:
+                self._serialize_src.append("        if self.{} != {}:".format(name, Numeric.NULLPTR))
+                self._serialize_src.append("            pointers.append(offset + {})".format(run_offset))
+        if all(length is None for (_, length) in self._run):
+            targets = "".join("members[\"{}\"], ".format(name) for (name, _) in self._run)
+            self._deserialize_src.append("    ({}) = {}.unpack_from(buf, offset)".format(targets, st_name))
+        else:
+            self._deserialize_src.append("    values = {}.unpack_from(buf, offset)".format(st_name))
+            i = 0
+            for (name, length) in self._run:
+                if length is None:
+                    self._deserialize_src.append("    members[\"{}\"] = values[{}]".format(name, i))
+                    i += 1
+                else:
+                    self._deserialize_src.append("    members[\"{}\"] = list(values[{}:{}])".format(name, i, i + length))
+                    i += length
+        self._deserialize_src.append("    offset += {}".format(st.size))
+        self._size_src.append("    size += {}".format(st.size))
+        self._run = []
+        self._run_fmt = ""
+        self._run_size = 0
+        self._run_pointers = []
+
+    def _add_nested_member(self, name: str, tp):
+        # Pointers after this member don't have a fixed offset
+        self.pointer_members = []
+        tp_name = "_t{}".format(len(self._ns))
+        self._ns[tp_name] = tp
+        self.size += tp.type_size()
+        self._serialize_src.append("    self.{}._serialize_members(buf, pointers)".format(name))
+        self._deserialize_src.append("    (members[\"{}\"], offset) = {}.deserialize_from(buf, offset, \"{}\")".format(
+            name, tp_name, self.endianness_prefix))
+        self._size_src.append("    size += self.{}.instance_size()".format(name))
+
+    def _add_variable_member(self, name: str, tp):
+        """Variable length members are not deserialized"""
+        # Pointers after this member don't have a fixed offset
+        self.pointer_members = []
+        ser = self._serialize_src
+        size = self._size_src
+        if tp is bytes or tp is bytearray:
+            ser.append("    buf.pack_bytes(self.{})".format(name))
+            size.append("    size += len(self.{})".format(name))
+            return
+        elem_types = get_args(tp) if not is_packed_array_type(tp) else get_args(tp.__supertype__)
+        if len(elem_types) < 1:
+            raise TypeError("Can't compile layout of \"{}\" because element type of member \"{}\" is unknown".format(self.cls.__name__, name))
+        # Buffers may be used in place of lists of bytes
+        ser.append("    value = self.{}".format(name))
+        ser.append("    if type(value) is bytes or type(value) is bytearray:")
+        ser.append("        buf.pack_bytes(value)")
+        size.append("    value = self.{}".format(name))
+        size.append("    if type(value) is bytes or type(value) is bytearray:")
+        size.append("        size += len(value)")
+        if is_packed_array_type(tp):
+            self._add_packed_array_member(name, tp)
+            return
+        if get_origin(tp) is tuple:
+            fmts = [Numeric.format_of_type(elem_type, "") for elem_type in elem_types if elem_type is not Ellipsis]
+            if None in fmts or len(fmts) < len(elem_types) or Numeric.Ptr32 in elem_types:
+                raise TypeError("Can't compile layout of \"{}\" because member \"{}\" is not a tuple of numbers".format(self.cls.__name__, name))
+            st = Struct(self.endianness_prefix + "".join(fmts))
+            st_name = self._add_struct(st)
+            ser.append("    else:")
+            ser.append("        buf.pack_struct({}, *value)".format(st_name))
+            size.append("    else:")
+            size.append("        size += {}".format(st.size))
+            return
+        elem_type = elem_types[0]
+        elem_fmt = Numeric.format_of_type(elem_type, self.endianness_prefix) if not is_serializable_type(elem_type) else None
+        if elem_fmt is not None and elem_type is Numeric.Ptr32:
+            ser.append("    else:")
+            ser.append("        offset = buf.pack_array(\"{}\", value)".format(elem_fmt))
+            ser.append("        if pointers is not None:")
+            ser.append("            pointers += [offset + i * {} for (i, ptr) in enumerate(value) if ptr != {}]".format(
+                Numeric.size_of_format(elem_fmt), Numeric.NULLPTR))
+            size.append("    else:")
+            size.append("        size += len(value) * {}".format(Numeric.size_of_format(elem_fmt)))
+        elif elem_fmt is not None:
+            ser.append("    else:")
+            ser.append("        buf.pack_array(\"{}\", value)".format(elem_fmt))
+            size.append("    else:")
+            size.append("        size += len(value) * {}".format(Numeric.size_of_format(elem_fmt)))
+        elif is_serializable_type(elem_type):
+            # Elements are serialized according to their own type
+            ser.append("    else:")
+            ser.append("        Serializable.serialize_sequence(value, buf, pointers)")
+            size.append("    else:")
+            size.append("        for elem in value:")
+            size.append("            size += elem.instance_size()")
+        else:
+            raise TypeError("Can't compile layout of \"{}\" because elements of member \"{}\" are not serializable".format(self.cls.__name__, name))
+
+    def _add_packed_array_member(self, name: str, tp):
+        """Packed arrays are written as one block of bytes"""
+        (_, elem_type) = get_args(tp.__supertype__)
+        elem_fmt = Numeric.format_of_type(elem_type, "")
+        if elem_fmt is None or elem_type is Numeric.Ptr32:
+            raise TypeError("Can't compile layout of \"{}\" because member \"{}\" is not an array of numbers".format(self.cls.__name__, name))
+        typecode = Numeric.array_typecodes[elem_fmt]
+        ser = self._serialize_src
+        ser.append("    else:")
+        # Lists and arrays of the wrong type are converted in one go
+        ser.append("        if type(value) is not array or value.typecode != \"{}\":".format(typecode))
+        ser.append("            value = array(\"{}\", value)".format(typecode))
+        if Numeric.needs_byteswap(self.endianness_prefix):
+            ser.append("        else:")
+            ser.append("            value = array(\"{}\", value)".format(typecode))
+            ser.append("        value.byteswap()")
+        ser.append("        buf.pack_bytes(memoryview(value).cast(\"B\"))")
+        self._size_src.append("    else:")
+        self._size_src.append("        size += len(value) * {}".format(Numeric.size_of_format(elem_fmt)))
+
+
+_layout_cache: dict[tuple[type, str], Layout] = {}
 
 
 class Serializable:
@@ -121,8 +517,56 @@ class Serializable:
         pass
 
     @classmethod
-    def format_of_member(cls, member: str) -> str:
-        fmt = Numeric.format_of_type(typehint_of_name(member, cls))
+    def layout(cls, endianness_prefix: str=None) -> Layout:
+        """Returns compiled layout of this class for the given byte order or None if it can't be compiled"""
+        key = (cls, endianness_prefix or Numeric.endianness_prefix)
+        try:
+            return _layout_cache[key]
+        except KeyError:
+            pass
+        try:
+            layout = Layout(*key)
+        except TypeError:
+            # Not a simple record, has to use _visit
+            layout = None
+        _layout_cache[key] = layout
+        return layout
+
+    def _serialize_members(self, buf: ResizableBuffer, pointers: list[int]=None):
+        layout = self.layout(buf.endianness_prefix)
+        if layout is None:
+            offset = buf.offset
+            ctx = {"first_offset": None, "buf": buf, "endianness_prefix": buf.endianness_prefix}
+            self._visit(self, ctx, Serializable._serializer_visitor)
+            if pointers is not None:
+                pointers += [offset + member_offset for member_offset in self.nonnull_pointer_member_offsets()]
+        else:
+            layout.serialize(self, buf, pointers)
+
+    @staticmethod
+    def serialize_sequence(items: list["Serializable"], buf: ResizableBuffer, pointers: list[int]=None):
+        """Writes items back to back.
+        Items that all have the same fixed size type are packed in bulk instead of one at a time."""
+        if len(items) < 1:
+            return
+        tp = type(items[0])
+        layout = tp.layout(buf.endianness_prefix)
+        if layout is not None and layout.is_fixed_size and layout.size > 0 and all(type(item) is tp for item in items):
+            offset = buf.skip(layout.size * len(items))
+            layout.pack_sequence(items, buf.buffer, offset)
+            if pointers is not None and len(layout.pointer_members) > 0:
+                for item in items:
+                    for (name, member_offset) in layout.pointer_members:
+                        if getattr(item, name) != Numeric.NULLPTR:
+                            pointers.append(offset + member_offset)
+                    offset += layout.size
+        else:
+            for item in items:
+                item._serialize_members(buf, pointers)
+
+    @classmethod
+    def format_of_member(cls, member: str, endianness_prefix: str=None) -> str:
+        fmt = Numeric.format_of_type(typehint_of_name(member, cls), endianness_prefix)
         if fmt:
             return fmt
         return None
@@ -137,6 +581,14 @@ class Serializable:
         return True
 
     def nonnull_pointer_member_offsets(self) -> list[int]:
+        layout = self.layout()
+        if layout is not None:
+            if layout.is_fixed_size:
+                return [offset for (name, offset) in layout.pointer_members if getattr(self, name) != Numeric.NULLPTR]
+            # Offsets depend on the contents so they can only be found by serializing
+            pointers = []
+            layout.serialize(self, ResizableBuffer(0), pointers)
+            return pointers
         ctx = {
             "size_sum": 0,
             "offsets": [],
@@ -153,6 +605,9 @@ class Serializable:
 
     def instance_size(self) -> int:
         """Will also include size of data inside any list type members."""
+        layout = self.layout()
+        if layout is not None:
+            return layout.instance_size(self)
         ctx = {"size_sum": 0}
         self._visit(self, ctx, Serializable._size_visitor)
         return ctx["size_sum"]
@@ -160,6 +615,9 @@ class Serializable:
     @classmethod
     def type_size(cls) -> int:
         """Similar to sizeof(). Size of lists is considered to be 0."""
+        layout = cls.layout()
+        if layout is not None:
+            return layout.size
         ctx = {"size_sum": 0}
         cls._visit(cls, ctx, Serializable._size_visitor)
         return ctx["size_sum"]
@@ -188,6 +646,15 @@ class Serializable:
                 if not should_continue:
                     break
             return should_continue
+        if is_packed_array_type(tp):
+            if value is tp or type(value) is bytes or type(value) is bytearray:
+                return visitor(value=value, name=name, tp=tp if value is tp else type(value), fmt=None, ctx=ctx)
+            # Visit elements like list elements
+            (_, elem_type) = get_args(tp.__supertype__)
+            for elem_value in value:
+                if not cls._visit(elem_value, ctx, visitor, name=name, tp=elem_type):
+                    return False
+            return True
         is_list = type(value) is list
         is_tuple = type(value) is tuple
         is_fixed_array = tp.__name__ == "FixedArray"
@@ -242,9 +709,9 @@ class Serializable:
             # Value is primitive
             # Determine format from name or type
             if tp is not None:
-                fmt = Numeric.format_of_type(tp)
+                fmt = Numeric.format_of_type(tp, ctx.get("endianness_prefix"))
             elif name is not None:
-                fmt = cls.format_of_member(name)
+                fmt = cls.format_of_member(name, ctx.get("endianness_prefix"))
             if fmt is None:
                 # Can't continue
                 cls._warn_unserializable(name)
@@ -268,19 +735,41 @@ class Serializable:
             ctx["first_offset"] = offset
         return True
 
-    def serialize_into(self, buf: ResizableBuffer, alignment=None) -> int:
+    def serialize_into(self, buf: ResizableBuffer, alignment=None, pointers: list[int]=None, base_offset: int=0) -> int:
         """Writes serializable members of this object into given buffer.
+        Absolute offsets of non-null pointers that were written are appended to pointers if it's given.
+        Padding for alignment is computed as if the buffer started at base_offset of the file.
         Returns absolute offset of where data was written."""
+        layout = self.layout(buf.endianness_prefix)
+        if layout is not None:
+            offset = buf.offset
+            pointer_count = len(pointers) if pointers is not None else 0
+            try:
+                layout.serialize(self, buf, pointers)
+            except StructError:
+                # Let the visitor find the offending member
+                buf.offset = offset
+                if pointers is not None:
+                    del pointers[pointer_count:]
+            else:
+                if buf.offset == offset:
+                    raise Exception("Serialization error: Did not write anything")
+                if alignment is not None and (base_offset + buf.offset) % alignment != 0:
+                    padding = alignment - (base_offset + buf.offset) % alignment
+                    buf.pack_struct(Struct("{}x".format(padding)))
+                return offset
         item = self
         if alignment is not None:
-            offset_after = buf.offset + self.instance_size()
+            offset_after = base_offset + buf.offset + self.instance_size()
             if offset_after % alignment != 0:
                 padding = ((offset_after // alignment) + 1) * alignment - offset_after
-                item = AlignmentHelper(wrapped=self, padding=[0] * padding)
-        ctx = {"first_offset": None, "buf": buf}
+                item = AlignmentHelper(wrapped=self, padding=bytes(padding))
+        ctx = {"first_offset": None, "buf": buf, "endianness_prefix": buf.endianness_prefix}
         self._visit(item, ctx, Serializable._serializer_visitor)
         if ctx["first_offset"] is None:
             raise Exception("Serialization error: Did not write anything")
+        if pointers is not None:
+            pointers += [ctx["first_offset"] + member_offset for member_offset in self.nonnull_pointer_member_offsets()]
         return ctx["first_offset"]
     
     def _deserializer_visitor(**kwargs) -> bool:
@@ -296,21 +785,34 @@ class Serializable:
         return True
     
     @classmethod
-    def deserialize_from(cls, buf, offset=0):
+    def deserialize_from(cls, buf, offset=0, endianness_prefix: str=None):
         """Assumes class has default constructor"""
+        layout = cls.layout(endianness_prefix)
+        if layout is not None:
+            return layout.deserialize(buf, offset)
         result = cls() # Default construct
-        ctx = {"result": result, "offset": offset, "buf": buf}
+        ctx = {"result": result, "offset": offset, "buf": buf, "endianness_prefix": endianness_prefix}
         cls._visit(cls, ctx, Serializable._deserializer_visitor)
         return (result, ctx["offset"])
     
     @classmethod
-    def read_sequence(cls, buf, offset, count) -> list:
+    def read_array(cls, buf, offset, count, endianness_prefix: str=None):
+        """Reads consecutive instances into a NumPy structured array with one field per member.
+        The array is a view into buf, so no objects are created per instance."""
+        import numpy as np
+        layout = cls.layout(endianness_prefix)
+        if layout is None:
+            raise TypeError("Class \"{}\" has no NumPy dtype because its layout can't be compiled".format(cls.__name__))
+        return np.frombuffer(memoryview(buf), dtype=layout.dtype(), count=count, offset=offset)
+
+    @classmethod
+    def read_sequence(cls, buf, offset, count, endianness_prefix: str=None) -> list:
         items = []
         if count < 1:
             return items
         size = cls.type_size()
         for _ in range(count):
-            (item, _) = cls.deserialize_from(buf, offset)
+            (item, _) = cls.deserialize_from(buf, offset, endianness_prefix)
             items.append(item)
             offset += size
         return items
@@ -319,16 +821,15 @@ class Serializable:
 @dataclass
 class AlignmentHelper(Serializable):
     wrapped: Serializable
-    padding: list[Numeric.U8] = field(default_factory=list)
+    padding: PackedArray(Numeric.U8) = field(default_factory=bytes)
 
 
 class AlignedString(Serializable):
-    chars: list[Numeric.U8] = field(default_factory=list)
+    chars: PackedArray(Numeric.U8) = field(default_factory=bytes)
 
     def __init__(self, s: str, alignment: int):
-        self.chars = list(str.encode(s))
-        self.chars.append(0)
+        self.chars = str.encode(s) + b"\0"
         self._alignment = alignment
 
-    def serialize_into(self, buf, unused):
-        return super().serialize_into(buf, self._alignment)
+    def serialize_into(self, buf, unused, pointers=None, base_offset=0):
+        return super().serialize_into(buf, self._alignment, pointers, base_offset)
@@ -38,9 +38,7 @@ class TamEntry(Serializable):
 
 
 def write(tam_path: str, texture_man: TextureManager, objs: list[bpy.types.Object]):
-    Numeric.use_big_endian()
-
-    tam = ResizableBuffer(0)
+    tam = ResizableBuffer(0, endianness_prefix=Numeric.BIG_ENDIAN)
 
     for obj in objs:
         anim_tex = texture_man.get_object_animated_texture(obj)
@@ -64,6 +62,4 @@ def write(tam_path: str, texture_man: TextureManager, objs: list[bpy.types.Objec
     TamEntry(frame_type=FrameType.TERMINATOR).serialize_into(tam)
 
     with open(tam_path, "wb") as f:
-        f.write(tam.buffer)
-
-    Numeric.use_little_endian()
+        f.write(tam.trim())
@@ -1,9 +1,12 @@
-import math
+import math, multiprocessing, os, sys, tempfile
 from mathutils import Vector, Matrix
 import bpy.types 
 from dataclasses import field
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
 from abc import ABC, abstractmethod
 from .serialization import Serializable
+from .dxt import Quality
 
 
 def mesh_faces(mesh: bpy.types.Mesh) -> list[tuple[int, int, int]]:
@@ -20,11 +23,13 @@ class Texture:
     has_alpha: bool
     image: bpy.types.Image
     animation_frames: int
+    quality: int
 
-    def __init__(self, *args, id: int=None, image: bpy.types.Image, generate_mipmaps: bool=False, animation_frames: int=0):
+    def __init__(self, *args, id: int=None, image: bpy.types.Image, generate_mipmaps: bool=False, animation_frames: int=0, quality: int=Quality.FAST):
         self.id = id
         self.image = image
         self.generate_mipmaps = generate_mipmaps
+        self.quality = quality
         self.animation_frames = animation_frames
         # Check if texture uses alpha
         self.has_alpha = image.channels == 4
@@ -37,6 +42,21 @@ class Texture:
                     break
 
 
+# Texture quality of exports, which either keeps the quality set in each material or overrides it
+TEXTURE_QUALITY_ITEMS = [
+    ("MATERIAL", "Per material", "Use the texture quality of each material", 0),
+    ("FAST", "Fast", "Compress all textures quickly", 1),
+    ("HIGH", "High", "Compress all textures with less banding on gradients", 2)
+]
+
+
+def texture_quality_override(item: str) -> int:
+    "Returns the quality that overrides the quality of materials, or None"
+    if item == "MATERIAL":
+        return None
+    return getattr(Quality, item)
+
+
 def get_object_diffuse_textures(obj: bpy.types.Object) -> list[Texture]:
     """Assumes the first image node of each material is the correct one"""
     textures = []
@@ -45,7 +65,8 @@ def get_object_diffuse_textures(obj: bpy.types.Object) -> list[Texture]:
             continue
         for node in mat_slot.material.node_tree.nodes:
             if node.type == "TEX_IMAGE" and node.image:
-                textures.append(Texture(generate_mipmaps=mat_slot.material.xj_settings.generate_mipmaps, image=node.image))
+                settings = mat_slot.material.xj_settings
+                textures.append(Texture(generate_mipmaps=settings.generate_mipmaps, image=node.image, quality=int(settings.texture_quality)))
                 break
     return textures
 
@@ -97,6 +118,51 @@ def align_up(n: int, to: int) -> int:
     return (n + to - 1) // to * to
 
 
+@contextmanager
+def replace_on_success(path: str) -> Iterator[BinaryIO]:
+    """Opens a temporary file next to path for writing, which replaces path only if the with block succeeds.
+    An existing file is left untouched if exporting fails halfway."""
+    (dirname, basename) = os.path.split(os.path.abspath(path))
+    (fd, temp_path) = tempfile.mkstemp(prefix=basename + ".", suffix=".tmp", dir=dirname)
+    try:
+        # Temporary files are only readable by the owner, but the result should have normal permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def starmap_forked(fn, args: list[tuple], workers: int=None) -> list:
+    """Calls fn with each tuple of arguments in a process pool and returns the results in order.
+    Workers are forked so that they don't have to import Blender modules.
+    Only Linux can safely fork Blender, which runs threads, so everything is done in this process
+    on other platforms or if there's only one worker."""
+    return list(imap_forked(fn, args, workers))
+
+
+def imap_forked(fn, args: list[tuple], workers: int=None) -> Iterator:
+    "Same as starmap_forked, but yields the results in order as soon as they are done"
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(args))
+    if workers <= 1 or not sys.platform.startswith("linux"):
+        for fn_args in args:
+            yield fn(*fn_args)
+        return
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        yield from pool.imap(call_with_args, [(fn, fn_args) for fn_args in args])
+
+
+def call_with_args(fn_and_args: tuple):
+    (fn, args) = fn_and_args
+    return fn(*args)
+
+
 def scale_mesh(mesh: bpy.types.Mesh, x: float, y: float=None, z: float=None):
     if y is None:
         y = x
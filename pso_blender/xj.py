@@ -1,11 +1,12 @@
 import bpy, os
+import numpy as np
 from dataclasses import dataclass, field
-from .serialization import Serializable, Numeric, AlignedString
-from struct import unpack_from, pack_into
+from .serialization import Serializable, Numeric, PackedArray, read_packed_array
+from struct import pack_into
 from .njcm import MeshTreeNode
 from . import tristrip, util, xvm
 from .iff import IffHeader, IffChunk, parse_pof0
-from .njtl import TextureList, TextureListEntry
+from .njtl import TextureList, write_texture_entries
 
 
 U8 = Numeric.U8
@@ -133,19 +134,23 @@ class VertexBufferFormat7(Serializable):
 
 @dataclass
 class IndexBuffer(Serializable):
-    indices: list[U16] = field(default_factory=list)
+    indices: PackedArray(U16) = field(default_factory=list)
 
 
 @dataclass
 class VertexBufferContainer(Serializable):
+    """When exporting, vertex_buffer is a VertexBufferFormat* that holds the vertex objects.
+    When importing, it's a NumPy structured array with a field per member of the VertexFormat* class,
+    so vertices are accessed by column (vertex_buffer["x"]) instead of by attribute."""
     vertex_format: U32 = 0
-    vertex_buffer: Ptr32 = NULLPTR # VertexBuffer
+    vertex_buffer: Ptr32 = NULLPTR # VertexBufferFormat* or np.ndarray of VertexFormat*, see above
     vertex_size: U32 = 0
     vertex_count: U32 = 0
 
     @classmethod
-    def deserialize_from(cls, buf, offset):
-        (container, after) = super(VertexBufferContainer, cls).deserialize_from(buf, offset)
+    def deserialize_from(cls, buf, offset, endianness_prefix=None):
+        "Vertices are read into a structured array that is a view into buf"
+        (container, after) = super(VertexBufferContainer, cls).deserialize_from(buf, offset, endianness_prefix)
         vertex_format = container.vertex_format & 0xffff
         if vertex_format == 1:
             vert_ctor = VertexFormat1
@@ -161,7 +166,7 @@ class VertexBufferContainer(Serializable):
             vert_ctor = VertexFormat7
         else:
             raise Exception("Unimplemented vertex format {}".format(container.vertex_format))
-        container.vertex_buffer = vert_ctor.read_sequence(buf, container.vertex_buffer, container.vertex_count)
+        container.vertex_buffer = vert_ctor.read_array(buf, container.vertex_buffer, container.vertex_count, endianness_prefix)
         return (container, after)
 
 
@@ -224,12 +229,11 @@ class IndexBufferContainer(Serializable):
     unk1: U32 = 0
 
     @classmethod
-    def deserialize_from(cls, buf, offset):
-        (container, after) = super(IndexBufferContainer, cls).deserialize_from(buf, offset)
-        container.renderstate_args = RenderStateArgs.read_sequence(buf, container.renderstate_args, container.renderstate_args_count)
-        [endian, typecode] = Numeric.format_of_type(U16)
-        fmt = endian + str(container.index_count) + typecode
-        container.index_buffer = unpack_from(fmt, buf, offset=container.index_buffer)
+    def deserialize_from(cls, buf, offset, endianness_prefix=None):
+        (container, after) = super(IndexBufferContainer, cls).deserialize_from(buf, offset, endianness_prefix)
+        container.renderstate_args = RenderStateArgs.read_sequence(
+            buf, container.renderstate_args, container.renderstate_args_count, endianness_prefix)
+        container.index_buffer = read_packed_array(U16, buf, container.index_buffer, container.index_count, endianness_prefix)
         return (container, after)
 
 
@@ -244,11 +248,14 @@ class Mesh(Serializable):
     alpha_index_buffer_count: U32 = 0
 
     @classmethod
-    def deserialize_from(cls, buf, offset):
-        (mesh, after) = super(Mesh, cls).deserialize_from(buf, offset=offset)
-        mesh.vertex_buffers = VertexBufferContainer.read_sequence(buf, mesh.vertex_buffers, mesh.vertex_buffer_count)
-        mesh.index_buffers = IndexBufferContainer.read_sequence(buf, mesh.index_buffers, mesh.index_buffer_count)
-        mesh.alpha_index_buffers = IndexBufferContainer.read_sequence(buf, mesh.alpha_index_buffers, mesh.alpha_index_buffer_count)
+    def deserialize_from(cls, buf, offset, endianness_prefix=None):
+        (mesh, after) = super(Mesh, cls).deserialize_from(buf, offset=offset, endianness_prefix=endianness_prefix)
+        mesh.vertex_buffers = VertexBufferContainer.read_sequence(
+            buf, mesh.vertex_buffers, mesh.vertex_buffer_count, endianness_prefix)
+        mesh.index_buffers = IndexBufferContainer.read_sequence(
+            buf, mesh.index_buffers, mesh.index_buffer_count, endianness_prefix)
+        mesh.alpha_index_buffers = IndexBufferContainer.read_sequence(
+            buf, mesh.alpha_index_buffers, mesh.alpha_index_buffer_count, endianness_prefix)
         return (mesh, after)
 
 
@@ -309,7 +316,8 @@ def determine_vertex_format(has_textures: bool, has_vertex_colors: bool, use_nor
     return (vertex_format, vertex_size, vertex_buffer, vertex_ctor)
 
 
-def write_vertex_buffer(destination: util.AbstractFileArchive, obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, xj_mesh: Mesh, has_textures: bool, vertex_colors, normal_type):
+def extract_vertex_buffer(obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, has_textures: bool, vertex_colors, normal_type) -> VertexBufferContainer:
+    """Returns a container with the vertex buffer in place of the pointer to it"""
     use_normals = normal_type is not None
 
     # One vertex per loop
@@ -357,71 +365,94 @@ def write_vertex_buffer(destination: util.AbstractFileArchive, obj: bpy.types.Ob
                 vertex.ny = normal[1]
                 vertex.nz = normal[2]
 
+    return VertexBufferContainer(
+        vertex_format=vertex_format,
+        vertex_buffer=vertex_buffer,
+        vertex_size=vertex_size,
+        vertex_count=len(vertex_buffer.vertices))
+
+
+def write_vertex_buffer(destination: util.AbstractFileArchive, xj_mesh: Mesh, container: VertexBufferContainer):
     # Put all vertices in one buffer
     xj_mesh.vertex_buffer_count = 1
     xj_mesh.vertex_buffers = destination.write(VertexBufferContainer(
-        vertex_format=vertex_format,
-        vertex_buffer=destination.write(vertex_buffer),
-        vertex_size=vertex_size,
-        vertex_count=len(vertex_buffer.vertices)))
+        vertex_format=container.vertex_format,
+        vertex_buffer=destination.write(container.vertex_buffer),
+        vertex_size=container.vertex_size,
+        vertex_count=container.vertex_count))
 
 
 class MaterialStrips:
-    def __init__(self, material_index: int, material: bpy.types.Material, strips: list[list[int]]):
+    """Triangles of one material. They are turned into strips by make_strips."""
+    def __init__(self, material_index: int, renderstate_args: list[RenderStateArgs], faces: list[tuple[int, int, int]]):
         self.material_index = material_index
-        self.renderstate_args = make_renderstate_args(
-            blend_modes=(material.xj_settings.src_blend, material.xj_settings.dst_blend),
-            texture_addressing=(material.xj_settings.tex_addr_u, material.xj_settings.tex_addr_v),
-            lighting=material.xj_settings.lighting,
-            material=(material.xj_settings.material1, material.xj_settings.material2),
-            camera_space_normals=material.xj_settings.camera_space_normals,
-            diffuse_color_source=material.xj_settings.diffuse_color_source)
-        self.strips = strips
+        self.renderstate_args = renderstate_args
+        self.faces = faces
+        self.strips: list[list[int]] = []
+
+    def make_strips(self):
+        self.strips = tristrip.stripify(self.faces, stitchstrips=True)
 
 
-def create_tristrips_grouped_by_material(obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, texture_man: xvm.TextureManager) -> list[MaterialStrips]:
+def material_renderstate_args(material: bpy.types.Material) -> list[RenderStateArgs]:
+    return make_renderstate_args(
+        blend_modes=(material.xj_settings.src_blend, material.xj_settings.dst_blend),
+        texture_addressing=(material.xj_settings.tex_addr_u, material.xj_settings.tex_addr_v),
+        lighting=material.xj_settings.lighting,
+        material=(material.xj_settings.material1, material.xj_settings.material2),
+        camera_space_normals=material.xj_settings.camera_space_normals,
+        diffuse_color_source=material.xj_settings.diffuse_color_source)
+
+
+def group_faces_by_material(obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, texture_man: xvm.TextureManager) -> list[MaterialStrips]:
     material_strips = []
     if texture_man.has_textures():
-        material_faces = []
         for (mat_idx, mat_slot) in enumerate(obj.material_slots):
-            material_faces.append([])
-            material_strips.append(MaterialStrips(mat_idx, mat_slot.material, []))
+            material_strips.append(MaterialStrips(mat_idx, material_renderstate_args(mat_slot.material), []))
         for face in blender_mesh.loop_triangles:
-            material_faces[face.material_index].append(tuple(face.loops))
-        for mat_idx in range(len(obj.material_slots)):
-            strips = tristrip.stripify(material_faces[mat_idx], stitchstrips=True)
-            material_strips[mat_idx].strips = strips
+            material_strips[face.material_index].faces.append(tuple(face.loops))
     else:
         faces = []
         for face in blender_mesh.loop_triangles:
             faces.append(tuple(face.loops))
-        material_strips.append(tristrip.stripify(faces, stitchstrips=True))
+        material_strips.append(MaterialStrips(0, [], faces))
     return material_strips
 
 
-def write_index_buffers(destination: util.AbstractFileArchive, obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, xj_mesh: Mesh, texture_man: xvm.TextureManager, has_vertex_alpha: bool):
+@dataclass
+class MeshData:
+    """Everything that is needed from Blender to write a mesh. Writing it doesn't use Blender,
+    so it can be done in another process."""
+    vertex_buffer: VertexBufferContainer
+    material_strips: list[MaterialStrips]
+    # Texture ID and whether the texture has alpha for each material, None if there are no textures
+    textures: list[tuple[int, bool]]
+    is_translucent: bool
+    has_vertex_alpha: bool
+
+
+def write_index_buffers(destination: util.AbstractFileArchive, xj_mesh: Mesh, mesh_data: MeshData):
     # Texture IDs must be 0-based for the render settings
     # One buffer per strip
-    material_strips = create_tristrips_grouped_by_material(obj, blender_mesh, texture_man)
     opaque_index_buffer_containers = []
     alpha_index_buffer_containers = []
-    textures = texture_man.get_object_textures(obj)
-    texture_id_base = texture_man.get_base_id()
-    for material_strip_data in material_strips:
+    for material_strip_data in mesh_data.material_strips:
+        material_strip_data.make_strips()
         for strip in material_strip_data.strips:
             # Strips can be empty due to unused material slots, skip them
             if len(strip) < 1:
                 continue
-            has_alpha = obj.rel_settings.is_translucent or has_vertex_alpha
+            has_alpha = mesh_data.is_translucent or mesh_data.has_vertex_alpha
             # Create render state args
             first_rs_arg_ptr = NULLPTR
             rs_args = material_strip_data.renderstate_args
-            if texture_man.has_textures():
-                tex = textures[material_strip_data.material_index]
-                has_alpha = has_alpha or tex.has_alpha
-                rs_args += make_renderstate_args(
+            if mesh_data.textures is not None:
+                (texture_id, texture_has_alpha) = mesh_data.textures[material_strip_data.material_index]
+                has_alpha = has_alpha or texture_has_alpha
+                # Make a new list, so that texture args don't pile up in the material's args
+                rs_args = rs_args + make_renderstate_args(
                     # XXX: Assumes material index matches index of texture in this array
-                    texture_id=tex.id - texture_id_base)
+                    texture_id=texture_id)
             rs_arg_count = len(rs_args)
             for rs_arg in rs_args:
                 ptr = destination.write(rs_arg)
@@ -452,9 +483,7 @@ def write_index_buffers(destination: util.AbstractFileArchive, obj: bpy.types.Ob
     xj_mesh.index_buffers = first_opaque_index_buffer_container_ptr
 
 
-def make_mesh(destination: util.AbstractFileArchive, obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, texture_man: xvm.TextureManager) -> Mesh:
-    mesh = Mesh()
-
+def extract_mesh_data(obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, texture_man: xvm.TextureManager) -> MeshData:
     normal_type = None
     for mat_slot in obj.material_slots:
         if mat_slot.material.xj_settings.camera_space_normals:
@@ -475,12 +504,50 @@ def make_mesh(destination: util.AbstractFileArchive, obj: bpy.types.Object, blen
             if attr.color[3] < 1:
                 has_vertex_alpha = True
                 break
+
+    textures = None
+    if texture_man.has_textures():
+        texture_id_base = texture_man.get_base_id()
+        textures = [(tex.id - texture_id_base, tex.has_alpha) for tex in texture_man.get_object_textures(obj)]
+    return MeshData(
+        vertex_buffer=extract_vertex_buffer(obj, blender_mesh, texture_man.has_textures(), vertex_colors, normal_type),
+        material_strips=group_faces_by_material(obj, blender_mesh, texture_man),
+        textures=textures,
+        is_translucent=obj.rel_settings.is_translucent,
+        has_vertex_alpha=has_vertex_alpha)
+
+
+def write_mesh_data(destination: util.AbstractFileArchive, mesh_data: MeshData) -> Mesh:
+    mesh = Mesh()
     # Write various mesh data
-    write_vertex_buffer(destination, obj, blender_mesh, mesh, texture_man.has_textures(), vertex_colors, normal_type)
-    write_index_buffers(destination, obj, blender_mesh, mesh, texture_man, has_vertex_alpha)
+    write_vertex_buffer(destination, mesh, mesh_data.vertex_buffer)
+    write_index_buffers(destination, mesh, mesh_data)
     return mesh
 
 
+def make_mesh(destination: util.AbstractFileArchive, obj: bpy.types.Object, blender_mesh: bpy.types.Mesh, texture_man: xvm.TextureManager) -> Mesh:
+    return write_mesh_data(destination, extract_mesh_data(obj, blender_mesh, texture_man))
+
+
+def estimate_mesh_size(obj: bpy.types.Object) -> int:
+    """Rough upper bound of how much make_mesh writes for an object. Used for reserving space up front."""
+    return estimate_size(len(obj.data.loops), len(obj.material_slots))
+
+
+def estimate_mesh_data_size(mesh_data: MeshData) -> int:
+    "Same as estimate_mesh_size, but for extracted mesh data"
+    return estimate_size(mesh_data.vertex_buffer.vertex_count, len(mesh_data.material_strips))
+
+
+def estimate_size(loop_count: int, material_count: int) -> int:
+    # One vertex per loop, and strips rarely have more than two indices per loop
+    vertex_size = VertexFormat7.type_size()
+    index_size = 2 * 2
+    overhead = Mesh.type_size() + VertexBufferContainer.type_size() + MeshTreeNode.type_size()
+    per_material_overhead = IndexBufferContainer.type_size() + RenderStateArgs.type_size() * 8
+    return overhead + material_count * per_material_overhead + loop_count * (vertex_size + index_size)
+
+
 def make_renderstate_args(
     *args,
     texture_id=None,
@@ -551,8 +618,8 @@ def xj_to_blender_mesh(name: str, node: MeshTreeNode) -> bpy.types.Collection:
 
         # Get vertices
         for vertex_buffer in node.mesh.vertex_buffers:
-            for vertex in vertex_buffer.vertex_buffer:
-                vertices.append((vertex.x, vertex.z, vertex.y))
+            vertex_array = vertex_buffer.vertex_buffer
+            vertices += np.column_stack((vertex_array["x"], vertex_array["z"], vertex_array["y"])).tolist()
 
         # Get indices
         for index_buffer in node.mesh.index_buffers + node.mesh.alpha_index_buffers:
@@ -580,22 +647,24 @@ def xj_to_blender_mesh(name: str, node: MeshTreeNode) -> bpy.types.Collection:
         colors = obj.data.color_attributes.new("vertex_color", "FLOAT_COLOR", "POINT")
         vert_idx = 0
         for vertex_buffer in node.mesh.vertex_buffers:
-            for vertex in vertex_buffer.vertex_buffer:
-                if vertex_has_color(vertex_buffer.vertex_format):
-                    colors.data[vert_idx].color[0] = vertex.r / 0xff
-                    colors.data[vert_idx].color[1] = vertex.g / 0xff
-                    colors.data[vert_idx].color[2] = vertex.b / 0xff
-                vert_idx += 1
+            vertex_array = vertex_buffer.vertex_buffer
+            if vertex_has_color(vertex_buffer.vertex_format):
+                rgb = np.column_stack((vertex_array["r"], vertex_array["g"], vertex_array["b"])) / 0xff
+                for (i, (r, g, b)) in enumerate(rgb.tolist()):
+                    colors.data[vert_idx + i].color[0] = r
+                    colors.data[vert_idx + i].color[1] = g
+                    colors.data[vert_idx + i].color[2] = b
+            vert_idx += len(vertex_array)
 
         collection.objects.link(obj)
     return collection
 
 
-def write(xj_path: str, xvm_path: str, obj: bpy.types.Object):
-    texture_man = xvm.TextureManager([obj])
+def write(xj_path: str, xvm_path: str, obj: bpy.types.Object, texture_quality: int=None):
+    texture_man = xvm.TextureManager([obj], texture_quality)
     textures = texture_man.get_object_textures(obj)
 
-    njcm_chunk = IffChunk("NJCM")
+    njcm_chunk = IffChunk("NJCM", size_hint=estimate_mesh_size(obj))
     # Root node must to be the first thing after the chunk header
     mesh_node = MeshTreeNode(
         eval_flags=NinjaEvalFlag.UNIT_ANG | NinjaEvalFlag.UNIT_SCL | NinjaEvalFlag.BREAK,
@@ -611,7 +680,7 @@ def write(xj_path: str, xvm_path: str, obj: bpy.types.Object):
 
     # Write mesh pointer into root node
     mesh_ptr = njcm_chunk.write(mesh)
-    pack_into(Numeric.endianness_prefix + "L", njcm_chunk.buf.buffer, mesh_pointer_offset, mesh_ptr)
+    pack_into(njcm_chunk.buf.endianness_prefix + "L", njcm_chunk.buf.buffer, mesh_pointer_offset, mesh_ptr)
 
     # Chunk (+POF0) is done
     xj_buf = njcm_chunk.finish()
@@ -624,15 +693,9 @@ def write(xj_path: str, xvm_path: str, obj: bpy.types.Object):
             count=len(textures))
         texlist_elements_offset = njtl_chunk.write(texlist) + IffHeader.type_size()
 
-        first_texlist_entry_ptr = NULLPTR
-        for texture in textures:
-            tex_name = texture.image.name[0:31]
-            name_ptr = njtl_chunk.write(AlignedString(tex_name, IffChunk.ALIGNMENT))
-            ptr = njtl_chunk.write(TextureListEntry(name=name_ptr))
-            if first_texlist_entry_ptr == NULLPTR:
-                first_texlist_entry_ptr = ptr
+        first_texlist_entry_ptr = write_texture_entries(njtl_chunk, [texture.image.name[0:31] for texture in textures], IffChunk.ALIGNMENT)
         # Rewrite pointer
-        pack_into(Numeric.endianness_prefix + "L", njtl_chunk.buf.buffer, texlist_elements_offset, first_texlist_entry_ptr)
+        pack_into(njtl_chunk.buf.endianness_prefix + "L", njtl_chunk.buf.buffer, texlist_elements_offset, first_texlist_entry_ptr)
 
         # Append NJTL
         xj_buf += njtl_chunk.finish()
@@ -2,8 +2,8 @@ import bpy
 import os
 from bpy_extras.io_utils import ExportHelper
 from bpy.types import Operator
-from bpy.props import StringProperty
-from . import xj
+from bpy.props import StringProperty, EnumProperty
+from . import xj, util
 
 
 class ExportXj(Operator, ExportHelper):
@@ -19,6 +19,12 @@ class ExportXj(Operator, ExportHelper):
         maxlen=255,  # Max internal buffer length, longer would be clamped.
     )
 
+    texture_quality: EnumProperty(
+        name="Texture quality",
+        items=util.TEXTURE_QUALITY_ITEMS,
+        default="MATERIAL"
+    )
+
     filepath: StringProperty(subtype="FILE_PATH")
 
     def only_meshes(self, objs: list[bpy.types.Object]):
@@ -31,8 +37,8 @@ class ExportXj(Operator, ExportHelper):
         if len(objs) < 1:
             # otherwise just use the first object
             objs = self.only_meshes(bpy.data.objects)
-        xj.write(self.filepath, noext + ".xvm", objs[0])
+        xj.write(self.filepath, noext + ".xvm", objs[0], util.texture_quality_override(self.texture_quality))
         return {"FINISHED"}
     
     def draw(self, context):
-        pass
+        self.layout.prop(self, "texture_quality")
@@ -1,6 +1,6 @@
 import bpy
 from bpy.props import BoolProperty, EnumProperty, IntProperty
-from . import xj
+from . import xj, dxt
 
 
 def make_enum_prop_items(the_enum):
@@ -13,6 +13,11 @@ class XjMaterialSettings(bpy.types.PropertyGroup):
         name="Generate Mipmaps",
         default=False,
         description="Generate mipmaps for this texture. Can make exporting very slow.")
+    texture_quality: EnumProperty(
+        name="Texture quality",
+        default=str(dxt.Quality.FAST),
+        items=make_enum_prop_items(dxt.Quality),
+        description="High quality has less banding on gradients, but the texture takes longer to export")
     src_blend: EnumProperty(
         name="Source",
         default=str(xj.BlendMode.D3DBLEND_SRCALPHA),
@@ -60,6 +65,7 @@ class XjMaterialSettingsPanel(bpy.types.Panel):
         self.layout.use_property_decorate = False
         settings = context.material.xj_settings
         self.layout.prop(settings, "generate_mipmaps")
+        self.layout.prop(settings, "texture_quality")
         self.layout.prop(settings, "lighting")
         # Alpha blending
         blend_box = self.layout.box()
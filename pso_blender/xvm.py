@@ -1,5 +1,6 @@
-import os, pathlib, marshal, json, hashlib
-from dataclasses import dataclass, field
+import os, pathlib, json, hashlib
+from dataclasses import dataclass, field, replace
+import numpy as np
 import bpy
 import bpy.types
 from .serialization import Serializable, Numeric, ResizableBuffer
@@ -99,7 +100,8 @@ class Xvm(Serializable):
 
 
 class TextureManager:
-    def __init__(self, objects: list[bpy.types.Object]):
+    def __init__(self, objects: list[bpy.types.Object], quality: int=None):
+        "Quality overrides the texture quality of every material if given"
         import time
         # Create "unique" texture IDs
         self._base_id = int(time.time()) & 0xffffffff
@@ -108,6 +110,9 @@ class TextureManager:
         self._textures_by_path = dict()
         for obj in objects:
             textures = get_object_diffuse_textures(obj)
+            if quality is not None:
+                for tex in textures:
+                    tex.quality = quality
             including_animated_textures = []
 
             # Get animated textures
@@ -118,7 +123,7 @@ class TextureManager:
                     tex.animation_frames = len(other_frames) + 1
                     for frame in other_frames:
                         including_animated_textures.append(
-                            Texture(generate_mipmaps=tex.generate_mipmaps, image=frame))
+                            Texture(generate_mipmaps=tex.generate_mipmaps, image=frame, quality=tex.quality))
 
             for tex in including_animated_textures:
                 w, h = tex.image.size
@@ -195,10 +200,15 @@ def generate_mipmaps(image: bpy.types.Image, has_alpha: bool) -> list[bpy.types.
     return levels
 
 
-def texture_checksum(tex: Texture) -> str:
-    data = list(tex.image.pixels)
-    data.append(float(tex.generate_mipmaps))
-    return hashlib.md5(marshal.dumps(data)).hexdigest()
+def texture_checksum(tex: Texture, pixels: np.ndarray=None) -> str:
+    "Pixels of the image can be given if they have already been read"
+    if pixels is None:
+        pixels = image_pixels(tex.image)
+    md5 = hashlib.md5(pixels.data)
+    md5.update(bytes([tex.generate_mipmaps]))
+    if tex.quality != dxt.Quality.FAST:
+        md5.update(bytes([tex.quality]))
+    return md5.hexdigest()
 
 
 def load_cache_index(path: str) -> dict[str, str]:
@@ -228,10 +238,38 @@ def cache_xvr(path: str, xvr: Xvr):
     xvr.serialize_into(buf)
     with open(path, "wb") as f:
         print("XVM Notice: Saving texture to cache '{}'".format(path))
-        f.write(buf.buffer)
+        f.write(buf.trim())
 
 
-def make_xvr(tex: Texture) -> Xvr:
+def image_pixels(image: bpy.types.Image) -> np.ndarray:
+    "Copying pixels with foreach_get is much faster than going through them one by one"
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels
+
+
+class PendingXvr:
+    "XVR whose levels are still being compressed"
+    def __init__(self, xvr: Xvr, levels: list[dxt.PendingImage]):
+        self.xvr = xvr
+        self.levels = levels
+
+    def result(self) -> Xvr:
+        data = bytearray()
+        for level in self.levels:
+            data += level.result()
+        self.xvr.body_size = len(data) + Xvr.type_size() - 4
+        self.xvr.data_size = len(data)
+        self.xvr.data = data
+        return self.xvr
+
+    def with_id(self, id: int) -> "PendingXvr":
+        "Same texture under another ID, which shares the levels that are being compressed"
+        return PendingXvr(replace(self.xvr, id=id), self.levels)
+
+
+def submit_xvr(tex: Texture, encoder: dxt.Encoder, pixels: np.ndarray=None) -> PendingXvr:
+    "Starts compressing the texture and all of its mip levels. Pixels of the image can be given if they have already been read."
     img_width, img_height = tex.image.size
     flags = 0
     if tex.generate_mipmaps:
@@ -241,35 +279,88 @@ def make_xvr(tex: Texture) -> Xvr:
             raise Exception("XVR Error in Image '{}': Image has unsupported alpha mode '{}'".format(tex.image.filepath, tex.image.alpha_mode))
         flags |= XvrFlags.ALPHA
     xvr_format = XvrFormat.DXT1
-    data = dxt.compress_image(list(tex.image.pixels), img_width, img_height, tex.image.channels, tex.has_alpha)
+    if pixels is None:
+        pixels = image_pixels(tex.image)
+    levels = [encoder.submit(pixels, img_width, img_height, tex.image.channels, tex.has_alpha, tex.quality)]
     if tex.generate_mipmaps:
         # Concat mipmaps into data
         mipmaps = generate_mipmaps(tex.image, tex.has_alpha)
         for level in mipmaps:
             level_width, level_height = level.size
-            data += dxt.compress_image(list(level.pixels), level_width, level_height, level.channels, tex.has_alpha)
+            levels.append(encoder.submit(image_pixels(level), level_width, level_height, level.channels, tex.has_alpha, tex.quality))
             # Remove temporary copies because Blender automatically saves them in the scene
             bpy.data.images.remove(level)
-    return Xvr(
-        body_size=len(data) + Xvr.type_size() - 4,
+    xvr = Xvr(
         id=tex.id,
         flags=flags,
         format=xvr_format,
         width=img_width,
-        height=img_height,
-        data_size=len(data),
-        data=data)
+        height=img_height)
+    return PendingXvr(xvr, levels)
 
 
-def write(path: str, textures: list[Texture]):
+def make_xvr(tex: Texture) -> Xvr:
+    with dxt.Encoder() as encoder:
+        return submit_xvr(tex, encoder).result()
+
+
+@dataclass
+class UncachedTexture:
+    "Texture that must be compressed for an XVM. Pixels are read again when it's submitted."
+    index: int
+    tex: Texture
+    checksum: str
+
+
+class PendingXvm:
+    "XVM whose textures are still being compressed. Compressed textures are cached when they are done."
+    def __init__(self, xvrs: list, uncached: list[UncachedTexture], cache_index_path: str, checksums: dict[str, str], cache_paths: list[str]):
+        # Xvr if it came from the cache, PendingXvr once it is submitted, None before that
+        self.xvrs = xvrs
+        self.uncached = uncached
+        self.cache_index_path = cache_index_path
+        self.checksums = checksums
+        self.cache_paths = cache_paths
+
+    def result(self) -> bytearray:
+        xvrs = []
+        for (xvr, cache_path) in zip(self.xvrs, self.cache_paths):
+            if isinstance(xvr, PendingXvr):
+                xvr = xvr.result()
+                cache_xvr(cache_path, xvr)
+            xvrs.append(xvr)
+        if len(self.checksums) > 0:
+            # Other XVMs may have been saved to the same cache in the meantime
+            cache_index = load_cache_index(self.cache_index_path)
+            cache_index.update(self.checksums)
+            save_cache_index(self.cache_index_path, cache_index)
+        buf = ResizableBuffer(0)
+        # I'll just explicitly write the lists because it's easier
+        xvm = Xvm(
+            body_size=Xvm.type_size() - 4,
+            xvr_count=len(xvrs))
+        xvm.serialize_into(buf)
+        for xvr in xvrs:
+            data = xvr.data
+            xvr.data = []
+            xvr.serialize_into(buf)
+            buf.append(data)
+            buf.seek_to_end()
+        return buf.trim()
+
+
+def load_cached_xvm(dirname: str, textures: list[Texture]) -> PendingXvm:
+    "Loads the textures whose pixels have not changed since they were cached, and nothing is compressed yet"
     # Cache xvr files in a subdirectory inside the destination directory
     cache_dir = "pso-blender-cache"
     xvr_ext = ".xvr"
-    (dirname, _) = os.path.split(path)
     # Index contains checksums of files
     cache_index_path = os.path.join(dirname, cache_dir, "index.json")
     cache_index = load_cache_index(cache_index_path)
     xvrs = []
+    uncached = []
+    checksums = {}
+    cache_paths = []
     for tex in textures:
         (_, basename) = os.path.split(tex.image.filepath)
         cache_dir_path = os.path.join(dirname, cache_dir)
@@ -277,27 +368,98 @@ def write(path: str, textures: list[Texture]):
         xvr_basename = basename + xvr_ext
         cached_xvr_path = os.path.join(cache_dir_path, xvr_basename)
         # Try to load cached textures from destination directory if pixels have not changed
-        checksum = texture_checksum(tex)
+        pixels = image_pixels(tex.image)
+        checksum = texture_checksum(tex, pixels)
         if os.path.isfile(cached_xvr_path) and checksum == cache_index.get(xvr_basename):
             xvr = get_cached_xvr(cached_xvr_path)
             xvr.id = tex.id # Use new texture id
         else:
-            xvr = make_xvr(tex)
-            cache_xvr(cached_xvr_path, xvr)
-        cache_index[xvr_basename] = checksum
-        save_cache_index(cache_index_path, cache_index)
+            xvr = None
+            uncached.append(UncachedTexture(len(xvrs), tex, checksum))
+        checksums[xvr_basename] = checksum
         xvrs.append(xvr)
-    buf = ResizableBuffer(0)
-    # I'll just explicitly write the lists because it's easier
-    xvm = Xvm(
-        body_size=Xvm.type_size() - 4,
-        xvr_count=len(xvrs))
-    xvm.serialize_into(buf)
-    for xvr in xvrs:
-        data = xvr.data
-        xvr.data = []
-        xvr.serialize_into(buf)
-        buf.append(data)
-        buf.seek_to_end()
+        cache_paths.append(cached_xvr_path)
+    return PendingXvm(xvrs, uncached, cache_index_path, checksums, cache_paths)
+
+
+def submit_uncached(xvms: list[PendingXvm], encoder: dxt.Encoder):
+    """Starts compressing the textures that were not in the cache for all XVMs.
+    Textures with the same checksum in several XVMs are compressed once.
+    Largest textures are submitted first so that the workers don't end up waiting for one big texture at the end.
+    Pixels are only read when a texture is submitted, so they don't all have to be in memory at once."""
+    uncached = [(xvm, item) for xvm in xvms for item in xvm.uncached]
+    uncached.sort(key=lambda xvm_and_item: xvm_and_item[1].tex.image.size[0] * xvm_and_item[1].tex.image.size[1], reverse=True)
+    submitted: dict[str, PendingXvr] = {}
+    for (xvm, item) in uncached:
+        pending = submitted.get(item.checksum)
+        if pending is None:
+            pending = submit_xvr(item.tex, encoder)
+            submitted[item.checksum] = pending
+        else:
+            pending = pending.with_id(item.tex.id)
+        xvm.xvrs[item.index] = pending
+    for xvm in xvms:
+        xvm.uncached = []
+
+
+def submit_xvm(dirname: str, textures: list[Texture], encoder: dxt.Encoder) -> PendingXvm:
+    "Starts compressing all textures that aren't cached"
+    xvm = load_cached_xvm(dirname, textures)
+    submit_uncached([xvm], encoder)
+    return xvm
+
+
+def make_xvm(dirname: str, textures: list[Texture], encoder: dxt.Encoder=None) -> bytearray:
+    "Textures are compressed with the encoder if given, or with a new one otherwise"
+    if encoder is not None:
+        return submit_xvm(dirname, textures, encoder).result()
+    with dxt.Encoder() as encoder:
+        return submit_xvm(dirname, textures, encoder).result()
+
+
+def write(path: str, textures: list[Texture], encoder: dxt.Encoder=None):
+    (dirname, _) = os.path.split(path)
+    xvm_buf = make_xvm(dirname, textures, encoder)
     with open(path, "wb") as f:
-        f.write(buf.buffer)
+        f.write(xvm_buf)
+
+
+def read_from(buf) -> list[tuple[Xvr, np.ndarray]]:
+    """Returns the header of each texture and the RGBA pixels of its largest mip level as a float32 array.
+    Pixels are in the same order as in bpy.types.Image.pixels."""
+    magic_size = 4
+    buf = memoryview(buf)
+    if bytes(buf[0:magic_size]) != b"XVMH":
+        raise Exception("XVM Error: File doesn't start with 'XVMH'")
+    (xvm, offset) = Xvm.deserialize_from(buf, magic_size)
+    textures = []
+    for _ in range(xvm.xvr_count):
+        if bytes(buf[offset:offset + magic_size]) != b"XVRT":
+            raise Exception("XVM Error: Expected texture {} to start with 'XVRT' at offset {:#x}".format(len(textures), offset))
+        (xvr, data_offset) = Xvr.deserialize_from(buf, offset + magic_size)
+        xvr.data = buf[data_offset:data_offset + xvr.data_size]
+        if xvr.format != XvrFormat.DXT1:
+            raise Exception("XVM Error: Texture {:#x} has unsupported format {}".format(xvr.id, xvr.format))
+        textures.append((xvr, dxt.decompress_image(xvr.data, xvr.width, xvr.height)))
+        # Size of the body comes after the magic
+        offset += magic_size + 4 + xvr.body_size
+    return textures
+
+
+def read(path: str) -> list[tuple[Xvr, np.ndarray]]:
+    with open(path, "rb") as f:
+        return read_from(f.read())
+
+
+def to_blender_images(textures: list[tuple[Xvr, np.ndarray]], names: list[str]=None) -> list[bpy.types.Image]:
+    """Textures without a name in the list are named after their ID.
+    Images are packed into the blend file since they don't exist on disk."""
+    names = names or []
+    images = []
+    for (i, (xvr, pixels)) in enumerate(textures):
+        name = names[i] if i < len(names) else "texture_{:08x}".format(xvr.id)
+        image = bpy.data.images.new(name, xvr.width, xvr.height, alpha=bool(xvr.flags & XvrFlags.ALPHA))
+        image.pixels.foreach_set(pixels)
+        image.pack()
+        images.append(image)
+    return images
@@ -1,6 +1,13 @@
 from dataclasses import dataclass, field
-import unittest
-from pso_blender.serialization import Serializable, Numeric, ResizableBuffer, FixedArray
+import unittest, io, os, random, struct, tempfile, warnings
+from unittest import mock
+from array import array
+import numpy as np
+from pso_blender.serialization import Serializable, Numeric, ResizableBuffer, FixedArray, PackedArray, AlignedString, read_packed_array
+from pso_blender.rel import Rel
+from pso_blender import prs, dxt, xj, xvm, bml, util, c_rel, n_rel, r_rel
+from pso_blender.iff import IffChunk, read_chunks, read_pof0, parse_pof0
+from pso_blender.njtl import TextureList, TextureListEntry, read_texture_names, write_texture_entries
 
 
 U8 = Numeric.U8
@@ -41,6 +48,20 @@ class MyPointingStruct(Serializable):
     sibling: Ptr32 = NULLPTR
 
 
+@dataclass
+class MyFixedPointingStruct(Serializable):
+    flags: U32 = 0
+    child: Ptr32 = NULLPTR
+    sibling: Ptr32 = NULLPTR
+
+
+@dataclass
+class MyNestedStruct(Serializable):
+    flags: U16 = 0
+    position: MyBasicStruct = field(default_factory=MyBasicStruct)
+    indices: list[U16] = field(default_factory=list)
+
+
 @dataclass
 class MyBufferStruct(Serializable):
     data_count: U32 = 0
@@ -53,6 +74,12 @@ class MyFixedArrayStruct(Serializable):
     flags: U32 = 0
 
 
+@dataclass
+class MyPackedArrayStruct(Serializable):
+    count: U16 = 0
+    indices: PackedArray(U16) = field(default_factory=list)
+
+
 class TestSerialization(unittest.TestCase):
     def test_basic_struct_instance_size(self):
         self.assertEqual(MyBasicStruct().instance_size(), 12)
@@ -72,8 +99,37 @@ class TestSerialization(unittest.TestCase):
         fmt = Numeric.format_of_type(U32)
         size = Numeric.size_of_format(fmt)
         buf.pack(fmt, 123)
-        self.assertEqual(buf.capacity, size)
+        self.assertEqual(buf.length, size)
+        self.assertGreaterEqual(buf.capacity, size)
         self.assertEqual(buf.offset, size)
+
+    def test_resizable_buffer_reserve(self):
+        buf = ResizableBuffer(0)
+        buf.reserve(0x10000)
+        allocation = buf.buffer
+        for i in range(0x10000 // 4):
+            buf.pack("<L", i)
+        self.assertIs(buf.buffer, allocation)
+        self.assertEqual(buf.capacity, 0x10000)
+
+    def test_resizable_buffer_clear(self):
+        buf = ResizableBuffer(0)
+        buf.pack("<L", 0xdeadbeef)
+        allocation = buf.buffer
+        buf.clear()
+        self.assertIs(buf.buffer, allocation)
+        buf.pack("<B", 1)
+        buf.grow_by(2)
+        buf.skip(1)
+        buf.grow_to(8)
+        self.assertEqual(buf.trim(), b"\x01" + b"\0" * 7)
+
+    def test_resizable_buffer_trim(self):
+        buf = ResizableBuffer(0)
+        buf.pack("<H", 0xbeef)
+        buf.append(b"\xff")
+        self.assertEqual(buf.trim(), b"\xef\xbe\xff")
+        self.assertEqual(buf.capacity, 3)
     
     def test_serialize_basic_struct_unaligned(self):
         buf = ResizableBuffer(0)
@@ -92,6 +148,91 @@ class TestSerialization(unittest.TestCase):
         item = MyPointingStruct(data_count=len(data), data=data, sibling=1337)
         self.assertEqual(item.nonnull_pointer_member_offsets(), [11])
     
+    def test_fixed_struct_layout(self):
+        layout = MyFixedArrayStruct.layout()
+        self.assertTrue(layout.is_fixed_size)
+        self.assertEqual(layout.size, 20)
+        self.assertEqual(layout.struct.format, "<16BL")
+        self.assertFalse(MyFlexStruct.layout().is_fixed_size)
+
+    def test_fixed_struct_nonnull_pointer_member_offsets(self):
+        item = MyFixedPointingStruct(child=1337)
+        self.assertEqual(item.nonnull_pointer_member_offsets(), [4])
+
+    def test_serialize_collects_pointer_offsets(self):
+        buf = ResizableBuffer(0)
+        buf.pack("<L", 0)
+        pointers = []
+        item = MyPointingStruct(data_count=3, data=[1, 2, 3], child=1337)
+        offset = item.serialize_into(buf, 4, pointers)
+        self.assertEqual(pointers, [offset + 7])
+
+    def test_serialize_sequence_collects_pointer_offsets(self):
+        buf = ResizableBuffer(0)
+        pointers = []
+        items = [MyFixedPointingStruct(child=1), MyFixedPointingStruct(), MyFixedPointingStruct(child=1, sibling=2)]
+        Serializable.serialize_sequence(items, buf, pointers)
+        self.assertEqual(pointers, [4, 28, 32])
+
+    def test_serialize_fixed_struct_aligned(self):
+        buf = ResizableBuffer(0)
+        buf.pack("<B", 0xff)
+        offset = MyUnalignedStruct(foo=1, bar=2, buz=3).serialize_into(buf, 4)
+        self.assertEqual(offset, 1)
+        self.assertEqual(buf.offset, 8)
+        self.assertEqual(buf.trim(), b"\xff\x01\x00\x02\x00\x03\x00\x00")
+
+    def test_serialize_nested_struct(self):
+        buf = ResizableBuffer(0)
+        item = MyNestedStruct(flags=1, position=MyBasicStruct(x=1.0), indices=[2, 3])
+        item.serialize_into(buf)
+        self.assertEqual(item.instance_size(), 2 + 12 + 4)
+        self.assertEqual(buf.trim(), b"\x01\x00\x00\x00\x80\x3f" + b"\0" * 8 + b"\x02\x00\x03\x00")
+
+    def test_serialize_nested_struct_big_endian(self):
+        buf = ResizableBuffer(0, endianness_prefix=Numeric.BIG_ENDIAN)
+        item = MyNestedStruct(flags=1, position=MyBasicStruct(x=1.0), indices=[2, 3])
+        item.serialize_into(buf)
+        self.assertEqual(buf.trim(), b"\x00\x01\x3f\x80\x00\x00" + b"\0" * 8 + b"\x00\x02\x00\x03")
+        (result, _) = MyNestedStruct.deserialize_from(buf.buffer, 0, Numeric.BIG_ENDIAN)
+        self.assertEqual(result.position, item.position)
+
+    def test_serialize_packed_array_member(self):
+        item = MyPackedArrayStruct(count=2, indices=array("H", [1, 0x0203]))
+        little = ResizableBuffer(0)
+        item.serialize_into(little)
+        self.assertEqual(little.trim(), b"\x02\x00\x01\x00\x03\x02")
+        big = ResizableBuffer(0, endianness_prefix=Numeric.BIG_ENDIAN)
+        item.serialize_into(big)
+        self.assertEqual(big.trim(), b"\x00\x02\x00\x01\x02\x03")
+        self.assertEqual(item.indices, array("H", [1, 0x0203]))
+        self.assertEqual(MyPackedArrayStruct(count=2, indices=[1, 0x0203]).instance_size(), 6)
+
+    def test_read_packed_array(self):
+        indices = read_packed_array(U16, b"\xff\x00\x02\x00\x01", 1, 2, Numeric.BIG_ENDIAN)
+        self.assertEqual(indices, array("H", [2, 1]))
+
+    def test_serialize_aligned_string(self):
+        buf = ResizableBuffer(0)
+        offset = AlignedString("abc", 8).serialize_into(buf, None)
+        self.assertEqual(offset, 0)
+        self.assertEqual(buf.trim(), b"abc\0" + b"\0" * 4)
+
+    def test_serialize_homogeneous_list_member(self):
+        buf = ResizableBuffer(0)
+        vertices = [MyBasicStruct(x=1.0), MyBasicStruct(y=1.0)]
+        MyFlexStruct(flags=0xff, vertices=vertices).serialize_into(buf)
+        self.assertEqual(buf.offset, 4 + 12 * 2)
+        self.assertEqual(buf.buffer[4:16], b"\x00\x00\x80\x3f" + b"\0" * 8)
+        self.assertEqual(buf.buffer[16:28], b"\0" * 4 + b"\x00\x00\x80\x3f" + b"\0" * 4)
+
+    def test_serialize_mixed_list_member(self):
+        buf = ResizableBuffer(0)
+        vertices = [MyBasicStruct(x=1.0), MyUnalignedStruct(foo=1)]
+        MyFlexStruct(vertices=vertices).serialize_into(buf)
+        self.assertEqual(buf.offset, 4 + 12 + 6)
+        self.assertEqual(buf.buffer[16:18], b"\x01\x00")
+
     def test_serialize_buffer_member(self):
         buf = ResizableBuffer(0)
         data = b"\xde\xad\xbe\xef"
@@ -108,6 +249,7 @@ class TestSerialization(unittest.TestCase):
         buf = ResizableBuffer(0)
         item = MyFixedArrayStruct(name=list(str.encode("deadbeef")), flags=0xdeadbeef)
         item.serialize_into(buf)
+        buf.trim()
         self.assertEqual(buf.buffer[0:8], b"deadbeef")
         self.assertEqual(buf.buffer[8:16], b"\0\0\0\0\0\0\0\0")
         self.assertEqual(buf.buffer[16:24], b"\xef\xbe\xad\xde")
@@ -122,6 +264,44 @@ class TestDeserialization(unittest.TestCase):
         self.assertEqual(result.y, 1.0)
         self.assertEqual(result.z, 1.0)
 
+    def test_nested_struct_deserialize(self):
+        buf = b"\x01\x00\x00\x00\x80\x3f" + b"\0" * 8
+        (result, offset) = MyNestedStruct.deserialize_from(buf)
+        self.assertEqual(offset, 14)
+        self.assertEqual(result.flags, 1)
+        self.assertEqual(result.position.x, 1.0)
+        self.assertEqual(result.indices, [])
+
+    def test_read_array(self):
+        buf = bytearray(b"\xff" + b"\x00\x00\x80\x3f\x00\x00\x00\x40\x00\x00\x40\x40" * 2)
+        vertices = MyBasicStruct.read_array(buf, 1, 2)
+        self.assertEqual(len(vertices), 2)
+        self.assertEqual(list(vertices["x"]), [1.0, 1.0])
+        self.assertEqual(vertices[1]["z"], 3.0)
+        # Array is a view into the buffer
+        vertices[0]["y"] = 0.0
+        self.assertEqual(buf[5:9], b"\0\0\0\0")
+
+    def test_read_vertex_buffer_container(self):
+        buf = ResizableBuffer(0)
+        vertices = buf.offset
+        for vertex in (xj.VertexFormat1(x=1, y=2, z=3, u=0.5), xj.VertexFormat1(x=4, v=0.25)):
+            vertex.serialize_into(buf)
+        container = xj.VertexBufferContainer(
+            vertex_format=1, vertex_buffer=vertices, vertex_size=xj.VertexFormat1.type_size(), vertex_count=2)
+        offset = container.serialize_into(buf)
+        (result, _) = xj.VertexBufferContainer.deserialize_from(buf.buffer, offset)
+        self.assertIsInstance(result.vertex_buffer, np.ndarray)
+        self.assertEqual(result.vertex_buffer["x"].tolist(), [1, 4])
+        self.assertEqual(result.vertex_buffer["u"].tolist(), [0.5, 0])
+        self.assertEqual(result.vertex_buffer["v"].tolist(), [0, 0.25])
+
+    def test_read_array_fixed_array(self):
+        buf = b"deadbeef\0\0\0\0\0\0\0\0\xef\xbe\xad\xde"
+        result = MyFixedArrayStruct.read_array(buf, 0, 1)
+        self.assertEqual(bytes(result["name"][0][0:8]).decode(), "deadbeef")
+        self.assertEqual(result["flags"][0], 0xdeadbeef)
+
     def test_fixed_array(self):
         buf = b"deadbeef\0\0\0\0\0\0\0\0\xef\xbe\xad\xde"
         (result, offset) = MyFixedArrayStruct.deserialize_from(buf)
@@ -129,5 +309,501 @@ class TestDeserialization(unittest.TestCase):
         self.assertEqual(result.flags, 0xdeadbeef)
 
 
+class TestRel(unittest.TestCase):
+    def write_rel(self, rel: Rel) -> bytearray:
+        first = rel.write(MyFixedPointingStruct(flags=1))
+        second = rel.write(MyFixedPointingStruct(flags=2, sibling=first))
+        rel.patch_pointer(first + 4, second)
+        return rel.finish(second)
+
+    def test_rel_pointer_table(self):
+        rel = Rel.read_from(self.write_rel(Rel()))
+        self.assertEqual(list(rel.pointer_offsets), [8, 24])
+        self.assertEqual(rel.payload_offset, 16)
+        (first, _) = rel.read(MyFixedPointingStruct, 4)
+        self.assertEqual(first.child, 16)
+
+    def test_streaming_rel(self):
+        stream = io.BytesIO()
+        self.assertIsNone(self.write_rel(Rel(stream=stream)))
+        self.assertEqual(stream.getvalue(), self.write_rel(Rel()))
+
+    def test_streaming_rel_unaligned_records(self):
+        def write_rel(rel: Rel) -> bytearray:
+            rel.write(MyUnalignedStruct(foo=1, bar=2, buz=3))
+            name = rel.write(AlignedString("ab", Rel.ALIGNMENT))
+            rel.write(MyUnalignedStruct(foo=4))
+            rel.write(MyUnalignedStruct(foo=5), ensure_aligned=True)
+            pointing = rel.write(MyFixedPointingStruct(flags=6, child=name))
+            return rel.finish(pointing)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            stream = io.BytesIO()
+            write_rel(Rel(stream=stream))
+            self.assertEqual(stream.getvalue(), write_rel(Rel()))
+
+    def test_failed_write_keeps_existing_file(self):
+        def write_rel_then_fail(rel: Rel, *args):
+            rel.write(MyFixedPointingStruct(flags=1))
+            raise Exception("REL Error: Object has no faces")
+        writers = (
+            (c_rel, lambda path: c_rel.write(path, [])),
+            (r_rel, lambda path: r_rel.write(path, [])),
+            (n_rel, lambda path: n_rel.write(path, None, None, [], [])))
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "map.rel")
+            for (module, write) in writers:
+                with open(path, "wb") as f:
+                    f.write(b"previous export")
+                with mock.patch.object(module, "write_rel", write_rel_then_fail):
+                    with self.assertRaises(Exception):
+                        write(path)
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), b"previous export")
+                # No temporary files are left behind
+                self.assertEqual(os.listdir(dirname), ["map.rel"])
+
+    def test_read_texture_names(self):
+        rel = Rel()
+        name_ptrs = [rel.write(AlignedString(name, Rel.ALIGNMENT)) for name in ("a", "grass01")]
+        entry_ptrs = [rel.write(TextureListEntry(name=name_ptr)) for name_ptr in name_ptrs]
+        texlist_ptr = rel.write(TextureList(elements=entry_ptrs[0], count=len(entry_ptrs)))
+        rel = Rel.read_from(rel.finish(texlist_ptr))
+        self.assertEqual(read_texture_names(rel.buf.buffer, rel.payload_offset), ["a", "grass01"])
+
+    def assertTextureEntryArray(self, buf, elements: int, names: list[str]):
+        "Entries follow each other like the game reads them, and every name comes before the entries"
+        entries = TextureListEntry.read_sequence(buf, elements, len(names))
+        self.assertTrue(all(entry.name < elements for entry in entries))
+        self.assertEqual([bytes(buf[entry.name:buf.index(0, entry.name)]).decode() for entry in entries], names)
+
+    def test_write_texture_entries_rel(self):
+        names = ["a", "grass01", "rock_wall"]
+        rel = Rel()
+        elements = write_texture_entries(rel, names, Rel.ALIGNMENT)
+        texlist_ptr = rel.write(TextureList(elements=elements, count=len(names)))
+        rel = Rel.read_from(rel.finish(texlist_ptr))
+        self.assertTextureEntryArray(rel.buf.buffer, elements, names)
+        self.assertEqual(read_texture_names(rel.buf.buffer, rel.payload_offset), names)
+        # Names and entries are relocated
+        self.assertEqual(len(rel.pointer_offsets), len(names) + 1)
+
+    def test_write_texture_entries_njtl(self):
+        names = ["a", "grass01", "rock_wall"]
+        chunk = IffChunk("NJTL")
+        elements = write_texture_entries(chunk, names, IffChunk.ALIGNMENT)
+        texlist_offset = chunk.write(TextureList(elements=elements, count=len(names)))
+        ((chunk_type, _, body), (pof0_type, _, _)) = read_chunks(io.BytesIO(chunk.finish()))
+        self.assertEqual((chunk_type, pof0_type), ("NJTL", "POF0"))
+        self.assertTextureEntryArray(body, elements, names)
+        self.assertEqual(read_texture_names(body, texlist_offset), names)
+
+
+class TestPrs(unittest.TestCase):
+    def assertRoundTrip(self, data: bytes):
+        self.assertEqual(bytes(prs.decompress(prs.compress(data))), data)
+
+    def test_prs_round_trip_empty(self):
+        self.assertRoundTrip(b"")
+
+    def test_prs_round_trip_literals(self):
+        self.assertRoundTrip(bytes(range(256)))
+
+    def test_prs_round_trip_short_matches(self):
+        data = b"abcab" + b"xyzxy" * 3
+        self.assertRoundTrip(data)
+
+    def test_prs_round_trip_long_matches(self):
+        data = bytes(range(200)) + bytes(0x400) + bytes(range(200)) * 2 + b"\xff" * 20
+        compressed = prs.compress(data)
+        self.assertLess(len(compressed), len(data) // 2)
+        self.assertEqual(bytes(prs.decompress(compressed)), data)
+
+    def test_prs_round_trip_far_matches(self):
+        # Repeats just within and just outside of the 0x1fff byte window
+        block = bytes((i * 7 + i // 256) & 0xff for i in range(0x1ffc))
+        self.assertRoundTrip(block + block[:0x20] + bytes(4) + block[:0x20])
+
+    def test_prs_optimal_round_trip(self):
+        data = b"abcab" + b"xyzxy" * 3 + bytes(range(200)) + bytes(0x400) + bytes(range(200)) * 2
+        compressed = prs.compress(data, prs.Level.OPTIMAL)
+        self.assertEqual(bytes(prs.decompress(compressed)), data)
+        self.assertLessEqual(len(compressed), len(prs.compress(data, prs.Level.FAST)))
+
+    def test_prs_decompress_with_size(self):
+        # Overlapping back-references of every period up to 8
+        data = b"".join(bytes(range(period)) * 40 for period in range(1, 9)) + b"tail"
+        compressed = prs.compress(data)
+        self.assertEqual(bytes(prs.decompress(compressed, len(data))), data)
+        self.assertEqual(bytes(prs.decompress(compressed, len(data) // 2)), data)
+
+    def test_prs_reader(self):
+        data = bytes((i * 7 + i // 0x300) & 0xff for i in range(0x30000))
+        reader = prs.Reader(prs.compress(data))
+        pieces = []
+        while True:
+            piece = reader.read(0x1234)
+            if len(piece) == 0:
+                break
+            pieces.append(piece)
+            reader.seek(0x10, io.SEEK_CUR)
+        self.assertEqual(b"".join(pieces), b"".join(data[i:i + 0x1234] for i in range(0, len(data), 0x1244)))
+        self.assertEqual(reader.tell(), len(data))
+
+    def test_prs_reader_preallocated(self):
+        data = bytes((i * 7 + i // 0x300) & 0xff for i in range(0x30000))
+        for size in (len(data), len(data) // 2, len(data) * 2):
+            reader = prs.Reader(prs.compress(data), size)
+            self.assertEqual(bytes(reader.read(0x1234)), data[:0x1234])
+            reader.seek(0x10000)
+            self.assertEqual(bytes(reader.read()), data[0x10000:])
+            self.assertEqual(reader.tell(), len(data))
+
+    def test_iff_read_chunks(self):
+        file_data = bytearray()
+        for _ in range(2):
+            chunk = IffChunk("NJCM")
+            chunk.write(MyFixedPointingStruct(flags=1))
+            chunk.write(MyFixedPointingStruct(child=8, sibling=12))
+            file_data += chunk.finish()
+        chunks = list(read_chunks(prs.Reader(prs.compress(file_data))))
+        self.assertEqual([(chunk_type, offset) for (chunk_type, offset, _) in chunks], [
+            ("NJCM", 0), ("POF0", 0x20), ("NJCM", len(file_data) // 2), ("POF0", len(file_data) // 2 + 0x20)])
+        (_, prev_offset, prev_body) = chunks[2]
+        (_, pof0_offset, pof0_body) = chunks[3]
+        self.assertEqual(
+            read_pof0(pof0_body, prev_body, prev_offset),
+            parse_pof0("", file_data, prev_offset, len(prev_body), pof0_offset, len(pof0_body)))
+        self.assertEqual(read_pof0(pof0_body, prev_body, prev_offset), [(prev_offset + 0x18, 8), (prev_offset + 0x1c, 12)])
+        skipped = list(read_chunks(io.BytesIO(file_data), skip_types=("NJCM",)))
+        self.assertEqual([body for (_, _, body) in skipped][0::2], [None, None])
+
+
+class TestDxt(unittest.TestCase):
+    def compress_image_per_block(self, pixels: list[float], width: int, height: int, channels: int, with_alpha: bool) -> bytearray:
+        buf = ResizableBuffer(0)
+        for y in range(0, height, 4):
+            for x in range(0, width, 4):
+                buf.pack("<HHL", *dxt.dxt1_compress_block(pixels, width, 4, channels, with_alpha, (x, y)))
+        return buf.trim()
+
+    def test_dxt1_matches_per_block_compression(self):
+        rng = random.Random(1)
+        for (width, height, channels, with_alpha) in ((8, 4, 3, False), (8, 8, 4, False), (4, 12, 4, True)):
+            # Mix of smooth, flat and exactly representable values
+            pixels = [rng.choice((rng.random(), 0.0, 1.0, 0.5)) for _ in range(width * height * channels)]
+            self.assertEqual(
+                dxt.compress_image(pixels, width, height, channels, with_alpha),
+                self.compress_image_per_block(pixels, width, height, channels, with_alpha))
+
+    def test_dxt1_parallel_bands(self):
+        rng = random.Random(2)
+        pixels = array("f", (rng.random() for _ in range(16 * 24 * 4)))
+        single = dxt.compress_image(pixels, 16, 24, 4, True, workers=1)
+        with mock.patch.object(dxt, "MIN_PARALLEL_BLOCKS", 0):
+            self.assertEqual(dxt.compress_image(pixels, 16, 24, 4, True, workers=2), single)
+
+    def block_errors(self, blocks: list, compressed: bytes, with_alpha: bool) -> list[int]:
+        "Squared errors of the opaque pixels of each compressed block"
+        errors = []
+        for (i, block) in enumerate(blocks):
+            (color0, color1, indices) = struct.unpack_from("<HHL", compressed, i * 8)
+            palette = dxt.dxt_make_color_palette(color0, color1)
+            error = 0
+            for (px_idx, pixel) in enumerate(block):
+                palette_idx = (indices >> (px_idx * 2)) & 3
+                if with_alpha and pixel[3] < 1.0:
+                    self.assertEqual(palette_idx, 3)
+                    continue
+                error += sum((pixel[chan] * 0xff - palette[palette_idx][chan]) ** 2 for chan in range(3))
+            errors.append(error)
+        return errors
+
+    def test_dxt1_high_quality(self):
+        rng = random.Random(4)
+        # Gradients with noise
+        pixels = [min(1.0, max(0.0, (x + y) / 14 + rng.uniform(-0.05, 0.05))) for y in range(8) for x in range(8) for _ in range(4)]
+        for with_alpha in (False, True):
+            if with_alpha:
+                pixels[3::4] = [rng.choice((0.0, 1.0, 1.0)) for _ in range(64)]
+            blocks = dxt.image_to_blocks(pixels, 8, 8, 4).tolist()
+            fast = dxt.compress_image(pixels, 8, 8, 4, with_alpha, workers=1, quality=dxt.Quality.FAST)
+            high = dxt.compress_image(pixels, 8, 8, 4, with_alpha, workers=1, quality=dxt.Quality.HIGH)
+            fast_errors = self.block_errors(blocks, fast, with_alpha)
+            high_errors = self.block_errors(blocks, high, with_alpha)
+            for (fast_error, high_error) in zip(fast_errors, high_errors):
+                self.assertLessEqual(high_error, fast_error)
+            self.assertLess(sum(high_errors), sum(fast_errors))
+            # Blocks with alpha must stay in the three color format
+            for i in range(4):
+                (color0, color1) = struct.unpack_from("<HH", high, i * 8)
+                self.assertEqual(color0 <= color1, with_alpha or color0 == color1)
+
+    def test_dxt1_decompress(self):
+        rng = random.Random(5)
+        pixels = [rng.random() for _ in range(8 * 8 * 4)]
+        pixels[3::4] = [rng.choice((0.0, 1.0)) for _ in range(64)]
+        for with_alpha in (False, True):
+            compressed = dxt.compress_image(pixels, 8, 8, 4, with_alpha, workers=1)
+            decompressed = dxt.decompress_image(compressed, 8, 8)
+            self.assertEqual(decompressed.shape, (8 * 8 * 4, ))
+            for y in range(8):
+                for x in range(8):
+                    block = (y // 4) * 2 + x // 4
+                    (color0, color1, indices) = struct.unpack_from("<HHL", compressed, block * 8)
+                    palette_idx = (indices >> (((y % 4) * 4 + (x % 4)) * 2)) & 3
+                    color = dxt.dxt_make_color_palette(color0, color1)[palette_idx]
+                    alpha = 0 if color0 <= color1 and palette_idx == 3 else 0xff
+                    pixel = decompressed[(y * 8 + x) * 4:(y * 8 + x + 1) * 4]
+                    self.assertEqual([round(value * 0xff) for value in pixel], [color[0], color[1], color[2], alpha])
+                    if with_alpha:
+                        self.assertEqual(pixel[3], 1.0 if pixels[(y * 8 + x) * 4 + 3] == 1.0 else 0.0)
+        # Flat blocks of colors that DXT1 can store exactly come back unchanged
+        flat = [value for block_color in ((1.0, 0.0, 0.0, 1.0), (0.0, 1.0, 1.0, 1.0)) for value in block_color * 16]
+        self.assertEqual(list(dxt.decompress_image(dxt.compress_image(flat, 4, 8, 4, False), 4, 8)), flat)
+
+    def test_dxt1_encoder(self):
+        rng = random.Random(3)
+        images = [(array("f", (rng.random() for _ in range(width * height * 4))), width, height)
+                  for (width, height) in ((16, 24), (8, 4), (4, 4), (32, 8))]
+        expected = [dxt.compress_image(pixels, width, height, 4, True, workers=1) for (pixels, width, height) in images]
+        for workers in (1, 2):
+            with mock.patch.object(dxt.Encoder, "BAND_BLOCKS", 2):
+                with dxt.Encoder(workers) as encoder:
+                    # Everything is submitted before any result is needed
+                    pending = [encoder.submit(pixels, width, height, 4, True) for (pixels, width, height) in images]
+                    results = [image.result() for image in pending]
+            self.assertEqual(results, expected)
+
+    def test_dxt1_encoder_releases_shared_memory(self):
+        rng = random.Random(4)
+        pixels = array("f", (rng.random() for _ in range(16 * 16 * 4)))
+        unlink = mock.Mock(wraps=dxt.release_shared)
+        with mock.patch.object(dxt, "release_shared", unlink):
+            with dxt.Encoder(2) as encoder:
+                taken = encoder.submit(pixels, 16, 16, 4, True)
+                taken.result()
+                self.assertEqual(unlink.call_count, 1)
+                # Images whose result is never taken are released when the encoder stops
+                encoder.submit(pixels, 16, 16, 4, True)
+            self.assertEqual(unlink.call_count, 2)
+
+
+class TestBml(unittest.TestCase):
+    def make_file_data(self, count: int) -> bytearray:
+        "IFF file with a NJCM (+POF0) chunk holding count pointing structs"
+        chunk = IffChunk("NJCM")
+        prev = None
+        for i in range(count):
+            prev = chunk.write(MyFixedPointingStruct(flags=i, sibling=prev if prev is not None else 0))
+        return chunk.finish()
+
+    def write_bml(self, dirname: str) -> tuple[str, list]:
+        files = [("first.xj", self.make_file_data(3), None), ("second.xj", self.make_file_data(40), None)]
+        path = os.path.join(dirname, "sample.bml")
+        bml.write_files(path, files, 1)
+        return (path, files)
+
+    def test_bml_parse_entry_uncompressed(self):
+        data = self.make_file_data(5)
+        item = bml.parse_entry("file.xj", bml.CompressionType.NONE, data, len(data), None, 0)
+        chunks = list(read_chunks(io.BytesIO(data)))
+        (_, njcm_offset, njcm_body) = chunks[0]
+        (_, _, pof0_body) = chunks[1]
+        self.assertEqual(item.models, [njcm_body])
+        self.assertEqual(item.pointer_table, read_pof0(pof0_body, njcm_body, njcm_offset))
+        self.assertIsNone(item.texture_archive)
+
+    def test_bml_parse_entry_prs(self):
+        data = self.make_file_data(5)
+        self.assertEqual(
+            bml.parse_entry("file.xj", bml.CompressionType.PRS, prs.compress(data), len(data), None, 0),
+            bml.parse_entry("file.xj", bml.CompressionType.NONE, data, len(data), None, 0))
+
+    def test_bml_parse_parallel(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            (path, files) = self.write_bml(dirname)
+            items = bml.parse_bml(path, 1)
+            self.assertEqual([item.name for item in items], [name for (name, _, _) in files])
+            for (item, (name, data, _)) in zip(items, files):
+                self.assertEqual(item, bml.parse_entry(name, bml.CompressionType.NONE, data, len(data), None, 0))
+            self.assertEqual(bml.parse_bml(path, 2), items)
+
+    def test_bml_parse_in_process_without_fork(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            (path, _) = self.write_bml(dirname)
+            items = bml.parse_bml(path, 1)
+            # Forking Blender is only safe on Linux
+            for platform in ("darwin", "win32"):
+                with mock.patch.object(util.sys, "platform", platform), \
+                        mock.patch.object(util.multiprocessing, "get_context", side_effect=AssertionError):
+                    self.assertEqual(bml.parse_bml(path, 2), items)
+
+    def test_bml_archive_open(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            (path, files) = self.write_bml(dirname)
+            with bml.BmlArchive(path) as archive:
+                self.assertEqual(archive.names(), [name for (name, _, _) in files])
+                self.assertEqual([archive.open(name) for (name, _, _) in files], bml.parse_bml(path, 1))
+                with self.assertRaises(Exception):
+                    archive.open("missing.xj")
+
+    def test_bml_archive_cache_eviction(self):
+        files = [(name, self.make_file_data(4), None) for name in ("a.xj", "b.xj", "c.xj")]
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "sample.bml")
+            bml.write_files(path, files, 1)
+            item_size = bml.BmlArchive.item_size(bml.parse_bml(path, 1)[0])
+            with bml.BmlArchive(path, cache_size=item_size * 2) as archive:
+                a = archive.open("a.xj")
+                b = archive.open("b.xj")
+                # Accessing a again makes b the least recently used
+                self.assertIs(archive.open("a.xj"), a)
+                archive.open("c.xj")
+                self.assertIs(archive.open("a.xj"), a)
+                self.assertIsNot(archive.open("b.xj"), b)
+                self.assertEqual(archive.open("b.xj"), b)
+
+    def test_bml_failed_write_keeps_existing_file(self):
+        def files():
+            yield bml.compress_file("first.xj", self.make_file_data(3), None)
+            raise Exception("XJ Error: Object has no faces")
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "sample.bml")
+            with open(path, "wb") as f:
+                f.write(b"previous export")
+            with self.assertRaises(Exception):
+                bml.write_stream(path, files(), 2, False)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"previous export")
+            self.assertEqual(os.listdir(dirname), ["sample.bml"])
+
+    def assertFileOffsets(self, path: str, files: list, alignment: int):
+        "Each file and texture archive starts aligned right after the previous one"
+        with bml.BmlArchive(path) as archive:
+            offset = 0x800
+            for (entry, (_, data, textures)) in zip(archive.entries, files):
+                self.assertEqual(entry.offset, offset)
+                offset = util.align_up(entry.offset + len(prs.compress(data)), alignment)
+                if textures is not None:
+                    self.assertEqual(entry.textures_offset, offset)
+                    offset = util.align_up(entry.textures_offset + entry.textures_compressed_size, alignment)
+            self.assertEqual(os.path.getsize(path), offset)
+
+    def test_bml_write_without_textures(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            (path, files) = self.write_bml(dirname)
+            self.assertFileOffsets(path, files, 0x800)
+
+    def test_bml_write_with_textures(self):
+        textures = bytes(range(256)) * 3 + bytes(0x100)
+        files = [
+            ("first.xj", self.make_file_data(3), textures),
+            ("plain.xj", self.make_file_data(7), None),
+            ("second.xj", self.make_file_data(40), textures[::-1])]
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "sample.bml")
+            bml.write_files(path, files, 1)
+            self.assertFileOffsets(path, files, 0x20)
+            items = bml.parse_bml(path, 1)
+            self.assertEqual([item.name for item in items], [name for (name, _, _) in files])
+            for (item, (name, data, textures)) in zip(items, files):
+                self.assertEqual(item, bml.parse_entry(name, bml.CompressionType.NONE, data, len(data), None, 0))
+                self.assertEqual(item.texture_archive, textures)
+
+
+class FakePixels:
+    "Stands in for bpy.types.Image.pixels"
+    def __init__(self, pixels: np.ndarray):
+        self.pixels = pixels
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __iter__(self):
+        return iter(self.pixels)
+
+    def foreach_get(self, out: np.ndarray):
+        out[:] = self.pixels
+
+
+@dataclass
+class FakeImage:
+    "Stands in for bpy.types.Image"
+    filepath: str
+    size: tuple[int, int]
+    pixels: FakePixels
+    channels: int = 4
+    alpha_mode: str = "STRAIGHT"
+
+
+class TestXvm(unittest.TestCase):
+    def make_texture(self, id: int, width: int, height: int, with_alpha: bool) -> util.Texture:
+        "Smooth gradient that DXT1 can compress with little error"
+        (y, x) = np.mgrid[0:height, 0:width]
+        pixels = np.stack([x / 64, y / 64, (x + y) / 128, np.ones((height, width))], axis=-1)
+        if with_alpha:
+            pixels[0:height // 2, :, 3] = 0
+        pixels = pixels.astype(np.float32).ravel()
+        image = FakeImage("//texture{}.png".format(id), (width, height), FakePixels(pixels))
+        return util.Texture(id=id, image=image)
+
+    def write_xvm(self, dirname: str, textures: list[util.Texture]) -> bytearray:
+        path = os.path.join(dirname, "textures.xvm")
+        xvm.write(path, textures)
+        with open(path, "rb") as f:
+            return bytearray(f.read())
+
+    def test_xvm_round_trip(self):
+        textures = [self.make_texture(0x10, 32, 16, False), self.make_texture(0x11, 8, 8, True), self.make_texture(0x12, 4, 4, False)]
+        with tempfile.TemporaryDirectory() as dirname:
+            result = xvm.read_from(self.write_xvm(dirname, textures))
+        self.assertEqual([(xvr.id, xvr.width, xvr.height) for (xvr, _) in result], [(0x10, 32, 16), (0x11, 8, 8), (0x12, 4, 4)])
+        self.assertEqual([bool(xvr.flags & xvm.XvrFlags.ALPHA) for (xvr, _) in result], [False, True, False])
+        for (tex, (xvr, pixels)) in zip(textures, result):
+            (width, height) = tex.image.size
+            original = tex.image.pixels.pixels
+            compressed = dxt.compress_image(original, width, height, 4, tex.has_alpha, workers=1)
+            np.testing.assert_array_equal(pixels, dxt.decompress_image(compressed, width, height))
+            # Opaque colors are within what 5:6:5 endpoints and 2 bit indices can represent
+            opaque = original[3::4] == 1
+            self.assertLess(np.abs(pixels - original).reshape(-1, 4)[opaque, 0:3].max(), 0.05)
+            np.testing.assert_array_equal(pixels[3::4], original[3::4])
+
+    def test_xvm_shared_texture_compressed_once(self):
+        shared = self.make_texture(0x10, 16, 16, False)
+        first = [shared, self.make_texture(0x11, 8, 8, True)]
+        second = [util.Texture(id=0x20, image=shared.image), self.make_texture(0x21, 4, 4, False)]
+        with tempfile.TemporaryDirectory() as dirname:
+            with dxt.Encoder(1) as encoder, mock.patch.object(encoder, "submit", wraps=encoder.submit) as submit:
+                pending = [xvm.load_cached_xvm(dirname, textures) for textures in (first, second)]
+                xvm.submit_uncached(pending, encoder)
+                self.assertEqual(submit.call_count, 3)
+                results = [xvm.read_from(pending_xvm.result()) for pending_xvm in pending]
+            expected = [xvm.read_from(xvm.make_xvm(dirname, textures)) for textures in (first, second)]
+        for (result, textures) in zip(results, (first, second)):
+            self.assertEqual([xvr.id for (xvr, _) in result], [tex.id for tex in textures])
+        for (result, expected_result) in zip(results, expected):
+            for ((_, pixels), (_, expected_pixels)) in zip(result, expected_result):
+                np.testing.assert_array_equal(pixels, expected_pixels)
+
+    def test_xvm_to_blender_images_names(self):
+        textures = [self.make_texture(0x10, 8, 8, False), self.make_texture(0x11, 4, 4, False)]
+        with tempfile.TemporaryDirectory() as dirname:
+            result = xvm.read_from(self.write_xvm(dirname, textures))
+        with mock.patch.object(xvm, "bpy") as bpy:
+            xvm.to_blender_images(result, ["grass01"])
+        self.assertEqual(bpy.data.images.new.call_args_list, [
+            mock.call("grass01", 8, 8, alpha=False), mock.call("texture_00000011", 4, 4, alpha=False)])
+
+    def test_xvm_read_unsupported_format(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            buf = self.write_xvm(dirname, [self.make_texture(0x10, 8, 8, False)])
+        # Format comes after the magic, body size and flags
+        struct.pack_into("<L", buf, buf.index(b"XVRT") + 12, xvm.XvrFormat.A8R8G8B8)
+        with self.assertRaisesRegex(Exception, "unsupported format 1"):
+            xvm.read_from(buf)
+
+
 if __name__ == '__main__':
     unittest.main()